@@ -1,5 +1,6 @@
 import datetime
 import logging
+import time
 
 from open_facebook import OpenFacebook, FacebookAuthorization
 from open_facebook import exceptions as open_facebook_exceptions
@@ -14,6 +15,10 @@ from django_facebook.utils import mass_get_or_create, cleanup_oauth_url, get_pro
 
 logger = logging.getLogger(__name__)
 
+## The session key of the graph, and the version of what's stored in it
+GRAPH_SESSION_KEY = 'graph'
+GRAPH_SESSION_VERSION = 1
+
 def require_persistent_graph(request, *args, **kwargs):
     """Just like ``get_persistent graph``, but instead of returning
     ``None``, raises an OpenFacebookException if we can't access Facebook.
@@ -30,6 +35,10 @@ def get_persistent_graph(request, *args, **kwargs):
     the graph in the session, allowing usage across multiple page views.
     Note that Facebook sessions expire at some point, you can't store this
     for permanent usage, unless we require the ``offline_access`` permission.
+
+    Only a compact version of the graph is stored, see
+    :py:func:`graph_to_session`, and the session is only written when
+    the token changes.
     """
     if not request:
         raise(ValidationError, 'You must pass a valid ``request`` to use persistent tokens')
@@ -43,19 +52,66 @@ def get_persistent_graph(request, *args, **kwargs):
     graph = get_facebook_graph(request, *args, **kwargs)
 
     #if it's valid replace the old cache
+    stored = request.session.get(GRAPH_SESSION_KEY)
     if graph is not None and graph.access_token:
-        request.session['graph'] = graph
+        if not isinstance(stored, dict) \
+                or stored.get('access_token') != graph.access_token:
+            request.session[GRAPH_SESSION_KEY] = graph_to_session(graph)
     else:
-        facebook_open_graph_cached = request.session.get('graph')
-        if facebook_open_graph_cached:
-            facebook_open_graph_cached._me = None
-        graph = facebook_open_graph_cached
+        graph = graph_from_session(stored)
+        if graph is None and stored is not None:
+            ## expired, or stored by an incompatible version
+            del request.session[GRAPH_SESSION_KEY]
 
     _add_current_user_id(graph, request.user)
     request.facebook = graph
 
     return graph
 
+
+def graph_to_session(graph):
+    """Returns the compact, versioned representation of ``graph`` stored
+    in the session: the token, when it expires and a digest of the user
+    """
+    data = dict(version=GRAPH_SESSION_VERSION,
+                access_token=graph.access_token, expires_at=None,
+                user_id=None, name=None)
+    if graph.expires:
+        try:
+            data['expires_at'] = int(time.time()) + int(graph.expires)
+        except (TypeError, ValueError):
+            pass
+    for source in (graph.prefetched_data, getattr(graph, '_me', None)):
+        if source:
+            data['user_id'] = data['user_id'] or \
+                source.get('user_id') or source.get('id')
+            data['name'] = data['name'] or source.get('name')
+    return data
+
+
+def graph_from_session(data):
+    """Rebuilds the graph stored by :py:func:`graph_to_session`, returns
+    ``None`` if the token expired
+    """
+    if isinstance(data, OpenFacebook):
+        ## stored before graphs were stored in their compact version
+        data._me = None
+        return data
+    if not isinstance(data, dict) \
+            or data.get('version') != GRAPH_SESSION_VERSION:
+        return None
+    expires = None
+    if data['expires_at']:
+        expires = data['expires_at'] - int(time.time())
+        if expires <= 0:
+            return None
+    prefetched_data = None
+    if data['user_id']:
+        prefetched_data = dict(user_id=data['user_id'], name=data['name'])
+    return OpenFacebook(data['access_token'], prefetched_data,
+                        expires=expires)
+
+
 def _get_access_token_from_request(request, redirect_uri=None):
     """Do whatever needed to retrieve an access_token from the request.
     :returns: a ``dict`` containing at least the access_token key.
@@ -214,6 +270,18 @@ def _add_current_user_id(graph, user):
             graph.current_user_id = facebook_id
 
 
+def invalidate_profile_cache(sender, profile, facebook_data, **kwargs):
+    """Drops the cached me profile once it is stored in the user's
+    profile, connected to the ``facebook_post_update`` signal
+    """
+    profile_cache = OpenFacebook.profile_cache
+    if profile_cache is not None:
+        profile_cache.invalidate(facebook_id=facebook_data.get('facebook_id'))
+
+signals.facebook_post_update.connect(invalidate_profile_cache,
+                                     dispatch_uid='invalidate_profile_cache')
+
+
 class FacebookUserConverter(object):
     """
     This conversion class helps you to convert Facebook users to Django users
@@ -223,7 +291,21 @@ class FacebookUserConverter(object):
     - extracting and prepopulating full profile data
     - invite flows
     - importing and storing likes
+
+    Only the fields used below are requested from Facebook, extend
+    ``profile_fields`` in a subclass or add to
+    ``FACEBOOK_EXTRA_PROFILE_FIELDS`` if you need more. Set it to ``None``
+    to retrieve the full profile.
     """
+    ## The fields of me read by _convert_facebook_data and _update_user
+    profile_fields = ['id', 'name', 'link', 'email', 'gender', 'birthday',
+                      'website', 'about', 'quotes', 'first_name',
+                      'last_name', 'verified']
+
+    ## The fields stored by _store_likes and _store_friends
+    like_fields = ['id', 'name', 'category', 'created_time']
+    friend_fields = ['uid', 'name', 'sex']
+
     def __init__(self, open_facebook):
         
         self.open_facebook = open_facebook
@@ -231,7 +313,14 @@ class FacebookUserConverter(object):
         self._profile = None
 
     def is_authenticated(self):
-        return self.open_facebook.is_authenticated()
+        """Like ``OpenFacebook.is_authenticated``, but requests only the
+        profile fields, so ``facebook_profile_data`` can reuse the result
+        """
+        try:
+            me = self.open_facebook.me(fields=self.get_profile_fields())
+        except OpenFacebookException:
+            me = None
+        return bool(me)
 
     def facebook_registration_data(self, username=True):
         """Gets all registration data and ensures its correct
@@ -253,12 +342,23 @@ class FacebookUserConverter(object):
         """Returns the facebook profile data, together with the image locations
         """
         if self._profile is None:
-            profile = self.open_facebook.me()
+            profile = self.open_facebook.me(fields=self.get_profile_fields())
             profile['image'] = self.open_facebook.my_image_url('large')
             profile['image_thumb'] = self.open_facebook.my_image_url()
             self._profile = profile
         return self._profile
 
+    @classmethod
+    def get_profile_fields(cls):
+        """Returns the profile fields to request, or ``None`` for all"""
+        if cls.profile_fields is None:
+            return None
+        fields = list(cls.profile_fields)
+        for field in facebook_settings.FACEBOOK_EXTRA_PROFILE_FIELDS:
+            if field not in fields:
+                fields.append(field)
+        return fields
+
     @classmethod
     def _convert_facebook_data(cls, facebook_profile_data, username=True):
         """Takes facebook user data and converts it to a format for
@@ -453,10 +553,13 @@ class FacebookUserConverter(object):
         stored_likes = self._store_likes(user, likes)
         return stored_likes
 
-    def get_likes(self, limit=5000):
-        """Parses the Facebook response and returns the likes"""
-        likes_response = self.open_facebook.get('me/likes', limit=limit)
-        likes = likes_response and likes_response.get('data')
+    def get_likes(self, limit=5000, page_size=500):
+        """Parses the Facebook response and returns the likes, following
+        the pagination up to ``limit`` likes
+        """
+        likes = list(self.open_facebook.iterate(
+            'me/likes', page_size=page_size, max_items=limit,
+            prefetch=True, fields=','.join(self.like_fields)))
         logger.info('found %s likes', len(likes))
         return likes
 
@@ -530,8 +633,9 @@ class FacebookUserConverter(object):
         friends = getattr(self, '_friends', None)
         if friends is None:
             friends_response = self.open_facebook.fql(
-                "SELECT uid, name, sex FROM user WHERE uid IN (SELECT uid2 " \
-                "FROM friend WHERE uid1 = me()) LIMIT %s" % limit)
+                "SELECT %s FROM user WHERE uid IN (SELECT uid2 " \
+                "FROM friend WHERE uid1 = me()) LIMIT %s" % (
+                    ', '.join(self.friend_fields), limit))
             # friends_response = self.open_facebook.get('me/friends',
             #                                           limit=limit)
             # friends = friends_response and friends_response.get('data')
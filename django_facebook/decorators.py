@@ -11,6 +11,7 @@ from django.utils.functional import wraps
 
 from django_facebook import settings as fb_settings
 from django_facebook.api import get_persistent_graph
+from django_facebook.permissions import invalidate_permissions
 from django_facebook.utils import get_oauth_url, parse_scope, response_redirect
 
 logger = logging.getLogger(__name__)
@@ -24,12 +25,13 @@ def facebook_required(view_func=None,
     permissions, redirecting to the authorization page if necessary.
 
     .. NOTE::
-       This implementation sends a request to check that the user
-       has the required permissions before executing the view.
+       This implementation checks that the user has the required
+       permissions before executing the view.
        
-       This should be able to prevent most failures, but it will slow
-       down things as an additional HTTP request will be performed
-       on each request..
+       The permissions are looked up in a snapshot, only when it is
+       missing or lacks one of them an additional HTTP request is sent,
+       see :mod:`django_facebook.permissions`. The snapshot is dropped
+       when the view raises an ``OAuthException``.
 
     :param view_func: The view function that will be decorated
     :param scope: List of names of permissions that will be required
@@ -42,6 +44,7 @@ def facebook_required(view_func=None,
         from ``request.fb_info['is_canvas']``.
     """
     from django_facebook.utils import test_permissions
+    from open_facebook import exceptions as open_facebook_exceptions
     scope_list = parse_scope(scope)
     
     def actual_decorator(view_func):
@@ -49,7 +52,12 @@ def facebook_required(view_func=None,
         def _wrapped_view(request, *args, **kwargs):
             oauth_url, redirect_uri = get_oauth_url(request, scope_list)
             if test_permissions(request, scope_list, redirect_uri):
-                return view_func(request, *args, **kwargs)
+                try:
+                    return view_func(request, *args, **kwargs)
+                except open_facebook_exceptions.OAuthException:
+                    ## The permissions were revoked since the snapshot
+                    invalidate_permissions(request)
+                    raise
             else:
                 logger.info('requesting access with redirect uri: %s', redirect_uri)
                 _canvas = canvas # Bring into local scope
@@ -98,6 +106,8 @@ def facebook_required_lazy(view_func=None,
                 get_persistent_graph(request, redirect_uri=redirect_uri)
                 return view_func(request, *args, **kwargs)
             except open_facebook_exceptions.OpenFacebookException, e:
+                if isinstance(e, open_facebook_exceptions.OAuthException):
+                    invalidate_permissions(request)
                 if test_permissions(request, scope_list, redirect_uri):
                     ## An error if we already have permissions
                     ## shouldn't have been caught
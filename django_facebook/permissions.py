@@ -0,0 +1,115 @@
+"""Snapshots of the permissions users granted us.
+
+``facebook_required`` used to call ``me/permissions`` on every request.
+The permissions are now kept per access token, in the session and, when
+``FACEBOOK_PERMISSIONS_CACHE_BACKEND`` is set, in that Django cache, for
+``FACEBOOK_PERMISSIONS_TIMEOUT`` seconds.
+
+A snapshot is only trusted to say a permission was granted: when it
+lacks one of the required permissions Facebook is asked again. It is
+refreshed once after the OAuth dialog, as users can decline extended
+permissions, and dropped when a view fails with an ``OAuthException``.
+"""
+
+import logging
+import time
+
+from django_facebook import settings as facebook_settings
+from open_facebook import exceptions as facebook_exceptions
+from open_facebook.cache import hash_token
+from open_facebook.utils import get_django_cache
+
+logger = logging.getLogger(__name__)
+
+SESSION_KEY = 'facebook_permissions'
+
+
+def get_cache():
+    backend = facebook_settings.FACEBOOK_PERMISSIONS_CACHE_BACKEND
+    if backend:
+        return get_django_cache(backend)
+
+
+def get_cache_key(access_token):
+    return 'django_facebook:permissions:%s' % hash_token(access_token)
+
+
+def get_permissions(request, graph, required=()):
+    """Returns the set of permissions granted to ``graph.access_token``.
+    Uses the snapshot, unless it is missing, expired or lacks one of the
+    ``required`` permissions.
+    """
+    permissions = get_snapshot(request, graph.access_token)
+    if permissions is None or not set(required) <= permissions:
+        permissions = refresh_permissions(request, graph)
+    return permissions
+
+
+def refresh_permissions(request, graph):
+    """Fetches and stores the permissions of ``graph.access_token``"""
+    permissions = fetch_permissions(graph)
+    store_permissions(request, graph.access_token, permissions)
+    return permissions
+
+
+def fetch_permissions(graph):
+    """Asks Facebook for the permissions of ``graph.access_token``"""
+    try:
+        permissions_response = graph.get('me/permissions')
+        permissions = permissions_response['data'][0]
+    except facebook_exceptions.OAuthException:
+        ## This happens when someone revokes their permissions
+        ## while the session is still stored
+        permissions = {}
+    return set([k for k, v in permissions.items() if v == '1' or v == 1])
+
+
+def get_snapshot(request, access_token):
+    """Returns the stored set of permissions, or ``None``"""
+    token_hash = hash_token(access_token)
+    now = time.time()
+    session = getattr(request, 'session', None)
+    snapshot = session.get(SESSION_KEY) if session is not None else None
+    if not snapshot or snapshot['token'] != token_hash \
+            or snapshot['expires'] < now:
+        snapshot = None
+        cache = get_cache()
+        if cache is not None:
+            snapshot = cache.get(get_cache_key(access_token))
+            if snapshot and session is not None:
+                session[SESSION_KEY] = snapshot
+    if snapshot and snapshot['expires'] >= now:
+        return set(snapshot['permissions'])
+
+
+def store_permissions(request, access_token, permissions):
+    timeout = facebook_settings.FACEBOOK_PERMISSIONS_TIMEOUT
+    snapshot = dict(token=hash_token(access_token),
+                    permissions=sorted(permissions),
+                    expires=time.time() + timeout)
+    session = getattr(request, 'session', None)
+    if session is not None:
+        session[SESSION_KEY] = snapshot
+    cache = get_cache()
+    if cache is not None:
+        cache.set(get_cache_key(access_token), snapshot, timeout)
+
+
+def invalidate_permissions(request, access_token=None):
+    """Drops the snapshot of ``access_token``, by default the one of the
+    current request's graph
+    """
+    if access_token is None:
+        graph = getattr(request, 'facebook', None)
+        access_token = getattr(graph, 'access_token', None)
+    if not access_token:
+        return
+    logger.info('dropping the permission snapshot')
+    session = getattr(request, 'session', None)
+    if session is not None:
+        snapshot = session.get(SESSION_KEY)
+        if snapshot and snapshot['token'] == hash_token(access_token):
+            del session[SESSION_KEY]
+    cache = get_cache()
+    if cache is not None:
+        cache.delete(get_cache_key(access_token))
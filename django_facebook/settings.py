@@ -28,6 +28,10 @@ FACEBOOK_HIDE_CONNECT_TEST = getattr(settings, 'FACEBOOK_HIDE_CONNECT_TEST', Tru
 ## Track all raw data coming in from FB
 FACEBOOK_TRACK_RAW_DATA = getattr(settings, 'FACEBOOK_TRACK_RAW_DATA', False)
 
+## Extra profile fields to request on top of
+## FacebookUserConverter.profile_fields, for example ['locale', 'timezone']
+FACEBOOK_EXTRA_PROFILE_FIELDS = getattr(settings, 'FACEBOOK_EXTRA_PROFILE_FIELDS', [])
+
 ## Whether to store all the user likes|friends
 FACEBOOK_STORE_LIKES = getattr(settings, 'FACEBOOK_STORE_LIKES', False)
 FACEBOOK_STORE_FRIENDS = getattr(settings, 'FACEBOOK_STORE_FRIENDS', False)
@@ -46,6 +50,91 @@ FACEBOOK_REGISTRATION_FORM = getattr(settings, 'FACEBOOK_REGISTRATION_FORM', Non
 ## Debugging
 FACEBOOK_DEBUG_REDIRECTS = getattr(settings, 'FACEBOOK_DEBUG_REDIRECTS', False)
 
+## Keep-alive connections to the Graph API.
+## The number of idle connections kept per host and the number of seconds
+## after which an idle connection is closed instead of reused.
+FACEBOOK_CONNECTION_POOL_SIZE = getattr(settings, 'FACEBOOK_CONNECTION_POOL_SIZE', 10)
+FACEBOOK_CONNECTION_POOL_IDLE_TIMEOUT = getattr(settings, 'FACEBOOK_CONNECTION_POOL_IDLE_TIMEOUT', 60)
+
+## Parallel Graph calls (OpenFacebook.map).
+## The default number of threads per call to map and the maximum number of
+## calls running at the same time in this process.
+FACEBOOK_MAP_MAX_WORKERS = getattr(settings, 'FACEBOOK_MAP_MAX_WORKERS', 5)
+FACEBOOK_MAX_PARALLEL_REQUESTS = getattr(settings, 'FACEBOOK_MAX_PARALLEL_REQUESTS', 20)
+
+## Caching of Graph API GET responses (off by default).
+## FACEBOOK_CACHE_BACKEND is the name of a Django cache used as second tier,
+## next to an in-process LRU of FACEBOOK_CACHE_SIZE entries.
+## FACEBOOK_CACHE_TIMEOUTS is a list of (path regex, seconds) rules, the
+## first match wins and a timeout of 0 disables caching for that path.
+FACEBOOK_CACHE_ENABLED = getattr(settings, 'FACEBOOK_CACHE_ENABLED', False)
+FACEBOOK_CACHE_BACKEND = getattr(settings, 'FACEBOOK_CACHE_BACKEND', None)
+FACEBOOK_CACHE_SIZE = getattr(settings, 'FACEBOOK_CACHE_SIZE', 1000)
+FACEBOOK_CACHE_TIMEOUT = getattr(settings, 'FACEBOOK_CACHE_TIMEOUT', 60)
+FACEBOOK_CACHE_TIMEOUTS = getattr(settings, 'FACEBOOK_CACHE_TIMEOUTS', [])
+## Expired responses with an ETag are kept this many seconds longer and
+## revalidated with If-None-Match, a 304 makes them fresh again.
+FACEBOOK_CACHE_REVALIDATE_TIMEOUT = getattr(settings, 'FACEBOOK_CACHE_REVALIDATE_TIMEOUT', 3600)
+
+## Let threads requesting the same Graph GET at the same time share one
+## HTTP call (off by default). Requests are only shared between callers
+## using the same access token, or no token at all.
+FACEBOOK_COALESCE_REQUESTS = getattr(settings, 'FACEBOOK_COALESCE_REQUESTS', False)
+
+## Fail fast when Facebook is having issues.
+## Requests to a part of the Graph API fail immediately for
+## FACEBOOK_CIRCUIT_BREAKER_RECOVERY seconds once more than this fraction of
+## at least FACEBOOK_CIRCUIT_BREAKER_MIN_REQUESTS requests failed within a
+## minute. Set the threshold to None to disable the circuit breaker.
+FACEBOOK_CIRCUIT_BREAKER_THRESHOLD = getattr(settings, 'FACEBOOK_CIRCUIT_BREAKER_THRESHOLD', 0.5)
+FACEBOOK_CIRCUIT_BREAKER_MIN_REQUESTS = getattr(settings, 'FACEBOOK_CIRCUIT_BREAKER_MIN_REQUESTS', 20)
+FACEBOOK_CIRCUIT_BREAKER_RECOVERY = getattr(settings, 'FACEBOOK_CIRCUIT_BREAKER_RECOVERY', 30)
+
+## Client side rate limiting (off by default).
+## A dict of (number of requests, seconds) budgets for the 'token', 'app'
+## and 'write' buckets, for example dict(token=(600, 600), write=(25, 3600)).
+## FACEBOOK_RATE_LIMIT_BACKEND is the name of a Django cache to share the
+## buckets between processes. When a budget runs out requests wait up to
+## FACEBOOK_RATE_LIMIT_MAX_WAIT seconds, or raise immediately when
+## FACEBOOK_RATE_LIMIT_BLOCK is False.
+FACEBOOK_RATE_LIMITS = getattr(settings, 'FACEBOOK_RATE_LIMITS', None)
+FACEBOOK_RATE_LIMIT_BACKEND = getattr(settings, 'FACEBOOK_RATE_LIMIT_BACKEND', None)
+FACEBOOK_RATE_LIMIT_BLOCK = getattr(settings, 'FACEBOOK_RATE_LIMIT_BLOCK', True)
+FACEBOOK_RATE_LIMIT_MAX_WAIT = getattr(settings, 'FACEBOOK_RATE_LIMIT_MAX_WAIT', 10)
+
+## Where to report request metrics: None, 'memory', 'prometheus', 'statsd'
+## or the dotted path to a class, see open_facebook.metrics
+FACEBOOK_METRICS_BACKEND = getattr(settings, 'FACEBOOK_METRICS_BACKEND', None)
+
+## Log a sample of the Graph API requests and responses at INFO, with
+## tokens redacted and payloads capped at FACEBOOK_TRACE_MAX_LENGTH
+## characters. Set the rate to 1 to log every request, 0 to log none.
+FACEBOOK_TRACE_SAMPLE_RATE = getattr(settings, 'FACEBOOK_TRACE_SAMPLE_RATE', 0.01)
+FACEBOOK_TRACE_MAX_LENGTH = getattr(settings, 'FACEBOOK_TRACE_MAX_LENGTH', 1000)
+
+## App access tokens are cached in process, and in the Django cache named
+## FACEBOOK_APP_TOKEN_CACHE_BACKEND to share them between processes.
+## They are used for FACEBOOK_APP_TOKEN_TIMEOUT seconds and refreshed
+## FACEBOOK_APP_TOKEN_REFRESH seconds before that.
+FACEBOOK_APP_TOKEN_CACHE_BACKEND = getattr(settings, 'FACEBOOK_APP_TOKEN_CACHE_BACKEND', None)
+FACEBOOK_APP_TOKEN_TIMEOUT = getattr(settings, 'FACEBOOK_APP_TOKEN_TIMEOUT', 86400)
+FACEBOOK_APP_TOKEN_REFRESH = getattr(settings, 'FACEBOOK_APP_TOKEN_REFRESH', 300)
+
+## The permissions checked by facebook_required are stored in the session
+## for FACEBOOK_PERMISSIONS_TIMEOUT seconds, and in the Django cache named
+## FACEBOOK_PERMISSIONS_CACHE_BACKEND if set, see django_facebook.permissions
+FACEBOOK_PERMISSIONS_TIMEOUT = getattr(settings, 'FACEBOOK_PERMISSIONS_TIMEOUT', 600)
+FACEBOOK_PERMISSIONS_CACHE_BACKEND = getattr(settings, 'FACEBOOK_PERMISSIONS_CACHE_BACKEND', None)
+
+## Caches the me profiles between requests for FACEBOOK_PROFILE_CACHE_TIMEOUT
+## seconds, in an in-process LRU of FACEBOOK_PROFILE_CACHE_SIZE entries and
+## in the Django cache named FACEBOOK_PROFILE_CACHE_BACKEND if set.
+## Profiles are dropped when they are stored in the users' profiles.
+FACEBOOK_PROFILE_CACHE_ENABLED = getattr(settings, 'FACEBOOK_PROFILE_CACHE_ENABLED', False)
+FACEBOOK_PROFILE_CACHE_BACKEND = getattr(settings, 'FACEBOOK_PROFILE_CACHE_BACKEND', None)
+FACEBOOK_PROFILE_CACHE_SIZE = getattr(settings, 'FACEBOOK_PROFILE_CACHE_SIZE', 1000)
+FACEBOOK_PROFILE_CACHE_TIMEOUT = getattr(settings, 'FACEBOOK_PROFILE_CACHE_TIMEOUT', 300)
+
 ## Check for required settings -------------------------------------------------
 required_settings = ['FACEBOOK_APP_ID', 'FACEBOOK_APP_SECRET']
 locals_dict = locals()
@@ -42,6 +42,24 @@ class UserConnectTest(FacebookTest):
         request.user = AnonymousUser()
         get_persistent_graph(request, access_token='short_username')
 
+    def test_graph_session(self):
+        from django_facebook.api import graph_from_session, graph_to_session
+        request = self.request
+        request.user = AnonymousUser()
+        graph = get_persistent_graph(request, access_token='short_username')
+        self.assertEqual(request.session['graph']['access_token'],
+                         'short_username')
+
+        ## the next request rebuilds the graph without writing the session
+        del request.facebook
+        request.session.modified = False
+        graph = get_persistent_graph(request)
+        self.assertEqual(graph.access_token, 'short_username')
+        self.assertFalse(request.session.modified)
+
+        graph.expires = -1
+        self.assertEqual(graph_from_session(graph_to_session(graph)), None)
+
     def test_full_connect(self):
         #going for a register, connect and login
         graph = get_facebook_graph(access_token='short_username')
@@ -60,6 +78,33 @@ class UserConnectTest(FacebookTest):
         facebook.facebook_profile_data()
         action, user = connect_user(self.request, facebook_graph=graph)
 
+    def test_profile_fields(self):
+        fields = FacebookUserConverter.get_profile_fields()
+        self.assertTrue('email' in fields and 'birthday' in fields)
+        extra = facebook_settings.FACEBOOK_EXTRA_PROFILE_FIELDS
+        facebook_settings.FACEBOOK_EXTRA_PROFILE_FIELDS = ['locale', 'email']
+        try:
+            fields = FacebookUserConverter.get_profile_fields()
+        finally:
+            facebook_settings.FACEBOOK_EXTRA_PROFILE_FIELDS = extra
+        self.assertEqual(fields.count('email'), 1)
+        self.assertEqual(fields[-1], 'locale')
+
+        ## is_authenticated already requests only these fields
+        from django_facebook.api import OpenFacebook
+        requests = []
+
+        class LocalOpenFacebook(OpenFacebook):
+            def _request(self, url, post_data=None):
+                requests.append(url)
+                return dict(id='1', name='Thierry')
+
+        facebook = FacebookUserConverter(LocalOpenFacebook('token'))
+        self.assertTrue(facebook.is_authenticated())
+        facebook.facebook_profile_data()
+        self.assertEqual(len(requests), 1)
+        self.assertTrue('fields=id%2Cname' in requests[0])
+
     def test_invalid_token(self):
         self.assertRaises(AssertionError,
                           connect_user, self.request, access_token='invalid')
@@ -145,6 +190,77 @@ class ErrorMappingTest(FacebookTest):
         self.assertRaises(facebook_exceptions.PermissionException,
                           raise_something)
 
+    def test_index(self):
+        from open_facebook import exceptions as facebook_exceptions
+
+        class SessionExpired(facebook_exceptions.OAuthException):
+            codes = ['session has expired', (250, 260)]
+
+        index = facebook_exceptions.ErrorCodeIndex(
+            facebook_exceptions.get_exception_classes())
+        self.assertEqual(index.match('(#255) nope', 255),
+                         facebook_exceptions.PermissionException)
+        index.register(SessionExpired)
+        self.assertEqual(index.match('(#255) nope', 255), SessionExpired)
+        self.assertEqual(index.match('(#341) the session has expired', 341),
+                         facebook_exceptions.FeedActionLimit)
+        self.assertEqual(index.match('(#200) the session has expired', 200),
+                         SessionExpired)
+        self.assertEqual(index.match('unknown', None), None)
+
+
+class PermissionsTest(FacebookTest):
+    class Graph(object):
+        access_token = 'permissions_token'
+
+        def __init__(self, permissions):
+            self.permissions = permissions
+            self.calls = 0
+
+        def get(self, path):
+            self.calls += 1
+            return dict(data=[dict([(p, 1) for p in self.permissions])])
+
+    def test_snapshot(self):
+        from django_facebook import permissions
+        graph = self.Graph(['email', 'publish_stream'])
+        self.assertEqual(permissions.get_permissions(
+            self.request, graph, ['email']),
+            set(['email', 'publish_stream']))
+        permissions.get_permissions(self.request, graph, ['publish_stream'])
+        self.assertEqual(graph.calls, 1)
+
+        ## lacking a permission makes us ask Facebook again
+        permissions.get_permissions(self.request, graph, ['user_photos'])
+        self.assertEqual(graph.calls, 2)
+
+        ## granted by the OAuth dialog
+        graph.permissions.append('user_photos')
+        permissions.refresh_permissions(self.request, graph)
+        permissions.get_permissions(self.request, graph, ['user_photos'])
+        self.assertEqual(graph.calls, 3)
+
+        ## another token doesn't use the snapshot
+        other = self.Graph(['email'])
+        other.access_token = 'other_token'
+        permissions.get_permissions(self.request, other, ['email'])
+        self.assertEqual(other.calls, 1)
+
+        permissions.invalidate_permissions(self.request, 'other_token')
+        permissions.get_permissions(self.request, other, ['email'])
+        self.assertEqual(other.calls, 2)
+
+    def test_declined_after_oauth(self):
+        from django_facebook.tests_utils.base import RequestMock
+        from django_facebook.utils import test_permissions
+        request = RequestMock().get('/?attempt=1&code=abc')
+        request.user = AnonymousUser()
+        request.facebook = self.Graph(['email'])
+        ## publish_stream was asked for, but declined
+        self.assertRaises(ValueError, test_permissions, request,
+                          ['email', 'publish_stream'])
+        self.assertEqual(request.facebook.calls, 1)
+
 
 class OAuthUrlTest(FacebookTest):
     def _test_equal(self, url, output):
@@ -195,3 +311,16 @@ class SignalTest(FacebookTest):
                                  'pre_update_signal'), True)
         self.assertEqual(hasattr(user.get_profile(),
                                  'post_update_signal'), True)
+
+    def test_profile_cache_invalidation(self):
+        ## FacebookTest replaced open_facebook.api.OpenFacebook with a mock
+        from django_facebook.api import OpenFacebook
+        from open_facebook.cache import ProfileCache
+        OpenFacebook.profile_cache = cache = ProfileCache()
+        try:
+            cache.set('token', dict(id='123', name='Thierry'))
+            signals.facebook_post_update.send(sender=get_profile_class(),
+                profile=None, facebook_data=dict(facebook_id=123))
+            self.assertEqual(cache.get('token'), None)
+        finally:
+            OpenFacebook.profile_cache = None
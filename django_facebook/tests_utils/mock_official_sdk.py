@@ -4,7 +4,7 @@ from open_facebook.api import OpenFacebook
 class MockFacebookAPI(OpenFacebook):
     mock = True
 
-    def me(self):
+    def me(self, fields=None):
         from django_facebook.tests_utils.sample_data.user_data import user_data
         data = user_data[self.access_token]
         return data
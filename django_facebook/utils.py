@@ -11,8 +11,10 @@ logger = logging.getLogger(__name__)
 
 
 def test_permissions(request, scope_list, redirect_uri=None):
-    """Calls Facebook ``me/permissions`` to see if the user granted us
-    some specified permissions or not.
+    """Checks if the user granted us some specified permissions or not.
+    Uses the snapshot of the permissions if it has all of them, and
+    calls Facebook ``me/permissions`` otherwise, see
+    :mod:`django_facebook.permissions`.
     
     :param request: The current request
     :param scope_list: List of permissions that will be checked
@@ -20,25 +22,22 @@ def test_permissions(request, scope_list, redirect_uri=None):
         after authentication.
     """
     from django_facebook.api import get_persistent_graph
-    from open_facebook import exceptions as facebook_exceptions
+    from django_facebook.permissions import (get_permissions,
+                                             refresh_permissions)
     fb = get_persistent_graph(request, redirect_uri=redirect_uri)
-    permissions_dict = {}
+    permissions = set()
     if fb:
-        try:
-            permissions_response = fb.get('me/permissions')
-            permissions = permissions_response['data'][0]
-        except facebook_exceptions.OAuthException:
-            ## This happens when someone revokes their permissions
-            ## while the session is still stored
-            permissions = {}
-        permissions_dict = dict([(k, bool(int(v)))
-                                 for k, v in permissions.items()
-                                 if v == '1' or v == 1])
+        if request.GET.get('attempt') and request.GET.get('code'):
+            ## Back from the OAuth dialog, where some of scope_list
+            ## might have been declined
+            permissions = refresh_permissions(request, fb)
+        else:
+            permissions = get_permissions(request, fb, required=scope_list)
 
     ## See if we have all permissions
     scope_allowed = True
     for permission in scope_list:
-        if permission not in permissions_dict:
+        if permission not in permissions:
             scope_allowed = False
 
     ## Raise if this happens after a redirect though
@@ -46,7 +45,7 @@ def test_permissions(request, scope_list, redirect_uri=None):
         raise ValueError(
               'Somehow Facebook is not giving us the permissions needed, ' \
               'lets break instead of endless redirects. FB was %r and ' \
-              'permissions %r' % (fb, permissions_dict))
+              'permissions %r' % (fb, permissions))
 
     return scope_allowed
 
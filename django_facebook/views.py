@@ -135,9 +135,16 @@ def image_upload(request):
     fb = get_persistent_graph(request)
     pictures = request.REQUEST.getlist('pictures')
 
-    for picture in pictures:
-        fb.set('me/photos', url=picture, message='the writing is one The '
-            'wall image %s' % picture)
+    uploads = [('set', 'me/photos', dict(url=picture, message='the writing '
+                'is one The wall image %s' % picture))
+               for picture in pictures]
+    ## uploaded files are streamed to Facebook instead of being refetched
+    uploads += [('set', 'me/photos', dict(source=picture, message='the '
+                 'writing is one The wall image %s' % picture.name))
+                for picture in request.FILES.getlist('pictures')]
+    for result in fb.map(uploads):
+        if isinstance(result, Exception):
+            raise result
 
     messages.info(request, 'The images have been added to your profile!')
 
@@ -35,9 +35,14 @@ which validates input::
 Currently that would be a bad idea though because of maintenance.
 """
 
+import hashlib
+import hmac
 import logging
+import re
+import time
 import urllib
 import urllib2
+import urlparse
 
 from django.http import QueryDict
 
@@ -45,7 +50,21 @@ from django_facebook import settings as facebook_settings
 from django_facebook.utils import to_int
 
 from open_facebook import exceptions as facebook_exceptions
-from open_facebook.utils import json, encode_params, send_warning
+from open_facebook.batch import GraphBatch
+from open_facebook.cache import ProfileCache, ResponseCache
+from open_facebook.fanout import BackgroundCall, fan_out
+from open_facebook.metrics import get_metrics
+from open_facebook.multipart import MultipartBody, has_files
+from open_facebook.pool import ConnectionPool
+from open_facebook.ratelimit import RateLimiter
+from open_facebook.retry import CircuitBreaker, RetryPolicy
+from open_facebook.singleflight import SingleFlight
+from open_facebook.streaming import JSONItemStream
+from open_facebook.tokens import AppTokenCache
+from open_facebook.tracing import Tracer
+from open_facebook.utils import (json, base64_url_decode_php_style,
+                                 constant_time_compare, encode_params,
+                                 get_endpoint, is_write_request, send_warning)
 
 
 logger = logging.getLogger(__name__)
@@ -53,11 +72,17 @@ logger = logging.getLogger(__name__)
 REQUEST_TIMEOUT = 8
 REQUEST_ATTEMPTS = 2
 
+ERROR_CODE_RE = re.compile('\(#(\d+)\)')
 
-try:
-    import django_statsd
-except ImportError:
-    django_statsd = None
+## signature algorithms supported by FacebookAuthorization
+SIGNATURE_ALGORITHMS = {
+    'HMAC-SHA256': hashlib.sha256,
+    'HMAC-MD5': hashlib.md5,
+    'HMAC-SHA1': hashlib.sha1,
+    'HMAC-SHA224': hashlib.sha224,
+    'HMAC-SHA384': hashlib.sha384,
+    'HMAC-SHA512': hashlib.sha512,
+}
 
 
 class FacebookConnection(object):
@@ -71,6 +96,52 @@ class FacebookConnection(object):
     ## this older URL is still used for FQL requests
     old_api_url = 'https://api.facebook.com/method/'
 
+    ## Sent with every request, responses are compressed when possible
+    request_headers = {
+        'User-agent': 'Open Facebook Python',
+        'Accept-Encoding': 'gzip, deflate',
+    }
+
+    ## Keep-alive connections, shared by every request in this process
+    connection_pool = ConnectionPool(
+        maxsize=facebook_settings.FACEBOOK_CONNECTION_POOL_SIZE,
+        idle_timeout=facebook_settings.FACEBOOK_CONNECTION_POOL_IDLE_TIMEOUT)
+
+    ## When and how often failed requests are retried
+    retry_policy = RetryPolicy(max_attempts=REQUEST_ATTEMPTS)
+
+    ## Fails fast when a part of the Graph API keeps failing
+    circuit_breaker = None
+    if facebook_settings.FACEBOOK_CIRCUIT_BREAKER_THRESHOLD:
+        circuit_breaker = CircuitBreaker(
+            failure_threshold=facebook_settings.FACEBOOK_CIRCUIT_BREAKER_THRESHOLD,
+            min_requests=facebook_settings.FACEBOOK_CIRCUIT_BREAKER_MIN_REQUESTS,
+            recovery_timeout=facebook_settings.FACEBOOK_CIRCUIT_BREAKER_RECOVERY)
+
+    ## Logs a sample of the requests and responses, see open_facebook.tracing
+    tracer = Tracer(
+        sample_rate=facebook_settings.FACEBOOK_TRACE_SAMPLE_RATE,
+        max_length=facebook_settings.FACEBOOK_TRACE_MAX_LENGTH,
+        logger=logger)
+
+    ## Where request metrics are reported, see open_facebook.metrics
+    metrics = get_metrics()
+
+    ## Optional coalescing of identical GET requests in flight
+    single_flight = None
+    if facebook_settings.FACEBOOK_COALESCE_REQUESTS:
+        single_flight = SingleFlight()
+
+    ## Optional read-through cache for GET requests
+    response_cache = None
+    if facebook_settings.FACEBOOK_CACHE_ENABLED:
+        response_cache = ResponseCache(
+            max_entries=facebook_settings.FACEBOOK_CACHE_SIZE,
+            backend=facebook_settings.FACEBOOK_CACHE_BACKEND,
+            timeout=facebook_settings.FACEBOOK_CACHE_TIMEOUT,
+            timeouts=facebook_settings.FACEBOOK_CACHE_TIMEOUTS,
+            revalidate_timeout=facebook_settings.FACEBOOK_CACHE_REVALIDATE_TIMEOUT)
+
     @classmethod
     def request(cls, path='', post_data=None, old_api=False, **params):
         """Main function for sending the request to Facebook"""
@@ -83,63 +154,266 @@ class FacebookConnection(object):
 
     @classmethod
     def _request(cls, url, post_data=None, timeout=REQUEST_TIMEOUT,
-                 attempts=REQUEST_ATTEMPTS):
+                 attempts=None):
         """Perform a HTTP request to the given URL and parse it as JSON.
         
-        ``urllib2`` raises errors on different status codes so we
-        use a ``try .. except`` clause here.
+        The request is sent over a keep-alive connection from
+        ``connection_pool``, which doesn't raise on error status codes,
+        Facebook puts the interesting bits in the body anyway. Compressed
+        responses are decoded by the pool, which also counts the bytes
+        transferred, see ``ConnectionPool.get_last_transfer``.
+
+        Failures are retried according to ``retry_policy``, by default
+        at most ``REQUEST_ATTEMPTS`` times and never for writes. The
+        ``circuit_breaker`` makes requests fail fast while Facebook is
+        having trouble.
+
+        GET requests are served from ``response_cache`` if it is enabled,
+        expired responses with an ETag are revalidated using
+        ``If-None-Match``, writes invalidate the cached reads of their
+        path. Identical GET
+        requests running at the same time share a single HTTP call when
+        ``single_flight`` is enabled.
+
+        A sample of the requests and their responses is logged by
+        ``tracer``, with access tokens redacted.
         """
-        logger.info('requesting url %s with post data %s', url, post_data)
-        opener = urllib2.build_opener()
-        opener.addheaders = [('User-agent', 'Open Facebook Python')]
-        # give it a few shots, connection is buggy at times
+        trace = cls.tracer.start(url, post_data)
+        is_write = is_write_request(url, post_data)
+        response = etag = None
+        from_cache = False
+        cache = cls.response_cache
+        if cache is not None:
+            cached_request = cache.parse(url)
+            if not is_write:
+                cached = cache.lookup(cached_request)
+                if cached is not None:
+                    response, etag, from_cache = cached
+                if cls.metrics.enabled:
+                    cls.metrics.increment(
+                        'cache.hits' if from_cache else 'cache.misses',
+                        endpoint=get_endpoint(url))
+
+        if not from_cache:
+            flight = cls.single_flight
+            if flight is not None and not is_write:
+                status, body, response_etag = flight.do(
+                    flight.get_key(url, etag), cls._fetch, url,
+                    timeout=timeout, attempts=attempts, etag=etag)
+            else:
+                status, body, response_etag = cls._fetch(
+                    url, post_data, timeout, attempts, is_write, etag=etag)
+            if cache is not None and is_write:
+                cache.invalidate(cached_request)
+            if status == 304 and response is not None:
+                ## still valid, keep using the cached body
+                cache.revalidated(cached_request, response, etag)
+                if cls.metrics.enabled:
+                    cls.metrics.increment('cache.revalidations',
+                                          endpoint=get_endpoint(url))
+                from_cache = True
+            else:
+                response, etag = body, response_etag
+
+        if trace is not None:
+            trace.response(response)
+        parsed_response = cls._parse_response(response)
+        if cache is not None and not is_write and not from_cache:
+            ## errors raised above, so only valid responses get here
+            cache.set(cached_request, response, etag)
+        return parsed_response
 
-        encoded_params = encode_params(post_data) if post_data else None
-        post_string = (urllib.urlencode(encoded_params) if post_data else None)
+    @classmethod
+    def _fetch(cls, url, post_data=None, timeout=REQUEST_TIMEOUT,
+               attempts=None, is_write=False, etag=None):
+        """Sends the request, retrying it if needed
 
-        if django_statsd:
-            _statsd_path = url.split('?', 1)[0].rsplit('/', 1)[-1].replace('.', '_')
-            _statsd_id = "facebook.%s" % _statsd_path
-        
-        while attempts:
+        :param etag: sent as ``If-None-Match`` to revalidate a cached
+            response
+        :returns: a ``(status, body, etag)`` tuple with the decoded body
+        """
+        headers = dict(cls.request_headers)
+        if etag:
+            headers['If-None-Match'] = etag
+        # give it a few shots, connection is buggy at times
+        policy = cls.retry_policy
+        if attempts is None:
+            attempts = policy.max_attempts
+        breaker = cls.circuit_breaker
+        if breaker is not None:
+            family = breaker.get_family(url)
+
+        post_body = cls._encode_body(post_data, headers)
+
+        metrics = cls.metrics
+        if metrics.enabled:
+            endpoint = get_endpoint(url)
+
+        attempt = 0
+        while True:
+            attempt += 1
+            if breaker is not None:
+                breaker.before_request(family)
             response_file = None
+            retry = False
+            if metrics.enabled:
+                metrics.increment('request.attempts', endpoint=endpoint)
+                if post_body:
+                    metrics.increment('request.bytes_sent',
+                                      len(post_body), endpoint=endpoint)
+                start = time.time()
+            if attempt > 1 and hasattr(post_body, 'seek'):
+                post_body.seek(0)
             try:
-                if django_statsd:
-                    django_statsd.start(_statsd_id)
-                try:
-                    ## For older Python versions you could leave out
-                    ## the timeout
-                    #response_file = opener.open(url, post_string)
-                    response_file = opener.open(url, post_string, timeout=timeout)
-                except (urllib2.HTTPError,), e:
-                    ## Catch the silly status code errors
-                    if 'http error' in str(e).lower():
-                        response_file = e
-                    else:
-                        raise
+                response_file = cls.connection_pool.urlopen(
+                    url, post_body, headers=headers, timeout=timeout)
                 response = response_file.read().decode('utf8')
-                break
             except (urllib2.HTTPError, urllib2.URLError), e:
                 logger.warn('Facebook Graph API request: error or timeout: %s', unicode(e))
-                attempts -= 1
-                if attempts <= 0:
+                if metrics.enabled:
+                    metrics.increment('errors',
+                                      exception=e.__class__.__name__)
+                if breaker is not None:
+                    breaker.record_failure(family)
+                if attempt >= attempts or not policy.should_retry(
+                        attempt, exception=e, is_write=is_write):
                     ## Maximum number of attempts reached, stop retrying 
                     raise
+                retry = True
+            else:
+                logger.debug('received %s bytes, %s after decoding',
+                             response_file.bytes_received,
+                             response_file.bytes_decoded)
+                status = response_file.code
+                failed = status in policy.retry_statuses
+                if breaker is not None:
+                    if failed:
+                        breaker.record_failure(family)
+                    else:
+                        breaker.record_success(family)
+                ## when out of attempts, parse the body so the Facebook
+                ## error gets raised
+                retry = failed and attempt < attempts and \
+                    policy.should_retry(attempt, status=status,
+                                        is_write=is_write)
+                if retry:
+                    logger.warn('Facebook Graph API request: status %s',
+                                status)
             finally:
                 if response_file:
                     response_file.close()
-                if django_statsd:
-                    django_statsd.stop(_statsd_id)
+                if metrics.enabled:
+                    metrics.observe('request.latency', time.time() - start,
+                                    endpoint=endpoint)
+                    if response_file:
+                        metrics.increment(
+                            'response.bytes_received',
+                            response_file.bytes_received, endpoint=endpoint)
+                        metrics.increment(
+                            'response.bytes_decoded',
+                            response_file.bytes_decoded, endpoint=endpoint)
+            if not retry:
+                break
+            if metrics.enabled:
+                metrics.increment('request.retries', endpoint=endpoint)
+            time.sleep(policy.get_delay(attempt))
+        return status, response, response_file.headers.get('etag')
+
+    @classmethod
+    def _encode_body(cls, post_data, headers):
+        """Returns the urlencoded ``post_data``, or a streaming
+        :class:`open_facebook.multipart.MultipartBody` when it contains
+        files, setting its ``Content-Type`` in ``headers``
+        """
+        if not post_data:
+            return None
+        if has_files(post_data):
+            body = MultipartBody(post_data)
+            headers['Content-Type'] = body.content_type
+            return body
+        return urllib.urlencode(encode_params(post_data))
+
+    @classmethod
+    def _stream_request(cls, url, post_data=None, timeout=REQUEST_TIMEOUT,
+                        result_sets=False):
+        """Like ``_request``, but yields the items of the response's
+        ``data`` array while they are read from the socket, see
+        :class:`open_facebook.streaming.JSONItemStream`.
+
+        :param result_sets: yield ``(name, rows)`` tuples for the result
+            sets of a ``fql.multiquery`` response instead
+
+        The request is only sent once iteration starts. It isn't cached
+        and isn't retried, items might already have been consumed.
+        """
+        cls.tracer.start(url, post_data)
+        headers = dict(cls.request_headers)
+        breaker = cls.circuit_breaker
+        if breaker is not None:
+            family = breaker.get_family(url)
+            breaker.before_request(family)
+
+        post_body = cls._encode_body(post_data, headers)
+
+        metrics = cls.metrics
+        if metrics.enabled:
+            endpoint = get_endpoint(url)
+            metrics.increment('request.attempts', endpoint=endpoint)
+
+        try:
+            response_file = cls.connection_pool.urlopen(
+                url, post_body, headers=headers, timeout=timeout)
+        except urllib2.URLError, e:
+            logger.warn('Facebook Graph API request: error or timeout: %s', unicode(e))
+            if metrics.enabled:
+                metrics.increment('errors', exception=e.__class__.__name__)
+            if breaker is not None:
+                breaker.record_failure(family)
+            raise
+        if breaker is not None:
+            if response_file.code in cls.retry_policy.retry_statuses:
+                breaker.record_failure(family)
+            else:
+                breaker.record_success(family)
 
+        try:
+            stream = JSONItemStream(response_file,
+                                    check=cls._raise_for_error)
+            if result_sets:
+                stream = stream.result_sets()
+            for item in stream:
+                yield item
+        finally:
+            ## hands the connection back if the body was read completely
+            response_file.close()
+            if metrics.enabled:
+                metrics.increment('response.bytes_received',
+                                  response_file.bytes_received,
+                                  endpoint=endpoint)
+                metrics.increment('response.bytes_decoded',
+                                  response_file.bytes_decoded,
+                                  endpoint=endpoint)
+
+    @classmethod
+    def _parse_response(cls, response):
+        """Parse the body of a Facebook response and raise the matching
+        exception if it contains an error.
+        """
         try:
             parsed_response = json.loads(response)
-            logger.info('Facebook Graph API response: %s' % parsed_response)
         except Exception, e:
             ## Using generic Exception because we need to support
             ## multiple JSON libraries :S
             parsed_response = QueryDict(response, True)
-            logger.info('Facebook Graph API response: %s' % parsed_response)
 
+        cls._raise_for_error(parsed_response)
+        return parsed_response
+
+    @classmethod
+    def _raise_for_error(cls, parsed_response):
+        """Raise the matching exception if the parsed response is a
+        Facebook error envelope
+        """
         if parsed_response and isinstance(parsed_response, dict):
             ## of course we have two different syntaxes
             if parsed_response.get('error'):
@@ -147,14 +421,11 @@ class FacebookConnection(object):
             elif parsed_response.get('error_code'):
                 cls.raise_error(parsed_response['error_code'], parsed_response['error_msg'])
 
-        return parsed_response
-
     @classmethod
     def raise_error(self, error_type, message):
         """Search for a corresponding error class and fall back to
         open facebook exception
         """
-        import re
         error_class = None
         if not isinstance(error_type, int):
             error_class = getattr(facebook_exceptions, error_type, None)
@@ -165,49 +436,20 @@ class FacebookConnection(object):
         # define a string to match a single error,
         # use ranges for complexer cases
         # also see http://fbdevwiki.com/wiki/Error_codes#User_Permission_Errors
-        classes = [getattr(facebook_exceptions, e, None)
-                   for e in dir(facebook_exceptions)]
-        exception_classes = [e for e in classes if getattr(
-            e, 'codes', None) and issubclass(
-                e, facebook_exceptions.OpenFacebookException)]
-        exception_classes.sort(key=lambda e: e.range())
+        # the lookup structure is compiled once in facebook_exceptions
 
         # find the error code
         error_code = None
-        error_code_re = re.compile('\(#(\d+)\)')
-        matches = error_code_re.match(message)
+        matches = ERROR_CODE_RE.match(message)
         matching_groups = matches.groups() if matches else None
         if matching_groups:
             error_code = to_int(matching_groups[0]) or None
 
-        for class_ in exception_classes:
-            codes_list = class_.codes_list()
-            # match the error class
-            matching_error_class = None
-            for code in codes_list:
-                if isinstance(code, basestring):
-                    # match on string
-                    key = code
-                    if key in message:
-                        matching_error_class = class_
-                        break
-                elif isinstance(code, tuple):
-                    start, stop = code
-                    if error_code and start <= error_code <= stop:
-                        matching_error_class = class_
-                        break
-                elif isinstance(code, (int, long)):
-                    if int(code) == error_code:
-                        matching_error_class = class_
-                        break
-                else:
-                    raise(
-                        ValueError, 'Dont know how to handle %s of ' \
-                        'type %s' % (code, type(code)))
-            #tell about the happy news if we found something
-            if matching_error_class:
-                error_class = matching_error_class
-                break
+        #tell about the happy news if we found something
+        matching_error_class = facebook_exceptions.error_index.match(
+            message, error_code)
+        if matching_error_class:
+            error_class = matching_error_class
 
         if 'Missing' in message and 'parameter' in message:
             error_class = facebook_exceptions.MissingParameter
@@ -215,6 +457,8 @@ class FacebookConnection(object):
         if not error_class:
             error_class = facebook_exceptions.OpenFacebookException
 
+        if self.metrics.enabled:
+            self.metrics.increment('errors', exception=error_class.__name__)
         raise error_class(message)
 
 
@@ -235,6 +479,18 @@ class FacebookAuthorization(FacebookConnection):
     - create test user
     - get_or_create_test_user
     """
+    ## the algorithm Facebook signs requests with
+    signed_request_algorithm = 'HMAC-SHA256'
+
+    ## HMAC objects keyed with a secret, by (secret, algorithm)
+    _keyed_hmacs = {}
+
+    ## App access tokens by app id and secret, see open_facebook.tokens
+    app_token_cache = AppTokenCache(
+        backend=facebook_settings.FACEBOOK_APP_TOKEN_CACHE_BACKEND,
+        timeout=facebook_settings.FACEBOOK_APP_TOKEN_TIMEOUT,
+        refresh=facebook_settings.FACEBOOK_APP_TOKEN_REFRESH)
+
     @classmethod
     def convert_code(cls, code, redirect_uri=None):
         """Converts an OAuth into an access_token"""
@@ -252,6 +508,10 @@ class FacebookAuthorization(FacebookConnection):
         Thanks to http://stackoverflow.com/questions/3302946/how-to-base64-url-decode-in-python
         and http://sunilarora.org/parsing-signedrequest-parameter-in-python-bas
         
+        The signature is checked, in constant time, before the untrusted
+        payload is decoded, so garbage is rejected without any JSON
+        parsing. Only ``signed_request_algorithm`` is accepted.
+        
         :param signed_request: The signed request to be verified.
             This is a string containing two dot-separated parts: signature
             and data. Each part is (PHP-style) base64-encoded.
@@ -261,72 +521,76 @@ class FacebookAuthorization(FacebookConnection):
             Defaults to ``FACEBOOK_APP_SECRET`` from settings.
         :returns: The decoded data object if signature is valid, else ``None``.
         """
-        from open_facebook.utils import base64_url_decode_php_style
-        import hmac
-        import hashlib
-        
         if not signed_request:
             return
         
         if secret is None:
             secret = facebook_settings.FACEBOOK_APP_SECRET
+        algorithm = cls.signed_request_algorithm
         
-        enc_signature, enc_payload = signed_request.split('.', 1)
-        signature, payload = map(base64_url_decode_php_style, (enc_signature, enc_payload))
-        data = json.loads(payload)
-        algo = data.get('algorithm').upper()
+        try:
+            enc_signature, enc_payload = str(signed_request).split('.', 1)
+            signature = base64_url_decode_php_style(enc_signature)
+        except (TypeError, ValueError):
+            logger.warn('Received a malformed signed request')
+            return
+        if not cls.verify_signature(enc_payload, secret, signature, algorithm):
+            logger.error("Invalid signed_data signature!")
+            return
         
         try:
-            if cls.verify_signature(enc_payload, secret, signature, algo):
-                logger.debug("Received a valid signed request")
-                return data
-            else:
-                logger.error("Invalid signed_data signature!")
-                return
-        except:
-            logger.exception("Something went wrong while verifying the signed_request.")
+            data = json.loads(base64_url_decode_php_style(enc_payload))
+            signed_with = data.get('algorithm', '').upper()
+        except (AttributeError, TypeError, ValueError):
+            logger.exception("Something went wrong while decoding the signed_request.")
+            return
+        if signed_with != algorithm:
+            logger.error('Signed request uses algorithm %r instead of %s',
+                         signed_with, algorithm)
+            return
+        logger.debug("Received a valid signed request")
+        return data
     
     @classmethod
     def calculate_signature(cls, data, secret, algorithm=None):
         """Calculate the signature of ``data`` using ``secret`` as key
         and the specified ``algorithm``.
         
+        The HMAC state keyed with ``secret`` is computed once per secret
+        and algorithm and copied for every signature.
+        
         :param data: The data to be signed
         :param secret: The secret shared key
         :param algorithm: The algorithm to be used. Defaults to ``HMAC-SHA256``.
             Must be one of algorithms supported by hashlib, or an equivalent
             calllable / function.
         """
-        import hmac, hashlib
-        
         if algorithm is None:
             algorithm = 'HMAC-SHA256'
     
-        if isinstance(algorithm, basestring):
-            if algorithm == 'HMAC-SHA256':
-                digestmod = hashlib.sha256
-            elif algorithm == 'HMAC-MD5':
-                digestmod = hashlib.md5
-            elif algorithm == 'HMAC-SHA1':
-                digestmod = hashlib.sha1
-            elif algorithm == 'HMAC-SHA224':
-                digestmod = hashlib.sha224
-            elif algorithm == 'HMAC-SHA384':
-                digestmod = hashlib.sha384
-            elif algorithm == 'HMAC-SHA512':
-                digestmod = hashlib.sha512
-            else:
-                raise ValueError("Unsupported algorithm: %r" % algorithm)
-        else:
+        if not isinstance(algorithm, basestring):
             ## Try using algorithm directly
-            digestmod = algorithm
-        return hmac.new(secret, msg=data, digestmod=digestmod).digest()
+            return hmac.new(secret, msg=data, digestmod=algorithm).digest()
+        
+        key = (secret, algorithm)
+        keyed_hmac = cls._keyed_hmacs.get(key)
+        if keyed_hmac is None:
+            digestmod = SIGNATURE_ALGORITHMS.get(algorithm)
+            if digestmod is None:
+                raise ValueError("Unsupported algorithm: %r" % algorithm)
+            keyed_hmac = hmac.new(secret, digestmod=digestmod)
+            if len(cls._keyed_hmacs) >= 16:
+                cls._keyed_hmacs.clear()
+            cls._keyed_hmacs[key] = keyed_hmac
+        signature = keyed_hmac.copy()
+        signature.update(data)
+        return signature.digest()
     
     @classmethod
     def verify_signature(cls, data, secret, signature, algorithm=None):
         """Verify the ``signature`` on ``data`` using ``secret`` key."""
         _c_sig = cls.calculate_signature(data, secret, algorithm)
-        return signature == _c_sig
+        return constant_time_compare(signature, _c_sig)
 
     @classmethod
     def get_app_access_token(cls):
@@ -336,21 +600,63 @@ class FacebookAuthorization(FacebookConnection):
         
         In order to retrieve application ``access_token``, we need
         ``FACEBOOK_APP_ID`` and ``FACEBOOK_APP_SECRET``, both stored
-        in the settings.
+        in the settings. Tokens are cached by ``app_token_cache``.
         
         :returns: the application access_token
         """
+        return cls.app_token_cache.get(
+            facebook_settings.FACEBOOK_APP_ID,
+            facebook_settings.FACEBOOK_APP_SECRET,
+            cls._fetch_app_access_token)
+
+    @classmethod
+    def _fetch_app_access_token(cls, app_id, secret):
+        """Returns a new ``(token, expires_in)`` tuple. Sent using
+        ``_fetch``, a cached or shared response could be the token
+        that was just rejected.
+        """
         kwargs = {
             'grant_type': 'client_credentials',
-            'client_id': facebook_settings.FACEBOOK_APP_ID,
-            'client_secret': facebook_settings.FACEBOOK_APP_SECRET,
+            'client_id': app_id,
+            'client_secret': secret,
         }
-        response = cls.request('oauth/access_token', **kwargs)
-        return response['access_token']
+        url = '%soauth/access_token?%s' % (cls.api_url,
+                                            urllib.urlencode(kwargs))
+        status, body, etag = cls._fetch(url)
+        return cls._parse_app_access_token(cls._parse_response(body))
+
+    @classmethod
+    def _parse_app_access_token(cls, response):
+        expires_in = response.get('expires_in') or response.get('expires')
+        return response['access_token'], to_int(expires_in) or None
 
     @classmethod
-    def create_test_user(cls, app_access_token, permissions=None):
-        """Create an user to be used for testing
+    def _app_request(cls, path, app_access_token=None, **params):
+        """Sends a request authenticated as the app. Without an explicit
+        ``app_access_token`` the cached one is used, if Facebook rejects
+        it the token is dropped and the request is sent once more with a
+        new one.
+        """
+        cached = app_access_token is None
+        if cached:
+            app_access_token = cls.get_app_access_token()
+        try:
+            return cls.request(path, access_token=app_access_token, **params)
+        except facebook_exceptions.OAuthException, e:
+            if not cached or isinstance(
+                    e, facebook_exceptions.PermissionException):
+                raise
+            logger.warn('app access token rejected: %s', e)
+            cls.app_token_cache.invalidate(
+                facebook_settings.FACEBOOK_APP_ID,
+                facebook_settings.FACEBOOK_APP_SECRET, app_access_token)
+            return cls.request(path, access_token=cls.get_app_access_token(),
+                               **params)
+
+    @classmethod
+    def create_test_user(cls, app_access_token=None, permissions=None):
+        """Create an user to be used for testing, using the cached app
+        access token unless ``app_access_token`` is given
         
         .. COMMENT -------------------------------------------------------------
             
@@ -368,25 +674,23 @@ class FacebookAuthorization(FacebookConnection):
                           'user_photos,offline_access'
 
         kwargs = {
-            'access_token': app_access_token,
             'installed': True,
             'name': 'Hello World',
             'method': 'post',
             'permissions': permissions,
         }
         path = '%s/accounts/test-users' % facebook_settings.FACEBOOK_APP_ID
-        response = cls.request(path, **kwargs)
+        response = cls._app_request(path, app_access_token, **kwargs)
 
         return response
 
     @classmethod
-    def get_or_create_test_user(cls, app_access_token, permissions=None):
+    def get_or_create_test_user(cls, app_access_token=None, permissions=None):
         if not permissions:
             permissions = ['read_stream', 'publish_stream',
                            'user_photos', 'offline_access']
-        kwargs = {'access_token': app_access_token}
         path = '%s/accounts/test-users' % facebook_settings.FACEBOOK_APP_ID
-        response = cls.request(path, **kwargs)
+        response = cls._app_request(path, app_access_token)
         return response
 
 
@@ -462,6 +766,28 @@ class OpenFacebook(FacebookConnection):
             print facebook.set('me/feed', message='Check out Fashiolista',
                                picture=photo, url='http://www.fashiolista.com')
     """
+    ## Optional client side rate limits, see open_facebook.ratelimit
+    rate_limiter = None
+    if facebook_settings.FACEBOOK_RATE_LIMITS:
+        rate_limiter = RateLimiter(
+            facebook_settings.FACEBOOK_RATE_LIMITS,
+            app_id=facebook_settings.FACEBOOK_APP_ID,
+            backend=facebook_settings.FACEBOOK_RATE_LIMIT_BACKEND,
+            block=facebook_settings.FACEBOOK_RATE_LIMIT_BLOCK,
+            max_wait=facebook_settings.FACEBOOK_RATE_LIMIT_MAX_WAIT)
+
+    ## Set to True or False to wait for or raise on exceeded rate limits,
+    ## None uses FACEBOOK_RATE_LIMIT_BLOCK
+    rate_limit_block = None
+
+    ## Optional cache of the me profiles, shared between requests
+    profile_cache = None
+    if facebook_settings.FACEBOOK_PROFILE_CACHE_ENABLED:
+        profile_cache = ProfileCache(
+            max_entries=facebook_settings.FACEBOOK_PROFILE_CACHE_SIZE,
+            backend=facebook_settings.FACEBOOK_PROFILE_CACHE_BACKEND,
+            timeout=facebook_settings.FACEBOOK_PROFILE_CACHE_TIMEOUT)
+
     def __init__(self, access_token=None, prefetched_data=None,
                  expires=None, current_user_id=None):
         self.access_token = access_token
@@ -486,7 +812,11 @@ class OpenFacebook(FacebookConnection):
         return authenticated
 
     def get(self, path, **kwargs):
-        """Performs a GET request on the Graph API"""
+        """Performs a GET request on the Graph API
+
+        Pass ``stream=True`` to iterate over the items of a large
+        connection while they are being decoded.
+        """
         response = self.request(path, **kwargs)
         return response
 
@@ -495,8 +825,78 @@ class OpenFacebook(FacebookConnection):
         kwargs['ids'] = ','.join(ids)
         return self.request(**kwargs)
 
+    def iterate(self, path, page_size=None, max_items=None, max_pages=None,
+                prefetch=False, **kwargs):
+        """Lazily yields the items of a paged Graph connection, following
+        the ``paging.next`` links one page at a time::
+
+            for like in facebook.iterate('me/likes', page_size=500):
+                print like['name']
+
+        :param page_size: sent as the ``limit`` parameter
+        :param max_items: stop after yielding this many items
+        :param max_pages: stop after fetching this many pages
+        :param prefetch: fetch the next page in the background while
+            the items of the current page are being consumed
+        """
+        if page_size:
+            kwargs['limit'] = page_size
+        response = self.get(path, **kwargs)
+        pages = items = 0
+        while response:
+            pages += 1
+            data = response.get('data') or []
+            next_url = (response.get('paging') or {}).get('next')
+            if not data or (max_pages and pages >= max_pages) or (
+                    max_items is not None and items + len(data) >= max_items):
+                next_url = None
+            next_page = None
+            if prefetch and next_url:
+                next_page = BackgroundCall(self._request_page, next_url)
+
+            for item in data:
+                if max_items is not None and items >= max_items:
+                    return
+                items += 1
+                yield item
+
+            if next_page is not None:
+                response = next_page.result()
+            elif next_url:
+                response = self._request_page(next_url)
+            else:
+                response = None
+
+    def _request_page(self, url):
+        """Fetches a ``paging.next`` url, within the rate limits like any
+        other request
+        """
+        if self.rate_limiter is not None:
+            path = urlparse.urlsplit(url)[2].lstrip('/')
+            self.rate_limiter.acquire(self.access_token, path,
+                                      block=self.rate_limit_block)
+        return self._request(url)
+
+    def batch(self):
+        """Returns a :class:`open_facebook.batch.GraphBatch` which sends
+        several operations in one request using the batch API::
+
+            with facebook.batch() as batch:
+                me = batch.get('me')
+                likes = batch.get('me/likes')
+            print me.result(), likes.result()
+        """
+        return GraphBatch(self)
+
     def set(self, path, params=None, **post_data):
-        """Performs a POST request on the Graph API"""
+        """Performs a POST request on the Graph API
+
+        File-like values are uploaded as a streaming multipart body::
+
+            facebook.set('me/photos', source=open('photo.jpg', 'rb'))
+
+        see :mod:`open_facebook.multipart` for progress callbacks.
+        """
         assert self.access_token, 'Write operations require an access token'
         if not params:
             params = {}
@@ -511,20 +911,134 @@ class OpenFacebook(FacebookConnection):
         self.request(*args, **kwargs)
 
     def fql(self, query, **kwargs):
-        """Executes a FQL query using the Facebook FQL API"""
+        """Executes a FQL query using the Facebook FQL API
+
+        Pass ``stream=True`` to iterate over the rows while they are
+        being decoded.
+        """
         kwargs['format'] = 'JSON'
         kwargs['query'] = query
         path = 'fql.query'
         response = self.request(path, old_api=True, **kwargs)
         return response
 
-    def me(self):
-        """Cached method of requesting information about me"""
-        me = getattr(self, '_me', None)
+    def fql_multi(self, queries, stream=False, **kwargs):
+        """Executes several FQL queries in a single ``fql.multiquery``
+        call. Queries can use the results of the others, by name::
+
+            results = facebook.fql_multi({
+                'friends': 'SELECT uid2 FROM friend WHERE uid1 = me()',
+                'details': 'SELECT uid, name FROM user '
+                           'WHERE uid IN (SELECT uid2 FROM #friends)',
+            })
+            print results['details']
+
+        Returns a dict with the rows per query. A query which failed on
+        its own gets the matching ``OpenFacebookException`` instead of
+        its rows, errors failing the whole call are raised.
+
+        Pass ``stream=True`` to iterate over ``(name, rows)`` tuples
+        instead, where ``rows`` yields the rows while they are decoded.
+        """
+        kwargs['format'] = 'JSON'
+        kwargs['queries'] = json.dumps(queries)
+        path = 'fql.multiquery'
+        if stream:
+            return self.request(path, old_api=True, stream='result_sets',
+                                **kwargs)
+        response = self.request(path, old_api=True, **kwargs)
+        return self._parse_result_sets(response)
+
+    @classmethod
+    def _parse_result_sets(cls, response):
+        """Returns the rows of a ``fql.multiquery`` response by query
+        name, or the exception of queries which failed
+        """
+        results = {}
+        for result_set in response:
+            try:
+                cls._raise_for_error(result_set)
+            except facebook_exceptions.OpenFacebookException, e:
+                results[result_set.get('name')] = e
+            else:
+                results[result_set['name']] = result_set['fql_result_set']
+        return results
+
+    def map(self, calls, max_workers=None):
+        """Runs independent calls in parallel, sharing the connection pool
+
+        Every call is either a path, which is fetched using ``get``, or a
+        ``(method, path)`` or ``(method, path, kwargs)`` tuple::
+
+            facebook.map(['me', 'me/likes', ('fql', query)])
+            facebook.map([('set', 'me/photos', dict(url=url))
+                          for url in photo_urls])
+
+        :param max_workers: the number of threads to use, defaults to
+            ``FACEBOOK_MAP_MAX_WORKERS``
+        :returns: a list with the results in the same order as ``calls``.
+            Calls which failed are represented by their exception.
+        """
+        if max_workers is None:
+            max_workers = facebook_settings.FACEBOOK_MAP_MAX_WORKERS
+
+        def call(spec):
+            method, args, kwargs = self._get_call(spec)
+            return method(*args, **kwargs)
+
+        return fan_out(call, calls, max_workers)
+
+    def _get_call(self, spec):
+        """Returns the ``(method, args, kwargs)`` of a ``map`` call"""
+        if isinstance(spec, basestring):
+            spec = ('get', spec)
+        method, args = spec[0], list(spec[1:])
+        kwargs = {}
+        if args and isinstance(args[-1], dict):
+            kwargs = args.pop()
+        return getattr(self, method), args, kwargs
+
+    def me(self, fields=None):
+        """Cached method of requesting information about me, also
+        cached between requests by ``profile_cache`` if enabled
+
+        :param fields: only request these fields. Cached data is reused
+            if it includes all of them, without fields any cached data
+            is returned
+        """
+        me = self._get_cached_me(fields)
         if me is None:
-            self._me = me = self.get('me')
+            me = self.get('me', **self._get_me_params(fields))
+            self._store_me(me, fields)
         return me
 
+    def _get_cached_me(self, fields=None):
+        """Returns the cached me data including ``fields``, kept on this
+        object or in ``profile_cache``, or ``None``
+        """
+        me = getattr(self, '_me', None)
+        cached_fields = getattr(self, '_me_fields', None)
+        if me is not None and fields and cached_fields is not None \
+                and not set(fields) <= set(cached_fields):
+            me = None
+        if me is None and self.profile_cache is not None:
+            cached = self.profile_cache.get(self.access_token, fields)
+            if cached is not None:
+                self._me_fields, me = cached
+                self._me = me
+        return me
+
+    def _get_me_params(self, fields=None):
+        if fields:
+            return dict(fields=','.join(fields))
+        return {}
+
+    def _store_me(self, me, fields=None):
+        self._me_fields = list(fields) if fields else None
+        self._me = me
+        if self.profile_cache is not None and isinstance(me, dict):
+            self.profile_cache.set(self.access_token, me, fields)
+
     def my_image_url(self, size=None):
         """
         Returns the image url from your profile
@@ -537,7 +1051,8 @@ class OpenFacebook(FacebookConnection):
         url = '%sme/picture?%s' % (self.api_url, query_dict.urlencode())
         return url
 
-    def request(self, path='', post_data=None, get_data=None, old_api=False, **params):
+    def request(self, path='', post_data=None, get_data=None, old_api=False,
+                stream=False, **params):
         """Main function for sending requests to Facebook APIs
         
         :param path: Either the object path for REST Graph API, or
@@ -548,8 +1063,15 @@ class OpenFacebook(FacebookConnection):
             Data that will be used to build the GET query.
         :param old_api: If set to ``True``, uses the old API URL
             (still valid for FQL requests).
+        :param stream: If set to ``True``, returns an iterator over the
+            items of the ``data`` array (or the FQL result rows), decoded
+            while they are read instead of all at once. ``'result_sets'``
+            iterates over the result sets of a ``fql.multiquery``.
         
         Extra kwargs will be used to build the GET query.
+
+        Raises ``RateLimitException`` when ``rate_limiter`` is configured
+        and one of the budgets ran out.
         
         """
         api_base_url = self.api_url
@@ -565,7 +1087,13 @@ class OpenFacebook(FacebookConnection):
         get_data.update(params)
         
         url = '%s%s?%s' % (api_base_url, path, urllib.urlencode(get_data))
-        logger.info('Request URL: %s', url)
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(
+                self.access_token, path, is_write_request(url, post_data),
+                block=self.rate_limit_block)
+        if stream:
+            return self._stream_request(url, post_data,
+                                        result_sets=stream == 'result_sets')
         response = self._request(url, post_data)
         return response
 
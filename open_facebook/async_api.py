@@ -0,0 +1,341 @@
+"""Non-blocking versions of the Open Facebook clients.
+
+:class:`AsyncOpenFacebook` and :class:`AsyncFacebookAuthorization` have the
+same methods as their blocking counterparts, but every method which talks
+to Facebook returns a future instead of the response. They run on the
+`Tornado <http://www.tornadoweb.org/>`_ IOLoop, so one process can keep
+hundreds of Graph calls in flight::
+
+    from tornado import gen
+
+    @gen.coroutine
+    def show_profile(access_token):
+        facebook = AsyncOpenFacebook(access_token)
+        me, likes = yield [facebook.me(), facebook.get('me/likes')]
+        raise gen.Return((me, likes))
+
+Responses are parsed and Facebook errors are mapped exactly like the
+blocking client does. Connections are kept alive when pycurl is installed
+(``CurlAsyncHTTPClient``), otherwise Tornado's default client is used.
+"""
+
+import logging
+import socket
+import time
+import urllib
+import urllib2
+
+from django_facebook import settings as facebook_settings
+
+from open_facebook import exceptions as facebook_exceptions
+from open_facebook.api import (FacebookAuthorization, OpenFacebook,
+                               REQUEST_TIMEOUT)
+from open_facebook.multipart import has_files
+from open_facebook.utils import (encode_params, get_endpoint,
+                                 is_write_request, json)
+
+try:
+    from tornado import gen
+    from tornado.httpclient import AsyncHTTPClient, HTTPError, HTTPRequest
+except ImportError:
+    gen = None
+
+logger = logging.getLogger(__name__)
+
+
+def get_http_client():
+    """Returns the IOLoop's shared http client, preferring the curl
+    client which reuses connections.
+    """
+    try:
+        from tornado.curl_httpclient import CurlAsyncHTTPClient
+        return CurlAsyncHTTPClient()
+    except ImportError:
+        return AsyncHTTPClient()
+
+
+def _coroutine(func):
+    """``gen.coroutine`` when tornado is installed, a clear error
+    otherwise
+    """
+    if gen is not None:
+        return gen.coroutine(func)
+
+    def tornado_required(*args, **kwargs):
+        raise ImportError('The async Open Facebook clients require tornado')
+    return tornado_required
+
+
+class AsyncFacebookConnection(object):
+    """Mixin which replaces the blocking ``request`` of a
+    :class:`open_facebook.api.FacebookConnection` by a coroutine.
+    """
+
+    @classmethod
+    def _build_url(cls, access_token, path='', get_data=None, old_api=False,
+                   **params):
+        api_base_url = cls.old_api_url if old_api else cls.api_url
+        get_data = dict(get_data or {})
+        if access_token:
+            params['access_token'] = access_token
+        get_data.update(params)
+        return '%s%s?%s' % (api_base_url, path, urllib.urlencode(get_data))
+
+    @classmethod
+    @_coroutine
+    def _async_request(cls, url, post_data=None, timeout=REQUEST_TIMEOUT,
+                       attempts=None):
+        """Fetch ``url`` without blocking and parse the response like
+        :meth:`open_facebook.api.FacebookConnection._request` does.
+
+        Failures are retried according to ``retry_policy``, never for
+        writes by default, and the ``circuit_breaker`` and ``metrics``
+        are used like the blocking client does.
+        """
+        trace = cls.tracer.start(url, post_data)
+        is_write = is_write_request(url, post_data)
+        body = None
+        if post_data:
+            body = urllib.urlencode(encode_params(post_data))
+        request = HTTPRequest(
+            url, method='POST' if body is not None else 'GET', body=body,
+            headers={'User-agent': 'Open Facebook Python'},
+            request_timeout=timeout)
+
+        policy = cls.retry_policy
+        if attempts is None:
+            attempts = policy.max_attempts
+        breaker = cls.circuit_breaker
+        if breaker is not None:
+            family = breaker.get_family(url)
+        metrics = cls.metrics
+        if metrics.enabled:
+            endpoint = get_endpoint(url)
+
+        client = get_http_client()
+        attempt = 0
+        while True:
+            attempt += 1
+            if breaker is not None:
+                breaker.before_request(family)
+            if metrics.enabled:
+                metrics.increment('request.attempts', endpoint=endpoint)
+                start = time.time()
+            error = None
+            try:
+                response = yield client.fetch(request)
+            except HTTPError, e:
+                ## 599 is used for timeouts and connection errors, any
+                ## other status still has the Facebook error in the body
+                if e.code != 599 and e.response is not None:
+                    response = e.response
+                else:
+                    response, error = None, e
+            except (socket.error, IOError), e:
+                ## refused or reset connections, raised as is by the
+                ## simple client
+                response, error = None, urllib2.URLError(e)
+            finally:
+                if metrics.enabled:
+                    metrics.observe('request.latency', time.time() - start,
+                                    endpoint=endpoint)
+            if error is not None:
+                logger.warn('Facebook Graph API request: error or '
+                            'timeout: %s', unicode(error))
+                if metrics.enabled:
+                    metrics.increment('errors',
+                                      exception=error.__class__.__name__)
+                if breaker is not None:
+                    breaker.record_failure(family)
+                ## a transport error, like the URLError of the
+                ## blocking client
+                if attempt >= attempts or not policy.should_retry(
+                        attempt, exception=urllib2.URLError(error),
+                        is_write=is_write):
+                    raise error
+            if response is not None:
+                status = response.code
+                failed = status in policy.retry_statuses
+                if breaker is not None:
+                    if failed:
+                        breaker.record_failure(family)
+                    else:
+                        breaker.record_success(family)
+                retry = failed and attempt < attempts and \
+                    policy.should_retry(attempt, status=status,
+                                        is_write=is_write)
+                if not retry:
+                    break
+                logger.warn('Facebook Graph API request: status %s', status)
+            if metrics.enabled:
+                metrics.increment('request.retries', endpoint=endpoint)
+            yield gen.sleep(policy.get_delay(attempt))
+
+        body = response.body.decode('utf8')
+        if trace is not None:
+            trace.response(body)
+        parsed_response = cls._parse_response(body)
+        raise gen.Return(parsed_response)
+
+
+class AsyncFacebookAuthorization(AsyncFacebookConnection,
+                                 FacebookAuthorization):
+    """Non-blocking :class:`open_facebook.api.FacebookAuthorization`.
+
+    ``convert_code``, ``create_test_user`` and ``get_or_create_test_user``
+    return futures, ``parse_signed_data`` doesn't need the network and
+    behaves exactly like the blocking version.
+    """
+
+    @classmethod
+    def request(cls, path='', post_data=None, old_api=False, **params):
+        """Returns a future for the parsed response"""
+        access_token = params.pop('access_token', None) \
+            or getattr(cls, 'access_token', None)
+        url = cls._build_url(access_token, path, old_api=old_api, **params)
+        return cls._async_request(url, post_data)
+
+    @classmethod
+    @_coroutine
+    def get_app_access_token(cls):
+        app_id = facebook_settings.FACEBOOK_APP_ID
+        secret = facebook_settings.FACEBOOK_APP_SECRET
+        token = cls.app_token_cache.get_valid(app_id, secret)
+        if token is None:
+            kwargs = {
+                'grant_type': 'client_credentials',
+                'client_id': app_id,
+                'client_secret': secret,
+            }
+            response = yield cls.request('oauth/access_token', **kwargs)
+            token = cls.app_token_cache.set(
+                app_id, secret, *cls._parse_app_access_token(response))
+        raise gen.Return(token)
+
+    @classmethod
+    @_coroutine
+    def _app_request(cls, path, app_access_token=None, **params):
+        cached = app_access_token is None
+        if cached:
+            app_access_token = yield cls.get_app_access_token()
+        try:
+            response = yield cls.request(
+                path, access_token=app_access_token, **params)
+        except facebook_exceptions.OAuthException, e:
+            if not cached or isinstance(
+                    e, facebook_exceptions.PermissionException):
+                raise
+            cls.app_token_cache.invalidate(
+                facebook_settings.FACEBOOK_APP_ID,
+                facebook_settings.FACEBOOK_APP_SECRET, app_access_token)
+            app_access_token = yield cls.get_app_access_token()
+            response = yield cls.request(
+                path, access_token=app_access_token, **params)
+        raise gen.Return(response)
+
+
+class AsyncOpenFacebook(AsyncFacebookConnection, OpenFacebook):
+    """Non-blocking :class:`open_facebook.api.OpenFacebook`.
+
+    ``get``, ``get_many``, ``set``, ``delete``, ``fql``, ``fql_multi``,
+    ``map`` and ``me`` return futures resolving to the same data the
+    blocking client returns, ``iterate`` resolves to a list of the items.
+    """
+
+    def request(self, path='', post_data=None, get_data=None, old_api=False,
+                stream=False, **params):
+        """Returns a future for the parsed response"""
+        if stream:
+            raise NotImplementedError('Streaming is only supported by the '
+                                      'blocking OpenFacebook client')
+        if has_files(post_data):
+            raise NotImplementedError('Uploads are only supported by the '
+                                      'blocking OpenFacebook client')
+        url = self._build_url(self.access_token, path, get_data=get_data,
+                              old_api=old_api, **params)
+        return self._async_request(url, post_data)
+
+    def batch(self):
+        raise NotImplementedError('Batches are only supported by the '
+                                  'blocking OpenFacebook client')
+
+    @_coroutine
+    def is_authenticated(self):
+        try:
+            me = yield self.me()
+        except facebook_exceptions.OpenFacebookException:
+            me = None
+        raise gen.Return(bool(me))
+
+    def delete(self, *args, **kwargs):
+        kwargs['method'] = 'delete'
+        return self.request(*args, **kwargs)
+
+    @_coroutine
+    def fql_multi(self, queries, stream=False, **kwargs):
+        kwargs['format'] = 'JSON'
+        kwargs['queries'] = json.dumps(queries)
+        response = yield self.request('fql.multiquery', old_api=True,
+                                      stream=stream, **kwargs)
+        raise gen.Return(self._parse_result_sets(response))
+
+    @_coroutine
+    def me(self, fields=None):
+        me = self._get_cached_me(fields)
+        if me is None:
+            me = yield self.get('me', **self._get_me_params(fields))
+            self._store_me(me, fields)
+        raise gen.Return(me)
+
+    @_coroutine
+    def map(self, calls, max_workers=None):
+        """Runs the calls concurrently on the IOLoop, resolves to the
+        results in the same order, failed calls represented by their
+        exception. ``max_workers`` is ignored, no threads are used.
+        """
+        @_coroutine
+        def call(spec):
+            method, args, kwargs = self._get_call(spec)
+            result = yield method(*args, **kwargs)
+            raise gen.Return(result)
+
+        futures = [call(spec) for spec in calls]
+        results = []
+        for future in futures:
+            try:
+                result = yield future
+            except Exception, e:
+                result = e
+            results.append(result)
+        raise gen.Return(results)
+
+    @_coroutine
+    def iterate(self, path, page_size=None, max_items=None, max_pages=None,
+                prefetch=False, **kwargs):
+        """Resolves to the list of items of a paged Graph connection, there
+        are no asynchronous generators. The next page is always requested
+        while the current one is being collected, ``prefetch`` is ignored.
+        """
+        if page_size:
+            kwargs['limit'] = page_size
+        response = yield self.get(path, **kwargs)
+        pages = 0
+        items = []
+        while response:
+            pages += 1
+            data = response.get('data') or []
+            next_url = (response.get('paging') or {}).get('next')
+            if not data or (max_pages and pages >= max_pages) or (
+                    max_items is not None and
+                    len(items) + len(data) >= max_items):
+                next_url = None
+            next_page = None
+            if next_url:
+                next_page = self._async_request(next_url)
+            items.extend(data)
+            response = None
+            if next_page is not None:
+                response = yield next_page
+        if max_items is not None:
+            items = items[:max_items]
+        raise gen.Return(items)
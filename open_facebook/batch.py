@@ -0,0 +1,268 @@
+"""Graph Batch API support for ``open_facebook``.
+
+Sends up to 50 Graph operations in a single HTTP request, see
+http://developers.facebook.com/docs/reference/api/batch/
+
+Example::
+
+    >>> with facebook.batch() as batch:
+    ...     me = batch.get('me')
+    ...     friends = batch.get('me/friends', limit=5)
+    ...     details = batch.get('', ids=friends.reference('$.data.*.id'))
+    ...     batch.set('me/feed', message='check out fashiolista')
+    >>> me.result()['name']
+    >>> details.result()
+
+Operations can depend on each other, either explicitly through
+``depends_on`` or by using a ``{result=name:$.jsonpath}`` reference in
+their parameters. Dependent operations are always sent in the same
+request, larger sets of operations are split over several requests.
+"""
+
+import logging
+import re
+import urllib
+
+from open_facebook import exceptions as facebook_exceptions
+from open_facebook.utils import json, encode_params
+
+logger = logging.getLogger(__name__)
+
+## Facebook refuses batches with more operations than this
+BATCH_MAX_SIZE = 50
+
+RESULT_REFERENCE_RE = re.compile(r'\{result=([^:}]+):[^}]*\}')
+
+
+class BatchOperation(object):
+    """A single operation inside a :class:`GraphBatch`.
+
+    After the batch executed ``response`` holds the parsed body and
+    ``exception`` the mapped Facebook error, if any.
+    """
+    def __init__(self, batch, method, path, params=None, post_data=None,
+                 name=None, depends_on=None):
+        self.batch = batch
+        self.method = method
+        self.path = path
+        self.params = params or {}
+        self.post_data = post_data or {}
+        self.name = name
+        if depends_on is not None and not isinstance(depends_on,
+                                                     (list, tuple)):
+            depends_on = [depends_on]
+        self.depends_on = list(depends_on or [])
+        self.executed = False
+        self.response = None
+        self.exception = None
+
+    def reference(self, jsonpath):
+        """Returns a ``{result=...}`` expression which other operations
+        in the same batch can use to refer to the response of this one.
+        """
+        return '{result=%s:%s}' % (self.get_name(), jsonpath)
+
+    def get_name(self):
+        if not self.name:
+            self.name = 'operation%s' % self.batch.operations.index(self)
+        return self.name
+
+    def result(self):
+        """Returns the response, or raises the error Facebook gave for
+        this operation.
+        """
+        if not self.executed:
+            raise ValueError('The batch has not been executed yet')
+        if self.exception is not None:
+            raise self.exception
+        return self.response
+
+    def dependencies(self):
+        """Returns the names of the operations this one depends on"""
+        names = set()
+        for dependency in self.depends_on:
+            if isinstance(dependency, BatchOperation):
+                dependency = dependency.get_name()
+            names.add(dependency)
+        values = self.params.values() + self.post_data.values()
+        for value in values:
+            if isinstance(value, basestring):
+                names.update(RESULT_REFERENCE_RE.findall(value))
+        return names
+
+    def to_dict(self):
+        """The representation Facebook expects in the ``batch`` parameter"""
+        relative_url = self.path
+        if self.params:
+            relative_url = '%s?%s' % (relative_url, _urlencode(self.params))
+        operation = dict(method=self.method, relative_url=relative_url)
+        if self.post_data:
+            operation['body'] = _urlencode(self.post_data)
+        if self.name:
+            operation['name'] = self.name
+            ## Facebook leaves out responses which are used as a
+            ## dependency, unless told otherwise
+            operation['omit_response_on_success'] = False
+        dependencies = self.dependencies()
+        if len(dependencies) == 1:
+            operation['depends_on'] = list(dependencies)[0]
+        return operation
+
+    def __repr__(self):
+        return '<BatchOperation %s %s>' % (self.method, self.path)
+
+
+class GraphBatch(object):
+    """Collects Graph operations and sends them using the batch API.
+
+    Use it as a context manager to execute the batch on exit, or call
+    :meth:`execute` yourself.
+    """
+    max_size = BATCH_MAX_SIZE
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.operations = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+    def add(self, method, path, params=None, post_data=None, name=None,
+            depends_on=None):
+        operation = BatchOperation(self, method, path, params=params,
+                                   post_data=post_data, name=name,
+                                   depends_on=depends_on)
+        self.operations.append(operation)
+        return operation
+
+    def get(self, path, name=None, depends_on=None, **params):
+        """Adds a GET request on the Graph API"""
+        return self.add('GET', path, params=params, name=name,
+                        depends_on=depends_on)
+
+    def set(self, path, params=None, name=None, depends_on=None,
+            **post_data):
+        """Adds a POST request on the Graph API"""
+        assert self.graph.access_token, \
+            'Write operations require an access token'
+        return self.add('POST', path, params=params, post_data=post_data,
+                        name=name, depends_on=depends_on)
+
+    def delete(self, path, name=None, depends_on=None, **params):
+        """Adds a DELETE request on the Graph API"""
+        return self.add('DELETE', path, params=params, name=name,
+                        depends_on=depends_on)
+
+    def execute(self):
+        """Sends all pending operations and returns their results in
+        order. Failed operations are represented by their exception
+        instead of raising it.
+        """
+        pending = [o for o in self.operations if not o.executed]
+        for chunk in self.chunks(pending):
+            self._execute_chunk(chunk)
+        results = []
+        for operation in pending:
+            if operation.exception is not None:
+                results.append(operation.exception)
+            else:
+                results.append(operation.response)
+        return results
+
+    def chunks(self, operations):
+        """Splits the operations in lists of at most ``max_size``,
+        keeping operations which depend on each other together.
+        """
+        ## union-find on the dependency graph. Resolving the dependencies
+        ## first names the operations which are depended upon, unnamed
+        ## operations are keyed by their id.
+        dependencies = [(o, o.dependencies()) for o in operations]
+        key = lambda o: o.name or id(o)
+        named = dict((o.name, o) for o in operations if o.name)
+        groups = dict((key(o), [o]) for o in operations)
+        group_of = dict((key(o), key(o)) for o in operations)
+        for operation, operation_dependencies in dependencies:
+            for dependency in operation_dependencies:
+                if dependency not in named:
+                    raise ValueError('Operation %r depends on unknown '
+                                     'operation %r' % (operation, dependency))
+                a = group_of[key(operation)]
+                b = group_of[dependency]
+                if a != b:
+                    for member in groups[b]:
+                        group_of[key(member)] = a
+                    groups[a].extend(groups.pop(b))
+
+        chunks = []
+        current = []
+        seen = set()
+        for operation in operations:
+            group_name = group_of[key(operation)]
+            if group_name in seen:
+                continue
+            seen.add(group_name)
+            group = sorted(groups[group_name], key=operations.index)
+            if len(group) > self.max_size:
+                raise ValueError('Found %s operations depending on each '
+                                 'other, only %s fit in a batch' % (
+                                     len(group), self.max_size))
+            if len(current) + len(group) > self.max_size:
+                chunks.append(current)
+                current = []
+            current.extend(group)
+        if current:
+            chunks.append(current)
+        return chunks
+
+    def _execute_chunk(self, operations):
+        batch = json.dumps([o.to_dict() for o in operations])
+        logger.info('sending a batch of %s operations', len(operations))
+        try:
+            responses = self.graph.request(post_data=dict(batch=batch))
+        finally:
+            self._invalidate(operations)
+        for operation, response in zip(operations, responses):
+            operation.executed = True
+            if response is None:
+                operation.exception = facebook_exceptions.OpenFacebookException(
+                    'Operation %r was not executed, probably because one of '
+                    'its dependencies failed' % operation)
+                continue
+            try:
+                operation.response = self.graph._parse_response(
+                    response.get('body') or '')
+            except facebook_exceptions.OpenFacebookException, e:
+                operation.exception = e
+
+    def _invalidate(self, operations):
+        """Drops the cached reads of the paths written to, like a
+        ``set`` or ``delete`` outside of a batch does
+        """
+        graph = self.graph
+        cache = graph.response_cache
+        if cache is None:
+            return
+        query = urllib.urlencode(dict(access_token=graph.access_token or ''))
+        for operation in operations:
+            if operation.method != 'GET':
+                path = operation.path.split('?', 1)[0].lstrip('/')
+                cache.invalidate(cache.parse('%s%s?%s' % (
+                    graph.api_url, path, query)))
+
+
+def _urlencode(params):
+    """Urlencodes ``params``, leaving ``{result=...}`` references intact
+    so Facebook can still resolve them.
+    """
+    parts = []
+    for k, v in encode_params(params).items():
+        if RESULT_REFERENCE_RE.search(v):
+            value = urllib.quote(v, safe='{}=:$.*,')
+        else:
+            value = urllib.quote_plus(v)
+        parts.append('%s=%s' % (urllib.quote_plus(k), value))
+    return '&'.join(parts)
@@ -0,0 +1,16 @@
+"""Micro-benchmarks for the hot paths of Open Facebook.
+
+Run them, with ``DJANGO_SETTINGS_MODULE`` set like for the tests, and
+compare the results to the checked in baseline::
+
+    python -m open_facebook.benchmarks run -o results.json
+    python -m open_facebook.benchmarks compare results.json
+
+``compare`` exits with status 1 when a benchmark is more than
+``--threshold`` (default 10%) slower than the baseline. Only run ``-k``
+matching benchmarks using ``run -k signed_request``. After a deliberate
+change, update ``baseline.json`` from a run on a quiet machine.
+
+Benchmarks live in :mod:`open_facebook.benchmarks.suite`, the timing,
+storage and comparison in :mod:`open_facebook.benchmarks.runner`.
+"""
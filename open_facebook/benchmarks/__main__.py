@@ -0,0 +1,51 @@
+"""Command line interface, see :mod:`open_facebook.benchmarks`"""
+
+import logging
+import optparse
+import sys
+
+USAGE = """%prog run [-k pattern] [-o results.json]
+       %prog compare results.json [baseline.json] [--threshold 0.1]"""
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage=USAGE)
+    parser.add_option('-k', dest='pattern',
+                      help='only run the benchmarks matching this regexp')
+    parser.add_option('-o', '--output', dest='output', default='-',
+                      help='where to write the json results, - for stdout')
+    parser.add_option('-r', '--repeat', dest='repeat', type='int', default=5)
+    parser.add_option('--min-time', dest='min_time', type='float',
+                      default=0.1, help='minimum seconds per measurement')
+    parser.add_option('-t', '--threshold', dest='threshold', type='float',
+                      default=0.1,
+                      help='the slowdown reported as regression, 0.1 is 10%')
+    options, args = parser.parse_args(argv)
+    if not args or args[0] not in ('run', 'compare'):
+        parser.error('specify run or compare')
+
+    logging.disable(logging.CRITICAL)
+    from open_facebook.benchmarks import runner
+
+    if args[0] == 'run':
+        results = runner.run(options.pattern, options.repeat,
+                             options.min_time, stream=sys.stderr)
+        runner.save(results, options.output)
+        return 0
+
+    if len(args) not in (2, 3):
+        parser.error('compare needs a results file and optionally a baseline')
+    results = runner.load(args[1])
+    baseline = runner.load(args[2] if len(args) == 3 else
+                           runner.BASELINE_PATH)
+    rows, regressions = runner.compare(baseline, results, options.threshold)
+    print runner.format_comparison(rows, options.threshold)
+    if regressions:
+        print '\n%s regression(s) above %.0f%%' % (len(regressions),
+                                                   options.threshold * 100)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,143 @@
+"""Runs benchmarks and compares their results.
+
+Results are stored as json::
+
+    {"python": "2.7.18", "platform": "...",
+     "benchmarks": {"utils.smart_str": {"best": 1.2e-06,
+                                        "median": 1.3e-06,
+                                        "number": 131072, "repeat": 5}}}
+
+``best`` and ``median`` are seconds per call. Comparisons use ``best``,
+which is the least sensitive to noise from other processes.
+"""
+
+import contextlib
+import os
+import platform
+import re
+import sys
+import timeit
+
+from open_facebook.utils import json
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+registry = []
+
+
+class Benchmark(object):
+    """
+    :param name: dotted name, like ``signed_request.parse``
+    :param setup: context manager yielding the function to time
+    """
+    def __init__(self, name, setup):
+        self.name = name
+        self.setup = setup
+
+    def calibrate(self, function, min_time):
+        """Returns the number of calls taking at least ``min_time``"""
+        timer = timeit.Timer(function)
+        number = 1
+        while True:
+            if timer.timeit(number) >= min_time or number >= 1 << 24:
+                return number
+            number *= 2
+
+    def run(self, repeat=5, min_time=0.1):
+        with self.setup() as function:
+            number = self.calibrate(function, min_time)
+            timings = timeit.Timer(function).repeat(repeat, number)
+        timings = sorted([t / number for t in timings])
+        return dict(best=timings[0], median=timings[len(timings) // 2],
+                    number=number, repeat=repeat)
+
+
+def benchmark(name):
+    """Registers a benchmark. The decorated function is a generator,
+    setting up, yielding the function to time and cleaning up::
+
+        @benchmark('utils.smart_str')
+        def smart_str_unicode():
+            yield lambda: smart_str(u'J\\xe9r\\xf4me')
+    """
+    def decorator(function):
+        registry.append(Benchmark(name, contextlib.contextmanager(function)))
+        return function
+    return decorator
+
+
+def get_benchmarks(pattern=None):
+    """Returns the registered benchmarks matching the ``pattern`` regexp"""
+    import open_facebook.benchmarks.suite
+    return [b for b in registry
+            if pattern is None or re.search(pattern, b.name)]
+
+
+def run(pattern=None, repeat=5, min_time=0.1, stream=None):
+    """Runs the benchmarks and returns the results"""
+    benchmarks = {}
+    for bench in get_benchmarks(pattern):
+        benchmarks[bench.name] = result = bench.run(repeat, min_time)
+        if stream is not None:
+            stream.write('%-40s %12s\n' % (bench.name,
+                                           format_time(result['best'])))
+    return dict(python=platform.python_version(),
+                platform=platform.platform(), benchmarks=benchmarks)
+
+
+def compare(baseline, results, threshold=0.1):
+    """Returns ``(name, baseline, result, change)`` tuples for all
+    benchmarks present in both, and a list of the regressions, the
+    tuples whose change exceeds ``threshold``
+    """
+    rows = []
+    regressions = []
+    for name in sorted(results['benchmarks']):
+        if name not in baseline['benchmarks']:
+            continue
+        before = baseline['benchmarks'][name]['best']
+        after = results['benchmarks'][name]['best']
+        row = (name, before, after, after / before - 1)
+        rows.append(row)
+        if row[3] > threshold:
+            regressions.append(row)
+    return rows, regressions
+
+
+def format_time(seconds):
+    for unit, factor in (('s', 1), ('ms', 1e3), ('us', 1e6)):
+        if seconds >= 1 / factor:
+            return '%.2f%s' % (seconds * factor, unit)
+    return '%.0fns' % (seconds * 1e9)
+
+
+def format_comparison(rows, threshold=0.1):
+    lines = ['%-40s %12s %12s %8s' % ('benchmark', 'baseline', 'result',
+                                      'change')]
+    for name, before, after, change in rows:
+        flag = ' REGRESSION' if change > threshold else ''
+        lines.append('%-40s %12s %12s %+7.1f%%%s' % (
+            name, format_time(before), format_time(after), change * 100,
+            flag))
+    return '\n'.join(lines)
+
+
+def load(path=BASELINE_PATH):
+    results_file = open(path)
+    try:
+        return json.load(results_file)
+    finally:
+        results_file.close()
+
+
+def save(results, path):
+    if path == '-':
+        json.dump(results, sys.stdout, indent=1, sort_keys=True,
+                  separators=(',', ': '))
+        return
+    results_file = open(path, 'w')
+    try:
+        json.dump(results, results_file, indent=1, sort_keys=True,
+                  separators=(',', ': '))
+    finally:
+        results_file.close()
@@ -0,0 +1,173 @@
+"""The benchmarks, grouped by the prefix of their name.
+
+The ``request`` benchmarks send full ``_request`` round trips to a
+:class:`open_facebook.tests_utils.fake_graph.FakeGraph`, either in-process
+(measuring the client overhead) or over http on localhost (adding the
+connection pool and the socket work). The response cache, request
+coalescing and rate limiting are disabled for them, so every call
+reaches the fake server.
+"""
+
+import base64
+import hashlib
+import hmac
+
+from open_facebook import exceptions as facebook_exceptions
+from open_facebook.api import FacebookAuthorization, OpenFacebook
+from open_facebook.benchmarks.runner import benchmark
+from open_facebook.tests_utils.fake_graph import (FakeGraph, FakeGraphPool,
+                                                  FakeGraphServer)
+from open_facebook.utils import (base64_url_decode_php_style, encode_params,
+                                 json, merge_urls, smart_str)
+
+SECRET = 'b5fb6d43fa4c7a8bbb5d8c7f2f0b6fd1'
+
+
+def base64_url_encode(data):
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+
+def make_signed_request(data, secret=SECRET):
+    payload = base64_url_encode(json.dumps(data))
+    signature = hmac.new(secret, payload, hashlib.sha256).digest()
+    return '%s.%s' % (base64_url_encode(signature), payload)
+
+
+SIGNED_DATA = dict(
+    algorithm='HMAC-SHA256', expires=1330000000, issued_at=1329994512,
+    oauth_token='AAAB' + 'x' * 100, user_id='100000000000001',
+    user=dict(country='nl', locale='en_US', age=dict(min=21)))
+
+
+## signed requests
+
+@benchmark('signed_request.parse')
+def parse_signed_request():
+    signed_request = make_signed_request(SIGNED_DATA)
+    yield lambda: FacebookAuthorization.parse_signed_data(signed_request,
+                                                          SECRET)
+
+
+@benchmark('signed_request.parse_invalid')
+def parse_invalid_signed_request():
+    signed_request = make_signed_request(SIGNED_DATA, secret='wrong')
+    yield lambda: FacebookAuthorization.parse_signed_data(signed_request,
+                                                          SECRET)
+
+
+@benchmark('signed_request.verify_signature')
+def verify_signature():
+    payload = make_signed_request(SIGNED_DATA).split('.', 1)[1]
+    signature = FacebookAuthorization.calculate_signature(payload, SECRET)
+    yield lambda: FacebookAuthorization.verify_signature(payload, SECRET,
+                                                         signature)
+
+
+## error mapping
+
+def raise_error_benchmark(name, error_type, message):
+    def raise_error():
+        def function():
+            try:
+                OpenFacebook.raise_error(error_type, message)
+            except facebook_exceptions.OpenFacebookException:
+                pass
+        yield function
+    benchmark('raise_error.%s' % name)(raise_error)
+
+
+raise_error_benchmark('by_type', 'OAuthException',
+                      'Error validating access token.')
+raise_error_benchmark('by_code', 'OAuthException',
+                      '(#341) Feed action request limit reached')
+raise_error_benchmark('by_message', 'OAuthException',
+                      'Missing redirect_uri parameter.')
+raise_error_benchmark('fallback', 'SomethingNew',
+                      'An unknown error occurred')
+raise_error_benchmark('fql_code', 200, 'Permissions error')
+
+
+## utils
+
+@benchmark('utils.encode_params')
+def encode_params_benchmark():
+    params = dict(message=u'J\xe9r\xf4me was here', limit=25, offset=50,
+                  fields='id,name,email', access_token='AAAB' + 'x' * 100)
+    yield lambda: encode_params(params)
+
+
+@benchmark('utils.smart_str.unicode')
+def smart_str_unicode():
+    yield lambda: smart_str(u'J\xe9r\xf4me Schellenbach')
+
+
+@benchmark('utils.smart_str.int')
+def smart_str_int():
+    yield lambda: smart_str(1234567890)
+
+
+@benchmark('utils.merge_urls')
+def merge_urls_benchmark():
+    generated = 'http://mysite.com?p1=a&p2=b&p3=c&p4=d&flag'
+    human = 'http://mysite.com?p4=D&p3=C&p2=B&flag'
+    yield lambda: merge_urls(generated, human)
+
+
+@benchmark('utils.base64_url_decode_php_style')
+def base64_url_decode():
+    encoded = make_signed_request(SIGNED_DATA).split('.', 1)[1]
+    yield lambda: base64_url_decode_php_style(encoded)
+
+
+## request round trips
+
+class BenchmarkOpenFacebook(OpenFacebook):
+    response_cache = None
+    single_flight = None
+    rate_limiter = None
+
+
+def get_fake_graph():
+    graph = FakeGraph(app_secret=SECRET)
+    likes = [dict(id=str(i), name='Like %s' % i, category='Musician/band',
+                  created_time='2012-01-01T00:00:00+0000')
+             for i in range(200)]
+    token = graph.add_user(
+        dict(id='1', name='Thierry Schellenbach', first_name='Thierry',
+             last_name='Schellenbach', email='thierry@example.com',
+             locale='en_US', gender='male'), likes=likes)
+    return graph, token
+
+
+@benchmark('request.in_process.me')
+def request_in_process():
+    graph, token = get_fake_graph()
+    facebook = BenchmarkOpenFacebook(token)
+    with FakeGraphPool(graph):
+        yield lambda: facebook.get('me')
+
+
+@benchmark('request.localhost.me')
+def request_localhost():
+    graph, token = get_fake_graph()
+    server = FakeGraphServer(graph).start()
+    facebook = BenchmarkOpenFacebook(token)
+    facebook.api_url = server.base_url
+    try:
+        yield lambda: facebook.get('me')
+    finally:
+        server.stop()
+        facebook.connection_pool.clear()
+
+
+@benchmark('request.localhost.likes')
+def request_localhost_likes():
+    graph, token = get_fake_graph()
+    server = FakeGraphServer(graph).start()
+    facebook = BenchmarkOpenFacebook(token)
+    facebook.api_url = server.base_url
+    try:
+        yield lambda: facebook.get('me/likes', limit=200)
+    finally:
+        server.stop()
+        facebook.connection_pool.clear()
@@ -0,0 +1,431 @@
+"""Read-through caching of Graph API responses.
+
+The :class:`ResponseCache` keeps successful GET responses in two tiers:
+
+- a bounded in-process LRU (:class:`LRUCache`)
+- optionally any configured Django cache, shared between processes
+
+Keys are built from the host, path, normalized parameters and a hash of
+the access token, so tokens never end up in a cache key. Writes
+(``set``/``delete``) to a path invalidate the cached reads of that path
+and its object for the same token.
+
+Responses are stored with their ETag. Once expired they are kept for
+another ``revalidate_timeout`` seconds, and revalidated with
+``If-None-Match`` instead of downloaded again: a ``304 Not Modified``
+makes the cached body fresh again.
+
+Enable it using the ``FACEBOOK_CACHE_*`` settings, for example::
+
+    FACEBOOK_CACHE_ENABLED = True
+    FACEBOOK_CACHE_BACKEND = 'default'
+    FACEBOOK_CACHE_TIMEOUTS = [(r'^me/permissions$', 300), (r'^me/feed', 0)]
+
+The :class:`ProfileCache` keeps the profiles returned by
+``OpenFacebook.me`` between requests, enable it using the
+``FACEBOOK_PROFILE_CACHE_*`` settings.
+"""
+
+import hashlib
+import itertools
+import logging
+import re
+import threading
+import time
+import urllib
+import urlparse
+
+from open_facebook.utils import get_django_cache
+
+logger = logging.getLogger(__name__)
+
+## Responses containing tokens, and requests keyed by secrets and codes
+NEVER_CACHED_RE = re.compile(r'^oauth/')
+
+
+class LRUCache(object):
+    """Thread-safe, bounded, least recently used cache with per entry
+    expiry.
+    """
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._data = {}
+        ## circular doubly linked list of [prev, next, key]
+        self._root = root = []
+        root[:] = [root, root, None]
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            link, value, expires = item
+            if expires is not None and expires < time.time():
+                self._remove(key)
+                return default
+            ## move to the front
+            prev, next, _ = link
+            prev[1], next[0] = next, prev
+            root = self._root
+            first = root[1]
+            link[0], link[1] = root, first
+            root[1] = first[0] = link
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, timeout=None):
+        expires = time.time() + timeout if timeout is not None else None
+        self._lock.acquire()
+        try:
+            if key in self._data:
+                self._remove(key)
+            root = self._root
+            first = root[1]
+            link = [root, first, key]
+            root[1] = first[0] = link
+            self._data[key] = (link, value, expires)
+            while len(self._data) > self.max_entries:
+                self._remove(root[0][2])
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            if key in self._data:
+                self._remove(key)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._data.clear()
+            root = self._root
+            root[:] = [root, root, None]
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _remove(self, key):
+        link, value, expires = self._data.pop(key)
+        prev, next, _ = link
+        prev[1], next[0] = next, prev
+
+
+def hash_token(access_token):
+    """Returns a digest of the access token which is safe to use in keys"""
+    if not access_token:
+        return 'anonymous'
+    return hashlib.sha1(access_token).hexdigest()
+
+
+class CachedRequest(object):
+    """The cache keys and timeout for a single Graph GET"""
+    def __init__(self, host, path, params, access_token, timeout):
+        self.host = host
+        self.path = path
+        self.params = params
+        self.token_hash = hash_token(access_token)
+        self.timeout = timeout
+        query = urllib.urlencode(sorted(params))
+        self.params_hash = hashlib.sha1(query).hexdigest()
+
+    def scope_key(self, path=None):
+        """Key of the version counter which invalidates all cached
+        variants of ``path`` for this token
+        """
+        path = self.path if path is None else path
+        digest = hashlib.sha1('%s/%s' % (self.host, path)).hexdigest()
+        return 'open_facebook:version:%s:%s' % (digest, self.token_hash)
+
+    def entry_key(self, version):
+        return 'open_facebook:response:%s:%s' % (
+            self.scope_key()[len('open_facebook:version:'):],
+            hashlib.sha1('%s:%s' % (version, self.params_hash)).hexdigest())
+
+
+class ResponseCache(object):
+    """Two tier cache for raw Graph API response bodies.
+
+    :param max_entries: size of the in-process LRU
+    :param backend: name of a Django cache to use as second tier, or
+        ``None`` to only cache in-process
+    :param timeout: default number of seconds responses are cached
+    :param timeouts: list of ``(regex, timeout)`` rules matched against
+        the path, the first match wins. A timeout of 0 disables caching.
+        ``oauth/`` responses are never cached.
+    :param revalidate_timeout: how many seconds expired responses with an
+        ETag are kept for revalidation using ``If-None-Match``
+    """
+    def __init__(self, max_entries=1000, backend=None, timeout=60,
+                 timeouts=None, revalidate_timeout=3600):
+        self.local = LRUCache(max_entries)
+        self.backend_name = backend
+        self._backend = None
+        self.timeout = timeout
+        self.timeouts = [(re.compile(pattern), t)
+                         for pattern, t in (timeouts or [])]
+        self.revalidate_timeout = revalidate_timeout
+        self._versions = itertools.count(int(time.time() * 1000))
+        self._lock = threading.Lock()
+        self.counters = dict(hits=0, local_hits=0, shared_hits=0, misses=0,
+                             stale=0, revalidations=0, invalidations=0)
+
+    @property
+    def backend(self):
+        if self._backend is None and self.backend_name:
+            self._backend = get_django_cache(self.backend_name)
+        return self._backend
+
+    def get_timeout(self, path):
+        if NEVER_CACHED_RE.search(path):
+            return 0
+        for pattern, timeout in self.timeouts:
+            if pattern.search(path):
+                return timeout
+        return self.timeout
+
+    def parse(self, url):
+        """Splits ``url`` into a :class:`CachedRequest`"""
+        scheme, host, path, query, fragment = urlparse.urlsplit(url)
+        params = urlparse.parse_qsl(query, keep_blank_values=True)
+        access_token = None
+        filtered_params = []
+        for k, v in params:
+            if k == 'access_token':
+                access_token = v
+            else:
+                filtered_params.append((k, v))
+        path = path.lstrip('/')
+        return CachedRequest(host, path, filtered_params, access_token,
+                             self.get_timeout(path))
+
+    def lookup(self, request):
+        """Returns ``(body, etag, fresh)`` for ``request`` or ``None``.
+
+        Expired responses with an ETag are kept for another
+        ``revalidate_timeout`` seconds, so they can be revalidated.
+        """
+        entry_key = request.entry_key(self._version(request))
+        entry = self.local.get(entry_key)
+        tier = 'local_hits'
+        if entry is None:
+            backend = self.backend
+            if backend is not None:
+                entry = backend.get(entry_key)
+                tier = 'shared_hits'
+                if isinstance(entry, basestring):
+                    ## stored by an older version, without an ETag
+                    entry = (entry, None, time.time() + request.timeout)
+                if entry is not None:
+                    self.local.set(entry_key, entry,
+                                   self._get_lifetime(request, entry[1]))
+
+        if entry is None:
+            self._count('misses')
+            return None
+        body, etag, fresh_until = entry
+        fresh = fresh_until > time.time()
+        if fresh:
+            self._count('hits', tier)
+        else:
+            self._count('stale')
+        return body, etag, fresh
+
+    def get(self, request):
+        """Returns the fresh cached body for ``request`` or ``None``"""
+        entry = self.lookup(request)
+        if entry is not None and entry[2]:
+            return entry[0]
+
+    def set(self, request, body, etag=None):
+        if not request.timeout:
+            return
+        entry = (body, etag, time.time() + request.timeout)
+        lifetime = self._get_lifetime(request, etag)
+        entry_key = request.entry_key(self._version(request))
+        self.local.set(entry_key, entry, lifetime)
+        backend = self.backend
+        if backend is not None:
+            backend.set(entry_key, entry, lifetime)
+
+    def revalidated(self, request, body, etag):
+        """Facebook confirmed the cached body is still valid"""
+        self._count('revalidations')
+        self.set(request, body, etag)
+
+    def invalidate(self, request):
+        """Drops cached reads of the path and the object it belongs to
+        (``me/feed`` also invalidates ``me``) for the same token.
+        """
+        self._count('invalidations')
+        paths = set([request.path, request.path.split('/', 1)[0]])
+        for path in paths:
+            scope_key = request.scope_key(path)
+            self.local.set(scope_key, self._new_version())
+            backend = self.backend
+            if backend is not None:
+                backend.set(scope_key, self._new_version(),
+                            self._max_timeout())
+
+    def stats(self):
+        """Returns a copy of the hit/miss counters"""
+        self._lock.acquire()
+        try:
+            return dict(self.counters)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self.local.clear()
+
+    def _count(self, *names):
+        self._lock.acquire()
+        try:
+            for name in names:
+                self.counters[name] += 1
+        finally:
+            self._lock.release()
+
+    def _new_version(self):
+        self._lock.acquire()
+        try:
+            return self._versions.next()
+        finally:
+            self._lock.release()
+
+    def _max_timeout(self):
+        return max([self.timeout] + [t for p, t in self.timeouts]) + \
+            self.revalidate_timeout
+
+    def _get_lifetime(self, request, etag):
+        if etag:
+            return request.timeout + self.revalidate_timeout
+        return request.timeout
+
+    def _version(self, request):
+        """The version of the cached reads of ``request``'s path. With a
+        backend it is the shared one, also for the in-process entries, so
+        writes in other processes invalidate them too.
+        """
+        if self.backend is not None:
+            return self._shared_version(request)
+        return self._local_version(request)
+
+    def _local_version(self, request):
+        scope_key = request.scope_key()
+        version = self.local.get(scope_key)
+        if version is None:
+            ## an evicted version must never resurrect older entries,
+            ## so start from a fresh one
+            version = self._new_version()
+            self.local.set(scope_key, version)
+        return version
+
+    def _shared_version(self, request):
+        backend = self.backend
+        scope_key = request.scope_key()
+        version = backend.get(scope_key)
+        if version is None:
+            backend.add(scope_key, self._new_version(), self._max_timeout())
+            version = backend.get(scope_key)
+        return version
+
+
+class ProfileCache(object):
+    """Two tier cache for ``me`` profiles, shared between requests.
+
+    Profiles are stored by facebook id, and found using a hash of the
+    access token which maps to that id. Copies are returned, so callers
+    can add to the profiles they get.
+
+    :param max_entries: size of the in-process LRU
+    :param backend: name of a Django cache to use as second tier, or
+        ``None`` to only cache in-process
+    :param timeout: number of seconds profiles are cached
+    """
+    def __init__(self, max_entries=1000, backend=None, timeout=300):
+        self.local = LRUCache(max_entries)
+        self.backend_name = backend
+        self._backend = None
+        self.timeout = timeout
+
+    @property
+    def backend(self):
+        if self._backend is None and self.backend_name:
+            self._backend = get_django_cache(self.backend_name)
+        return self._backend
+
+    @classmethod
+    def get_key(cls, facebook_id):
+        return 'open_facebook:profile:%s' % facebook_id
+
+    @classmethod
+    def get_token_key(cls, access_token):
+        return 'open_facebook:profile_token:%s' % hash_token(access_token)
+
+    def get(self, access_token, fields=None):
+        """Returns ``(fields, profile)``, ``fields`` being those the
+        profile was requested with, or ``None`` if there is no profile
+        including all of the requested ``fields``
+        """
+        facebook_id = self._get(self.get_token_key(access_token))
+        if facebook_id is None:
+            return None
+        entry = self._get(self.get_key(facebook_id))
+        if entry is None:
+            return None
+        cached_fields, profile = entry
+        if fields and cached_fields is not None \
+                and not set(fields) <= set(cached_fields):
+            return None
+        return cached_fields, dict(profile)
+
+    def set(self, access_token, profile, fields=None):
+        """Stores the profile of ``access_token``, requested with
+        ``fields``. Profiles without an id are not stored.
+        """
+        facebook_id = profile.get('id')
+        if not facebook_id:
+            return
+        self._set(self.get_token_key(access_token), facebook_id)
+        self._set(self.get_key(facebook_id),
+                  (list(fields) if fields else None, dict(profile)))
+
+    def invalidate(self, facebook_id=None, access_token=None):
+        """Drops the profile of ``facebook_id`` and or ``access_token``"""
+        if access_token:
+            key = self.get_token_key(access_token)
+            facebook_id = facebook_id or self._get(key)
+            self._delete(key)
+        if facebook_id:
+            self._delete(self.get_key(facebook_id))
+
+    def clear(self):
+        self.local.clear()
+
+    def _get(self, key):
+        entry = self.local.get(key)
+        if entry is None and self.backend is not None:
+            entry = self.backend.get(key)
+            if entry is not None:
+                self.local.set(key, entry, entry[0] - time.time())
+        if entry is not None and entry[0] > time.time():
+            return entry[1]
+
+    def _set(self, key, value):
+        entry = (time.time() + self.timeout, value)
+        self.local.set(key, entry, self.timeout)
+        if self.backend is not None:
+            self.backend.set(key, entry, self.timeout)
+
+    def _delete(self, key):
+        self.local.delete(key)
+        if self.backend is not None:
+            self.backend.delete(key)
@@ -2,6 +2,9 @@
 Facebook error classes also see
 http://fbdevwiki.com/wiki/Error_codes#User_Permission_Errors
 '''
+import bisect
+import re
+import urllib2
 
 
 class OpenFacebookException(Exception):
@@ -92,3 +95,161 @@ class AliasException(OpenFacebookException):
     instead of a 404....
     '''
     codes = 803
+
+
+class RateLimitException(OpenFacebookException):
+    '''
+    Raised before contacting Facebook when a client side rate limit
+    (see ``open_facebook.ratelimit``) ran out, ``retry_after`` is the
+    number of seconds until the next request is allowed
+    '''
+    def __init__(self, bucket, retry_after):
+        OpenFacebookException.__init__(
+            self, '%s rate limit reached, retry in %.2f seconds' % (
+                bucket, retry_after))
+        self.bucket = bucket
+        self.retry_after = retry_after
+
+
+class CircuitOpenException(urllib2.URLError):
+    '''
+    Raised without contacting Facebook when too many recent requests to
+    the same part of the Graph API failed. Subclasses ``URLError`` so
+    code handling Facebook being down keeps working.
+    '''
+    def __init__(self, family):
+        urllib2.URLError.__init__(
+            self, 'circuit open for %s, failing fast' % family)
+        self.family = family
+
+
+class ErrorCodeIndex(object):
+    '''
+    Lookup structure mapping Facebook error codes and messages to the most
+    specific exception class, compiled once instead of on every error
+
+    - an exact code dict, which already knows about overlapping ranges
+    - a sorted table of non overlapping intervals for the ranges
+    - one regex to quickly reject messages without any string code
+
+    Matches follow the same rules as ``OpenFacebookException.range()``:
+    the class matching the fewest codes wins, ties are broken by name.
+    '''
+
+    def __init__(self, exception_classes=()):
+        self._classes = {}
+        self._index = None
+        for exception_class in exception_classes:
+            self._classes[exception_class] = True
+
+    def register(self, exception_class):
+        '''
+        Adds a custom exception class, it will be matched using its
+        ``codes`` just like the built in ones
+        '''
+        if not issubclass(exception_class, OpenFacebookException):
+            raise ValueError('%s is not an OpenFacebookException' %
+                             exception_class)
+        self._classes[exception_class] = True
+        self._index = None
+
+    def match(self, message, error_code=None):
+        '''
+        Returns the most specific class for the given message and numeric
+        error code, or None
+        '''
+        index = self._index
+        if index is None:
+            index = self._index = self._build()
+        exact, starts, segments, strings, strings_re = index
+
+        best = None
+        if error_code is not None:
+            best = exact.get(error_code)
+            if best is None:
+                position = bisect.bisect_right(starts, error_code) - 1
+                if position >= 0:
+                    start, stop, candidate = segments[position]
+                    if error_code <= stop:
+                        best = candidate
+
+        if strings_re is not None and strings_re.search(message):
+            for candidate in strings:
+                if best is not None and candidate[:2] >= best[:2]:
+                    break
+                if candidate[3] in message:
+                    best = candidate
+                    break
+
+        if best is not None:
+            return best[2]
+
+    def _build(self):
+        exact = {}
+        intervals = []
+        strings = []
+        for exception_class in self._classes:
+            if not getattr(exception_class, 'codes', None):
+                continue
+            priority = (exception_class.range(), exception_class.__name__)
+            for code in exception_class.codes_list():
+                if isinstance(code, basestring):
+                    strings.append(priority + (exception_class, code))
+                elif isinstance(code, tuple):
+                    start, stop = code
+                    intervals.append((start, stop, priority + (
+                        exception_class, )))
+                elif isinstance(code, (int, long)):
+                    entry = priority + (exception_class, )
+                    if code not in exact or entry[:2] < exact[code][:2]:
+                        exact[code] = entry
+                else:
+                    raise ValueError('Dont know how to handle %s of '
+                                     'type %s' % (code, type(code)))
+
+        ## split overlapping ranges into segments with a single winner
+        boundaries = set()
+        for start, stop, entry in intervals:
+            boundaries.add(start)
+            boundaries.add(stop + 1)
+        boundaries = sorted(boundaries)
+        segments = []
+        for start, next_start in zip(boundaries, boundaries[1:]):
+            candidates = [e for s, t, e in intervals if s <= start <= t]
+            if candidates:
+                segments.append((start, next_start - 1, min(candidates)))
+
+        ## exact codes inside a more specific range lose to that range
+        for code, entry in exact.items():
+            for start, stop, candidate in segments:
+                if start <= code <= stop and candidate[:2] < entry[:2]:
+                    exact[code] = candidate
+
+        strings.sort()
+        strings_re = None
+        if strings:
+            strings_re = re.compile('|'.join(
+                [re.escape(s[3]) for s in strings]))
+        starts = [s[0] for s in segments]
+        return exact, starts, segments, strings, strings_re
+
+
+def get_exception_classes():
+    '''
+    Returns all exception classes with error codes defined in this module
+    '''
+    classes = [globals()[name] for name in sorted(globals())]
+    return [c for c in classes if isinstance(c, type) and issubclass(
+        c, OpenFacebookException) and getattr(c, 'codes', None)]
+
+
+error_index = ErrorCodeIndex(get_exception_classes())
+
+
+def register_exception(exception_class):
+    '''
+    Makes ``FacebookConnection.raise_error`` aware of a custom exception
+    class
+    '''
+    error_index.register(exception_class)
+    return exception_class
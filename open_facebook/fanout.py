@@ -0,0 +1,109 @@
+"""Runs independent Graph calls in parallel.
+
+Used by :meth:`open_facebook.api.OpenFacebook.map`. Every call runs in one
+of a small number of worker threads, which all share the process wide
+connection pool. A process wide semaphore caps the number of calls running
+at the same time, so one big fan-out can't starve everything else.
+
+:class:`BackgroundCall` runs a single call in the background, which
+:meth:`open_facebook.api.OpenFacebook.iterate` uses to prefetch pages.
+"""
+
+import logging
+import threading
+
+from django_facebook import settings as facebook_settings
+
+logger = logging.getLogger(__name__)
+
+## Shared by all fan-outs in this process
+concurrency_limit = threading.BoundedSemaphore(
+    facebook_settings.FACEBOOK_MAX_PARALLEL_REQUESTS)
+
+_local = threading.local()
+
+
+def fan_out(function, arguments, max_workers):
+    """Calls ``function(argument)`` for every item in ``arguments`` using
+    at most ``max_workers`` threads.
+
+    :returns: the results in the order of ``arguments``. Calls which
+        raised are represented by their exception instead.
+    """
+    arguments = list(arguments)
+    results = [None] * len(arguments)
+    workers = min(max_workers or 1, len(arguments))
+
+    ## Fan-outs started from within a fan-out run inline, waiting for
+    ## the semaphore we are holding ourselves would dead lock
+    if workers <= 1 or getattr(_local, 'active', False):
+        for index, argument in enumerate(arguments):
+            results[index] = _call(function, argument)
+        return results
+
+    pending = list(enumerate(arguments))
+    pending.reverse()
+    lock = threading.Lock()
+
+    def worker():
+        _local.active = True
+        while True:
+            lock.acquire()
+            try:
+                if not pending:
+                    return
+                index, argument = pending.pop()
+            finally:
+                lock.release()
+            concurrency_limit.acquire()
+            try:
+                results[index] = _call(function, argument)
+            finally:
+                concurrency_limit.release()
+
+    threads = [threading.Thread(target=worker) for i in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class BackgroundCall(object):
+    """Starts ``function(*args, **kwargs)`` in a background thread,
+    :meth:`result` waits for it and returns or raises its outcome.
+    """
+    def __init__(self, function, *args, **kwargs):
+        self._result = self._exception = None
+        ## started from a fan-out worker, which already holds a slot
+        self._limited = not getattr(_local, 'active', False)
+        self._thread = threading.Thread(target=self._run,
+                                        args=(function, args, kwargs))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, function, args, kwargs):
+        if self._limited:
+            concurrency_limit.acquire()
+        try:
+            self._result = function(*args, **kwargs)
+        except Exception, e:
+            self._exception = e
+        finally:
+            if self._limited:
+                concurrency_limit.release()
+
+    def result(self):
+        self._thread.join()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+def _call(function, argument):
+    try:
+        return function(argument)
+    except Exception, e:
+        logger.info('parallel call %r failed with %r', argument, e)
+        return e
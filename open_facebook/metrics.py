@@ -0,0 +1,216 @@
+"""Metrics about the requests Open Facebook sends.
+
+``FacebookConnection.metrics`` receives:
+
+- ``request.latency``: histogram of the seconds per attempt, by endpoint
+- ``request.attempts`` and ``request.retries``: counters by endpoint
+- ``request.bytes_sent``, ``response.bytes_received`` and
+  ``response.bytes_decoded``: counters by endpoint
+- ``errors``: counter by exception class, for mapped Facebook errors and
+  transport errors
+- ``cache.hits`` and ``cache.misses``: counters by endpoint
+
+Endpoints are the first two segments of the path with object ids
+replaced by ``:id``, like ``me/likes`` or ``:id/comments``.
+
+Pick a backend using ``FACEBOOK_METRICS_BACKEND``:
+
+- ``None``: :class:`NullMetrics`, nothing is recorded
+- ``'memory'``: :class:`MemoryMetrics`, counters and histograms in this
+  process
+- ``'prometheus'``: :class:`PrometheusMetrics`, which can render them in
+  the Prometheus text format
+- ``'statsd'``: :class:`StatsdMetrics`, requires the statsd package
+- the dotted path of your own :class:`NullMetrics` subclass
+"""
+
+import bisect
+import logging
+import threading
+
+from django_facebook import settings as facebook_settings
+
+logger = logging.getLogger(__name__)
+
+## upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class NullMetrics(object):
+    """Records nothing, and the base class of the other backends.
+
+    Callers skip computing tags when ``enabled`` is ``False``, so
+    disabled metrics cost next to nothing.
+    """
+    enabled = False
+
+    def increment(self, name, value=1, **tags):
+        pass
+
+    def observe(self, name, value, **tags):
+        pass
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class MemoryMetrics(NullMetrics):
+    """Keeps counters and histograms in this process"""
+    enabled = True
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    @classmethod
+    def get_key(cls, name, tags):
+        return (name, tuple(sorted(tags.items())))
+
+    def increment(self, name, value=1, **tags):
+        key = self.get_key(name, tags)
+        self._lock.acquire()
+        try:
+            self.counters[key] = self.counters.get(key, 0) + value
+        finally:
+            self._lock.release()
+
+    def observe(self, name, value, **tags):
+        key = self.get_key(name, tags)
+        self._lock.acquire()
+        try:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+        finally:
+            self._lock.release()
+
+    def get_counter(self, name, **tags):
+        return self.counters.get(self.get_key(name, tags), 0)
+
+    def get_histogram(self, name, **tags):
+        return self.histograms.get(self.get_key(name, tags))
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self.counters.clear()
+            self.histograms.clear()
+        finally:
+            self._lock.release()
+
+
+class PrometheusMetrics(MemoryMetrics):
+    """:class:`MemoryMetrics` which can be exported in the Prometheus
+    text format, serve :meth:`render` from a view to get scraped
+    """
+    prefix = 'facebook_'
+
+    @classmethod
+    def format_name(cls, name):
+        return cls.prefix + name.replace('.', '_')
+
+    @classmethod
+    def format_labels(cls, labels):
+        if not labels:
+            return ''
+        return '{%s}' % ','.join(['%s="%s"' % (
+            k, unicode(v).replace('\\', '\\\\').replace('"', '\\"'))
+            for k, v in labels])
+
+    def render(self):
+        self._lock.acquire()
+        try:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+        finally:
+            self._lock.release()
+
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            name = self.format_name(name) + '_total'
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s counter' % name)
+            lines.append('%s%s %s' % (name, self.format_labels(labels),
+                                      value))
+        for (name, labels), histogram in histograms:
+            name = self.format_name(name)
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s histogram' % name)
+            cumulative = 0
+            bounds = [repr(float(b)) for b in histogram.buckets] + ['+Inf']
+            for bound, count in zip(bounds, histogram.counts):
+                cumulative += count
+                lines.append('%s_bucket%s %s' % (name, self.format_labels(
+                    labels + (('le', bound), )), cumulative))
+            lines.append('%s_sum%s %r' % (name, self.format_labels(labels),
+                                          histogram.sum))
+            lines.append('%s_count%s %s' % (
+                name, self.format_labels(labels), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+class StatsdMetrics(NullMetrics):
+    """Sends the metrics to statsd, tags become part of the name:
+    ``facebook.request.latency.me_likes``
+
+    :param client: a statsd client with ``incr`` and ``timing`` methods,
+        defaults to ``statsd.StatsClient()``
+    """
+    enabled = True
+
+    def __init__(self, client=None, prefix='facebook'):
+        if client is None:
+            from statsd import StatsClient
+            client = StatsClient()
+        self.client = client
+        self.prefix = prefix
+
+    def format_name(self, name, tags):
+        parts = [self.prefix, name]
+        for key, value in sorted(tags.items()):
+            parts.append(unicode(value).replace('.', '_').replace(
+                '/', '_').replace(':', ''))
+        return '.'.join(parts)
+
+    def increment(self, name, value=1, **tags):
+        self.client.incr(self.format_name(name, tags), value)
+
+    def observe(self, name, value, **tags):
+        ## statsd timings are in milliseconds
+        self.client.timing(self.format_name(name, tags), value * 1000)
+
+
+METRICS_BACKENDS = {
+    'memory': MemoryMetrics,
+    'prometheus': PrometheusMetrics,
+    'statsd': StatsdMetrics,
+}
+
+
+def get_metrics(backend=None):
+    """Returns an instance of the configured metrics backend"""
+    if backend is None:
+        backend = facebook_settings.FACEBOOK_METRICS_BACKEND
+    if not backend:
+        return NullMetrics()
+    backend_class = METRICS_BACKENDS.get(backend)
+    if backend_class is None:
+        from django_facebook.utils import get_class_from_string
+        backend_class = get_class_from_string(backend)
+    return backend_class()
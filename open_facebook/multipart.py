@@ -0,0 +1,196 @@
+"""Streaming ``multipart/form-data`` bodies, for photo and video uploads.
+
+Pass open files as parameters to ``OpenFacebook.set`` to upload them::
+
+    facebook.set('me/photos', source=open('photo.jpg', 'rb'),
+                 message='Photo from disk')
+
+Wrap them in an :class:`Upload` to set the filename or content type, or
+to follow the progress::
+
+    def progress(sent, total):
+        print '%s of %s bytes' % (sent, total)
+
+    facebook.set('me/videos', source=Upload(video_file, progress=progress))
+
+The body is read from the files in chunks while it is being sent, so
+large uploads don't end up in memory. Anything with a ``read`` method
+works: files, ``mmap`` objects, Django's ``UploadedFile``, ``StringIO``.
+Their size has to be known up front, as Facebook requires a
+``Content-Length``.
+"""
+
+import mimetypes
+import os
+import uuid
+
+from open_facebook.utils import smart_str
+
+
+def is_file(value):
+    return isinstance(value, Upload) or (
+        hasattr(value, 'read') and not isinstance(value, basestring))
+
+
+def has_files(params):
+    """Whether ``params`` need to be sent as a multipart body"""
+    if not params:
+        return False
+    for value in params.values():
+        if is_file(value):
+            return True
+    return False
+
+
+class Upload(object):
+    """A file to upload, read from its current position.
+
+    :param fileobj: the file-like object to read from
+    :param filename: defaults to the name of ``fileobj``
+    :param content_type: defaults to a guess based on the filename
+    :param progress: called as ``progress(sent, total)`` after every chunk
+    """
+    def __init__(self, fileobj, filename=None, content_type=None,
+                 progress=None):
+        self.fileobj = fileobj
+        if filename is None:
+            filename = os.path.basename(getattr(fileobj, 'name', None)
+                                        or '') or 'upload'
+        self.filename = filename
+        self.content_type = content_type or \
+            mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        self.progress = progress
+        self.start = self._tell()
+        self.size = self._get_size()
+        self.sent = 0
+
+    def _tell(self):
+        try:
+            return self.fileobj.tell()
+        except (AttributeError, IOError, ValueError):
+            return None
+
+    def _get_size(self):
+        fileobj = self.fileobj
+        start = self.start or 0
+        try:
+            return os.fstat(fileobj.fileno()).st_size - start
+        except (AttributeError, IOError, OSError, ValueError):
+            pass
+        try:
+            ## mmap objects
+            return len(fileobj) - start
+        except (AttributeError, TypeError):
+            pass
+        if self.start is not None:
+            fileobj.seek(0, os.SEEK_END)
+            size = fileobj.tell() - start
+            fileobj.seek(start)
+            return size
+        raise ValueError('Cannot determine the size of %r' % fileobj)
+
+    def read(self, amt):
+        amt = min(amt, self.size - self.sent)
+        if amt <= 0:
+            return ''
+        data = self.fileobj.read(amt)
+        if not data:
+            raise IOError('%s ended after %s of %s bytes' % (
+                self.filename, self.sent, self.size))
+        self.sent += len(data)
+        if self.progress is not None:
+            self.progress(self.sent, self.size)
+        return data
+
+    def rewind(self):
+        if self.sent:
+            if self.start is None:
+                raise IOError('Cannot rewind %s' % self.filename)
+            self.fileobj.seek(self.start)
+            self.sent = 0
+
+
+def quote(value):
+    value = smart_str(value)
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\r', '').replace('\n', '')
+
+
+class MultipartBody(object):
+    """File-like ``multipart/form-data`` body, the files in ``params``
+    are read while it is read. ``httplib`` sends objects like this one
+    in blocks, using ``read``.
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, params, boundary=None):
+        self.boundary = boundary or uuid.uuid4().hex
+        parts = []
+        for key, value in params.items():
+            header = '--%s\r\nContent-Disposition: form-data; name="%s"' % (
+                self.boundary, quote(key))
+            if is_file(value):
+                if not isinstance(value, Upload):
+                    value = Upload(value)
+                parts.append('%s; filename="%s"\r\nContent-Type: %s\r\n\r\n'
+                             % (header, quote(value.filename),
+                                value.content_type))
+                parts.append(value)
+                parts.append('\r\n')
+            else:
+                parts.append('%s\r\n\r\n%s\r\n' % (header, smart_str(value)))
+        parts.append('--%s--\r\n' % self.boundary)
+
+        ## join the consecutive strings
+        self.parts = []
+        for part in parts:
+            if isinstance(part, str) and self.parts and \
+                    isinstance(self.parts[-1], str):
+                self.parts[-1] += part
+            else:
+                self.parts.append(part)
+        self.length = 0
+        for part in self.parts:
+            self.length += part.size if isinstance(part, Upload) \
+                else len(part)
+        self.seek(0)
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary=%s' % self.boundary
+
+    def __len__(self):
+        return self.length
+
+    def read(self, amt=None):
+        """Returns up to ``amt`` bytes, all of them if ``amt`` is None"""
+        if amt is None:
+            chunks = []
+            chunk = self.read(self.chunk_size)
+            while chunk:
+                chunks.append(chunk)
+                chunk = self.read(self.chunk_size)
+            return ''.join(chunks)
+
+        while self._index < len(self.parts):
+            part = self.parts[self._index]
+            if isinstance(part, Upload):
+                data = part.read(amt)
+            else:
+                data = part[self._offset:self._offset + amt]
+                self._offset += len(data)
+            if data:
+                return data
+            self._index += 1
+            self._offset = 0
+        return ''
+
+    def seek(self, offset, whence=0):
+        """Only supports going back to the start, for retries"""
+        if offset or whence:
+            raise IOError('MultipartBody can only seek to the start')
+        for part in self.parts:
+            if isinstance(part, Upload):
+                part.rewind()
+        self._index = 0
+        self._offset = 0
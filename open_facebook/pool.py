@@ -0,0 +1,336 @@
+"""Persistent keep-alive connections for ``open_facebook``.
+
+Every Graph API call used to build a new ``urllib2`` opener, paying a full
+TCP and TLS handshake per request. The :class:`ConnectionPool` keeps a small
+stack of idle ``httplib`` connections per ``(scheme, host)`` so consecutive
+requests to graph.facebook.com (or the old REST api) reuse the same socket.
+Bodies sent with ``Content-Encoding: gzip`` or ``deflate`` are decoded
+while they are read, and the pool keeps track of the bytes received and
+decoded for capacity planning (:meth:`ConnectionPool.stats`).
+
+Example::
+
+    >>> pool = ConnectionPool(maxsize=4)
+    >>> response = pool.urlopen('https://graph.facebook.com/cocacola')
+    >>> body = response.read()
+    >>> response.close()  # hands the connection back to the pool
+"""
+
+import errno
+import httplib
+import logging
+import os
+import select
+import socket
+import threading
+import time
+import urllib2
+import urlparse
+import zlib
+
+from open_facebook.utils import is_write_request
+
+logger = logging.getLogger(__name__)
+
+
+def is_stale_connection_error(error):
+    """Whether ``error`` means the server closed an idle connection before
+    answering, timeouts are left to the retry policy
+    """
+    if isinstance(error, socket.timeout):
+        return False
+    if isinstance(error, httplib.BadStatusLine):
+        return True
+    return isinstance(error, socket.error) and \
+        error.errno in (errno.ECONNRESET, errno.EPIPE)
+
+
+class PooledResponse(object):
+    """File-like wrapper around an ``httplib.HTTPResponse``.
+
+    Mimics the bits of the ``urllib2`` response interface we rely on
+    (``read``, ``info``, ``getcode``, ``close``) and gives the underlying
+    connection back to the pool once the body is fully read and the
+    response is closed. Compressed bodies are decoded incrementally, so
+    ``read(amt)`` returns up to ``amt`` decoded bytes.
+    """
+    def __init__(self, pool, key, connection, response):
+        self._pool = pool
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self.code = response.status
+        self.msg = response.reason
+        self.headers = response.msg
+        self.path = None
+
+        ## transparently decode gzip and deflate bodies
+        self.content_encoding = (response.getheader('content-encoding')
+                                 or '').strip().lower()
+        self._decoder = None
+        if self.content_encoding in ('gzip', 'x-gzip'):
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.content_encoding == 'deflate':
+            self._decoder = zlib.decompressobj()
+        self._decoded = ''
+        self._first_chunk = True
+
+        ## the size of the body on the wire and after decoding
+        self.bytes_received = 0
+        self.bytes_decoded = 0
+
+    def read(self, amt=None):
+        try:
+            if self._decoder is None:
+                data = self._response.read(amt)
+                self.bytes_received += len(data)
+            else:
+                data = self._read_decoded(amt)
+        except (socket.error, httplib.HTTPException, zlib.error), e:
+            self._discard()
+            raise urllib2.URLError(e)
+        self.bytes_decoded += len(data)
+        return data
+
+    def _read_decoded(self, amt=None):
+        chunks = [self._decoded]
+        size = len(self._decoded)
+        while amt is None or size < amt:
+            raw = self._response.read(max(amt, 8192) if amt else None)
+            if not raw:
+                chunks.append(self._decoder.flush())
+                break
+            self.bytes_received += len(raw)
+            data = self._decompress(raw)
+            chunks.append(data)
+            size += len(data)
+        data = ''.join(chunks)
+        if amt is None:
+            self._decoded = ''
+            return data
+        self._decoded = data[amt:]
+        return data[:amt]
+
+    def _decompress(self, raw):
+        try:
+            return self._decoder.decompress(raw)
+        except zlib.error:
+            ## some servers send raw deflate streams without the zlib
+            ## header, which is what "deflate" should have meant
+            if not (self._first_chunk and self.content_encoding == 'deflate'):
+                raise
+            self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self._decoder.decompress(raw)
+        finally:
+            self._first_chunk = False
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.code
+
+    def close(self):
+        connection = self._connection
+        if connection is None:
+            return
+        self._connection = None
+        response = self._response
+        self._pool._record_transfer(self)
+        ## Only a fully consumed response leaves the socket in a
+        ## state where the next request can be sent over it
+        if response.isclosed() and not response.will_close:
+            self._pool._put(self._key, connection)
+        else:
+            response.close()
+            connection.close()
+
+    def _discard(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+class ConnectionPool(object):
+    """Thread-safe pool of persistent HTTP(S) connections keyed by host.
+
+    :param maxsize: The number of idle connections kept per host. More
+        connections can be in use at the same time, the surplus is simply
+        closed instead of being returned to the pool.
+    :param idle_timeout: Idle connections older than this many seconds are
+        closed instead of being reused, Facebook drops them anyway.
+    """
+    connection_classes = {
+        'http': httplib.HTTPConnection,
+        'https': httplib.HTTPSConnection,
+    }
+
+    def __init__(self, maxsize=10, idle_timeout=60):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._pid = os.getpid()
+        self._local = threading.local()
+        self.counters = dict(responses=0, bytes_received=0, bytes_decoded=0)
+
+    def urlopen(self, url, data=None, headers=None, timeout=None):
+        """Sends a GET (or a POST if ``data`` is given) to ``url`` over a
+        pooled connection.
+
+        ``data`` is either a string or a file-like object with a
+        ``read`` method, which is sent in blocks.
+
+        Low level socket and protocol errors are raised as
+        ``urllib2.URLError`` so callers can treat this exactly like
+        ``urllib2.urlopen``. Unlike urllib2 error status codes don't raise,
+        the response is returned and its body can be read as usual.
+        """
+        parsed = urlparse.urlsplit(url)
+        key = (parsed.scheme, parsed.netloc)
+        path = parsed.path or '/'
+        if parsed.query:
+            path = '%s?%s' % (path, parsed.query)
+        method = 'GET' if data is None else 'POST'
+        headers = dict(headers or {})
+        if data is not None:
+            headers.setdefault(
+                'Content-Type', 'application/x-www-form-urlencoded')
+
+        is_write = is_write_request(url, data)
+        while True:
+            connection, reused = self._get(key, timeout)
+            sent = False
+            try:
+                connection.request(method, path, data, headers)
+                sent = True
+                response = connection.getresponse()
+            except (socket.error, httplib.HTTPException), e:
+                connection.close()
+                ## Writes which reached the server may have been applied,
+                ## those are only sent again by the retry policy
+                if reused and is_stale_connection_error(e) \
+                        and not (sent and is_write):
+                    ## The server closed our idle connection right
+                    ## before we used it, try again on a fresh one
+                    logger.debug('stale pooled connection to %s: %s',
+                                 key[1], e)
+                    if hasattr(data, 'seek'):
+                        ## streamed bodies, see open_facebook.multipart
+                        data.seek(0)
+                    continue
+                raise urllib2.URLError(e)
+            response = PooledResponse(self, key, connection, response)
+            ## without the query, which holds the access token
+            response.path = parsed.path or '/'
+            return response
+
+    def stats(self):
+        """Returns a copy of the transfer counters of all responses"""
+        self._lock.acquire()
+        try:
+            return dict(self.counters)
+        finally:
+            self._lock.release()
+
+    def get_last_transfer(self):
+        """Returns the sizes of the last response closed by this thread::
+
+            dict(path='/me', content_encoding='gzip',
+                 bytes_received=312, bytes_decoded=1024)
+        """
+        return getattr(self._local, 'last_transfer', None)
+
+    def clear(self):
+        """Closes all idle connections"""
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, {}
+        finally:
+            self._lock.release()
+        for connections in idle.values():
+            for connection, last_used in connections:
+                connection.close()
+
+    def _get(self, key, timeout=None):
+        """Returns a ``(connection, reused)`` tuple, preferring the most
+        recently used healthy connection for ``key``.
+        """
+        now = time.time()
+        connection = None
+        self._lock.acquire()
+        try:
+            self._check_pid()
+            connections = self._idle.get(key, [])
+            while connections:
+                candidate, last_used = connections.pop()
+                if now - last_used > self.idle_timeout \
+                        or self._is_dropped(candidate):
+                    candidate.close()
+                    continue
+                connection = candidate
+                break
+        finally:
+            self._lock.release()
+
+        reused = connection is not None
+        if not reused:
+            scheme, host = key
+            connection_class = self.connection_classes.get(scheme)
+            if connection_class is None:
+                raise urllib2.URLError('unknown url type: %s' % scheme)
+            connection = connection_class(host, timeout=timeout)
+        else:
+            connection.timeout = timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+        return connection, reused
+
+    def _put(self, key, connection):
+        self._lock.acquire()
+        try:
+            self._check_pid()
+            connections = self._idle.setdefault(key, [])
+            if len(connections) < self.maxsize:
+                connections.append((connection, time.time()))
+                connection = None
+        finally:
+            self._lock.release()
+        if connection is not None:
+            connection.close()
+
+    def _record_transfer(self, response):
+        self._local.last_transfer = dict(
+            path=response.path, content_encoding=response.content_encoding,
+            bytes_received=response.bytes_received,
+            bytes_decoded=response.bytes_decoded)
+        self._lock.acquire()
+        try:
+            self.counters['responses'] += 1
+            self.counters['bytes_received'] += response.bytes_received
+            self.counters['bytes_decoded'] += response.bytes_decoded
+        finally:
+            self._lock.release()
+
+    def _check_pid(self):
+        """Forked children must not share sockets with their parent,
+        forget about the inherited connections.
+        """
+        pid = os.getpid()
+        if pid != self._pid:
+            self._pid = pid
+            self._idle = {}
+
+    @classmethod
+    def _is_dropped(cls, connection):
+        """Health check: an idle keep-alive socket should have nothing to
+        read, if it does the server either closed it or sent garbage.
+        """
+        sock = connection.sock
+        if sock is None:
+            return True
+        try:
+            readable, _, _ = select.select([sock], [], [], 0.0)
+        except (select.error, socket.error, ValueError):
+            return True
+        return bool(readable)
@@ -0,0 +1,220 @@
+"""Client side rate limiting of Graph API requests.
+
+Facebook throttles apps and users which send too many requests, and
+only tells us after rejecting a call (``FeedActionLimit``, #341). The
+:class:`RateLimiter` spends the quota evenly instead, using token buckets
+for three kinds of budgets:
+
+- ``token``: all requests made with the same access token
+- ``app``: all requests made by this app (``FACEBOOK_APP_ID``)
+- ``write``: writes with the same access token to the same path, like
+  ``me/feed`` or an open graph action
+
+Enable it using the ``FACEBOOK_RATE_LIMIT*`` settings, for example::
+
+    FACEBOOK_RATE_LIMITS = dict(token=(600, 600), app=(20000, 600),
+                                write=(25, 3600))
+    FACEBOOK_RATE_LIMIT_BACKEND = 'default'
+
+Budgets are ``(number of requests, seconds)``. Without a backend the
+buckets live in this process, with one they are shared between all
+processes using that Django cache.
+"""
+
+import logging
+import threading
+import time
+
+from open_facebook import exceptions as facebook_exceptions
+from open_facebook.cache import hash_token
+from open_facebook.utils import get_django_cache, get_path_family
+
+logger = logging.getLogger(__name__)
+
+
+class LocalBuckets(object):
+    """Token buckets kept in this process.
+
+    Uses the generic cell rate algorithm, which stores a single
+    timestamp per bucket: the time at which it will be full again.
+    Full buckets are the same as missing ones, those are dropped every
+    ``prune_interval`` seconds so a bucket per access token doesn't leak.
+    """
+    prune_interval = 60
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._pruned_at = time.time()
+
+    def consume(self, key, limit, period):
+        """Takes a token from the bucket
+
+        :returns: 0 when a token was taken, otherwise the number of
+            seconds until one is available
+        """
+        interval = float(period) / limit
+        now = time.time()
+        self._lock.acquire()
+        try:
+            if now - self._pruned_at > self.prune_interval:
+                self._prune(now)
+            full_at = max(self._buckets.get(key, now), now)
+            wait = full_at + interval - period - now
+            if wait > 0:
+                return wait
+            self._buckets[key] = full_at + interval
+            return 0
+        finally:
+            self._lock.release()
+
+    def _prune(self, now):
+        self._pruned_at = now
+        for key, full_at in self._buckets.items():
+            if full_at <= now:
+                del self._buckets[key]
+
+    def refund(self, key, limit, period, consumed_at):
+        """Puts back a token taken by ``consume``"""
+        interval = float(period) / limit
+        self._lock.acquire()
+        try:
+            if key in self._buckets:
+                self._buckets[key] -= interval
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._buckets.clear()
+        finally:
+            self._lock.release()
+
+
+class SharedBuckets(object):
+    """Buckets shared between processes through a Django cache.
+
+    Caches don't offer compare and set, so this counts requests in fixed
+    windows using the atomic ``add`` and ``incr`` instead, which allows
+    at most ``limit`` requests per window over all processes.
+    """
+    def __init__(self, backend):
+        self.backend_name = backend
+        self._backend = None
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            self._backend = get_django_cache(self.backend_name)
+        return self._backend
+
+    def consume(self, key, limit, period):
+        now = time.time()
+        window = int(now // period)
+        window_key = 'open_facebook:ratelimit:%s:%s' % (key, window)
+        backend = self.backend
+        ## the key expires together with the window
+        if backend.add(window_key, 1, int(period) + 1):
+            count = 1
+        else:
+            try:
+                count = backend.incr(window_key)
+            except ValueError:
+                ## expired in between
+                backend.add(window_key, 1, int(period) + 1)
+                count = 1
+        if count <= limit:
+            return 0
+        return (window + 1) * period - now
+
+    def refund(self, key, limit, period, consumed_at):
+        """Puts back a token taken by ``consume`` at ``consumed_at``"""
+        window = int(consumed_at // period)
+        window_key = 'open_facebook:ratelimit:%s:%s' % (key, window)
+        try:
+            self.backend.decr(window_key)
+        except ValueError:
+            ## the window is over already
+            pass
+
+
+class RateLimiter(object):
+    """
+    :param limits: dict with ``(number of requests, seconds)`` budgets
+        for the ``token``, ``app`` and ``write`` buckets. Missing
+        budgets aren't limited.
+    :param app_id: the app the ``app`` budget is kept for
+    :param backend: name of a Django cache to share the buckets with
+        other processes, ``None`` keeps them in this process
+    :param block: wait for a token by default instead of raising
+        ``RateLimitException``
+    :param max_wait: raise instead of waiting longer than this many
+        seconds, even when blocking
+    """
+    def __init__(self, limits, app_id=None, backend=None, block=True,
+                 max_wait=10):
+        self.limits = dict(limits)
+        self.app_id = app_id
+        self.block = block
+        self.max_wait = max_wait
+        if backend:
+            self.buckets = SharedBuckets(backend)
+        else:
+            self.buckets = LocalBuckets()
+
+    @classmethod
+    def get_write_path(cls, path):
+        """Writes to different objects share a bucket, so
+        ``1234/comments`` and ``5678/comments`` count as ``:id/comments``
+        """
+        return get_path_family(path)
+
+    def get_buckets(self, access_token, path, is_write=False):
+        """Returns ``(key, limit, period)`` for every bucket the request
+        takes a token from
+        """
+        token_hash = hash_token(access_token)
+        buckets = []
+        if 'write' in self.limits and is_write:
+            buckets.append(('write:%s:%s' % (
+                token_hash, self.get_write_path(path)), ) +
+                tuple(self.limits['write']))
+        if 'token' in self.limits and access_token:
+            buckets.append(('token:%s' % token_hash, ) +
+                           tuple(self.limits['token']))
+        if 'app' in self.limits:
+            buckets.append(('app:%s' % self.app_id, ) +
+                           tuple(self.limits['app']))
+        return buckets
+
+    def acquire(self, access_token, path, is_write=False, block=None):
+        """Takes a token from every bucket of the request, waiting for
+        them if ``block`` is set
+
+        :raises: ``RateLimitException`` when not allowed to wait, or when
+            the wait would exceed ``max_wait``. The tokens already taken
+            from the other buckets are put back then.
+        """
+        if block is None:
+            block = self.block
+        consumed = []
+        for key, limit, period in self.get_buckets(
+                access_token, path, is_write):
+            waited = 0
+            while True:
+                wait = self.buckets.consume(key, limit, period)
+                if not wait:
+                    consumed.append((key, limit, period, time.time()))
+                    break
+                if not block or (self.max_wait is not None and
+                                 waited + wait > self.max_wait):
+                    bucket = key.split(':', 1)[0]
+                    logger.info('rate limit %s reached, retry in %.2fs',
+                                bucket, wait)
+                    for consumed_bucket in consumed:
+                        self.buckets.refund(*consumed_bucket)
+                    raise facebook_exceptions.RateLimitException(
+                        bucket, wait)
+                time.sleep(wait)
+                waited += wait
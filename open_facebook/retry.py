@@ -0,0 +1,185 @@
+"""Retry and fail fast behaviour for Graph API requests.
+
+:class:`RetryPolicy` decides whether and when a failed request is tried
+again, using exponential backoff with jitter. Writes are never retried
+unless the policy explicitly allows it, Facebook might already have
+processed them.
+
+:class:`CircuitBreaker` keeps track of failures per family of Graph paths
+(``me/feed``, ``:id/comments``, ``fql.query``...). Once too many recent
+requests to a family failed it raises
+:class:`open_facebook.exceptions.CircuitOpenException` without contacting
+Facebook, and after ``recovery_timeout`` seconds lets a single probe
+through to see whether things recovered.
+"""
+
+import logging
+import random
+import threading
+import time
+import urllib2
+import urlparse
+
+from open_facebook import exceptions as facebook_exceptions
+from open_facebook.utils import get_path_family
+
+logger = logging.getLogger(__name__)
+
+
+class RetryPolicy(object):
+    """
+    :param max_attempts: the total number of tries, including the first
+    :param backoff: the delay in seconds before the first retry, doubled
+        for every following retry
+    :param max_backoff: the maximum delay between two tries
+    :param jitter: randomize the delays (full jitter) so clients don't
+        retry in lock step
+    :param retry_exceptions: the transport errors worth retrying
+    :param retry_statuses: the http statuses worth retrying
+    :param retry_writes: also retry POST and DELETE requests
+    """
+    def __init__(self, max_attempts=2, backoff=0.1, max_backoff=2.0,
+                 jitter=True, retry_exceptions=(urllib2.URLError, ),
+                 retry_statuses=(500, 502, 503, 504), retry_writes=False):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_exceptions = tuple(retry_exceptions)
+        self.retry_statuses = tuple(retry_statuses)
+        self.retry_writes = retry_writes
+
+    def should_retry(self, attempt, exception=None, status=None,
+                     is_write=False):
+        """Whether to try again after ``attempt`` tries failed with the
+        given exception or http status
+        """
+        if attempt >= self.max_attempts:
+            return False
+        if is_write and not self.retry_writes:
+            return False
+        if isinstance(exception, facebook_exceptions.CircuitOpenException):
+            return False
+        if exception is not None:
+            return isinstance(exception, self.retry_exceptions)
+        return status in self.retry_statuses
+
+    def get_delay(self, attempt):
+        """The number of seconds to wait after ``attempt`` tries"""
+        delay = min(self.max_backoff, self.backoff * (2 ** (attempt - 1)))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+
+class CircuitState(object):
+    def __init__(self):
+        self.state = CircuitBreaker.CLOSED
+        self.window_start = time.time()
+        self.requests = 0
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+
+class CircuitBreaker(object):
+    """
+    :param failure_threshold: the fraction of failed requests within
+        ``window`` seconds which opens the circuit
+    :param min_requests: don't open the circuit before this many
+        requests were made within the window
+    :param window: the length in seconds of the window failures are
+        counted in
+    :param recovery_timeout: the number of seconds the circuit stays open
+        before a probe request is let through
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=0.5, min_requests=20, window=60,
+                 recovery_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.min_requests = min_requests
+        self.window = window
+        self.recovery_timeout = recovery_timeout
+        self._lock = threading.Lock()
+        self._circuits = {}
+
+    @classmethod
+    def get_family(cls, url):
+        """Groups urls by the first two segments of their path, with
+        object ids replaced by ``:id``
+        """
+        scheme, host, path, query, fragment = urlparse.urlsplit(url)
+        return '%s/%s' % (host, get_path_family(path, 2))
+
+    def get_state(self, family):
+        self._lock.acquire()
+        try:
+            circuit = self._circuits.get(family)
+            return circuit.state if circuit else self.CLOSED
+        finally:
+            self._lock.release()
+
+    def before_request(self, family):
+        """Raises ``CircuitOpenException`` if requests to this family
+        should fail fast
+        """
+        self._lock.acquire()
+        try:
+            circuit = self._circuits.get(family)
+            if circuit is None or circuit.state == self.CLOSED:
+                return
+            if circuit.state == self.OPEN:
+                if time.time() - circuit.opened_at < self.recovery_timeout:
+                    raise facebook_exceptions.CircuitOpenException(family)
+                circuit.state = self.HALF_OPEN
+                circuit.probing = False
+            ## half open, let a single probe through
+            if circuit.probing:
+                raise facebook_exceptions.CircuitOpenException(family)
+            circuit.probing = True
+        finally:
+            self._lock.release()
+
+    def record_success(self, family):
+        self._record(family, failed=False)
+
+    def record_failure(self, family):
+        self._record(family, failed=True)
+
+    def _record(self, family, failed):
+        now = time.time()
+        self._lock.acquire()
+        try:
+            circuit = self._circuits.get(family)
+            if circuit is None:
+                circuit = self._circuits[family] = CircuitState()
+            if circuit.state == self.HALF_OPEN:
+                if failed:
+                    self._open(family, circuit, now)
+                else:
+                    logger.info('closing the circuit for %s', family)
+                    self._circuits[family] = CircuitState()
+                return
+            if now - circuit.window_start > self.window:
+                circuit.window_start = now
+                circuit.requests = circuit.failures = 0
+            circuit.requests += 1
+            if failed:
+                circuit.failures += 1
+            if circuit.state == self.CLOSED \
+                    and circuit.requests >= self.min_requests \
+                    and circuit.failures >= \
+                    self.failure_threshold * circuit.requests:
+                self._open(family, circuit, now)
+        finally:
+            self._lock.release()
+
+    def _open(self, family, circuit, now):
+        logger.warn('opening the circuit for %s, %s of %s requests failed',
+                    family, circuit.failures, circuit.requests)
+        circuit.state = self.OPEN
+        circuit.opened_at = now
+        circuit.probing = False
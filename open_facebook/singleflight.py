@@ -0,0 +1,100 @@
+"""Coalescing of identical Graph API requests.
+
+On busy pages many threads ask for the same object at the same moment.
+With :class:`SingleFlight` only the first of them sends the request,
+the others wait for it and get the same response body (or exception).
+Nothing is cached, once the request finished the next caller sends a new
+one; use the response cache for that.
+
+Requests are identified by host, path, sorted parameters and a hash of
+the access token. Reads using the app access token, or no token, are
+therefore shared by all users, reads using a user's token only between
+requests for that same user.
+"""
+
+import logging
+import threading
+import urlparse
+
+from open_facebook.cache import hash_token
+
+logger = logging.getLogger(__name__)
+
+
+class Flight(object):
+    """A call in progress"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+class SingleFlight(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.counters = dict(calls=0, shared=0)
+
+    @classmethod
+    def get_key(cls, url, etag=None):
+        """Returns the key identifying the request for ``url``, sent with
+        ``etag`` as ``If-None-Match``. A 304 answering a revalidation is
+        no response to share with callers which have nothing cached.
+        """
+        scheme, host, path, query, fragment = urlparse.urlsplit(url)
+        params = urlparse.parse_qsl(query, keep_blank_values=True)
+        access_token = None
+        filtered_params = []
+        for k, v in params:
+            if k == 'access_token':
+                access_token = v
+            else:
+                filtered_params.append((k, v))
+        filtered_params.sort()
+        return (host, path, tuple(filtered_params), hash_token(access_token),
+                etag)
+
+    def do(self, key, function, *args, **kwargs):
+        """Calls ``function(*args, **kwargs)``, unless a call for ``key``
+        is already in progress, in which case its outcome is returned
+        """
+        self._lock.acquire()
+        try:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+                self.counters['calls'] += 1
+            else:
+                self.counters['shared'] += 1
+        finally:
+            self._lock.release()
+
+        if not leader:
+            logger.debug('waiting for identical request %s', key[1])
+            flight.done.wait()
+            if flight.exception is not None:
+                raise flight.exception
+            return flight.result
+
+        try:
+            flight.result = function(*args, **kwargs)
+        except Exception, e:
+            flight.exception = e
+            raise
+        finally:
+            self._lock.acquire()
+            try:
+                del self._flights[key]
+            finally:
+                self._lock.release()
+            flight.done.set()
+        return flight.result
+
+    def stats(self):
+        """Returns a copy of the counters"""
+        self._lock.acquire()
+        try:
+            return dict(self.counters)
+        finally:
+            self._lock.release()
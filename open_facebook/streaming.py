@@ -0,0 +1,187 @@
+"""Incremental decoding of large Graph and FQL responses.
+
+Reading a 5000 friend FQL result with ``read()`` and ``json.loads`` keeps
+several copies of the payload in memory. :class:`JSONItemStream` instead
+reads the response in chunks and yields the items of its ``data`` array
+(or of the top level array FQL returns) as soon as they are decoded::
+
+    for friend in facebook.fql(query, stream=True):
+        print friend['name']
+
+Only the item being decoded and the unread part of the current chunk are
+kept around. :meth:`JSONItemStream.result_sets` does the same for the
+rows of every result set of a ``fql.multiquery`` response.
+"""
+
+import codecs
+import logging
+import re
+
+from open_facebook.utils import json
+
+logger = logging.getLogger(__name__)
+
+WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+
+
+class JSONItemStream(object):
+    """Iterates over the items of a JSON response read from ``fileobj``
+
+    The other keys of the response (``paging``, ``error``...) end up in
+    ``envelope``. Responses without a ``data`` array are yielded as a
+    single item.
+
+    :param check: called with the envelope before the first item is
+        yielded and once the response has been read, so Facebook errors
+        can be raised
+    """
+    def __init__(self, fileobj, chunk_size=16384, check=None):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.check = check
+        self.envelope = {}
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder('utf8')()
+        self._buffer = u''
+        self._pos = 0
+        self._eof = False
+
+    def __iter__(self):
+        char = self._peek()
+        if char == '[':
+            self._pos += 1
+            for item in self._array():
+                yield item
+            return
+        self._expect('{')
+
+        has_data = False
+        if self._peek() == '}':
+            self._pos += 1
+        else:
+            while True:
+                key = self._value()
+                self._expect(':')
+                if key == 'data' and self._peek() == '[':
+                    self._pos += 1
+                    has_data = True
+                    self._check()
+                    for item in self._array():
+                        yield item
+                else:
+                    self.envelope[key] = self._value()
+                if self._expect(',}') == '}':
+                    break
+
+        self._check()
+        if not has_data:
+            yield self.envelope
+
+    def result_sets(self):
+        """Iterates over a ``fql.multiquery`` response, yielding a
+        ``(name, rows)`` tuple per query where ``rows`` iterates over the
+        rows of its result set. Rows which aren't consumed before moving
+        on to the next query are skipped.
+        """
+        if self._peek() != '[':
+            ## an error envelope, raised by check
+            for item in self:
+                pass
+            return
+        self._pos += 1
+        if self._peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            self._expect('{')
+            entry = {}
+            streamed = False
+            if self._peek() == '}':
+                self._pos += 1
+            else:
+                while True:
+                    key = self._value()
+                    self._expect(':')
+                    if key == 'fql_result_set' and 'name' in entry and \
+                            self._peek() == '[':
+                        self._pos += 1
+                        rows = self._array()
+                        streamed = True
+                        yield entry['name'], rows
+                        for row in rows:
+                            pass
+                    else:
+                        entry[key] = self._value()
+                    if self._expect(',}') == '}':
+                        break
+            if not streamed:
+                ## the name came after the rows, or the query failed
+                if self.check is not None:
+                    self.check(entry)
+                yield entry.get('name'), iter(entry.get('fql_result_set')
+                                              or [])
+            if self._expect(',]') == ']':
+                return
+
+    def _check(self):
+        if self.check is not None:
+            self.check(self.envelope)
+
+    def _array(self):
+        if self._peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield self._value()
+            if self._expect(',]') == ']':
+                return
+
+    def _fill(self, size=None):
+        chunk = self.fileobj.read(size or self.chunk_size)
+        ## drop what was consumed already
+        self._buffer = self._buffer[self._pos:]
+        self._pos = 0
+        if chunk:
+            self._buffer += self._utf8.decode(chunk)
+        else:
+            self._buffer += self._utf8.decode('', True)
+            self._eof = True
+
+    def _peek(self):
+        while True:
+            self._pos = WHITESPACE_RE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer) or self._eof:
+                return self._buffer[self._pos:self._pos + 1]
+            self._fill()
+
+    def _expect(self, chars):
+        char = self._peek()
+        if not char or char not in chars:
+            raise ValueError('Expected one of %r at %r in the response' % (
+                chars, self._buffer[self._pos:self._pos + 20]))
+        self._pos += 1
+        return char
+
+    def _value(self):
+        self._peek()
+        ## every failed attempt decodes the whole value again, doubling
+        ## the reads keeps that linear in the size of large items
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(
+                    self._buffer, self._pos)
+            except ValueError:
+                if self._eof:
+                    raise
+                self._fill(size)
+                size *= 2
+                continue
+            ## a number at the end of the buffer might continue in the
+            ## next chunk
+            if end == len(self._buffer) and not self._eof:
+                self._fill(size)
+                size *= 2
+                continue
+            self._pos = end
+            return value
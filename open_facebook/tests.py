@@ -122,6 +122,1243 @@ class TestOpenFacebook(unittest.TestCase):
                 name='FashiolistaTestt')
 
 
+class LocalServerTestCase(unittest.TestCase):
+    '''
+    Runs a keep-alive http server on localhost, responding with
+    ``self.body`` and keeping track of the connections and requests
+    made to it
+    '''
+    body = '{"id": "1"}'
+    status = 200
+    content_encoding = None
+    etag = None
+    ## the number of requests to close the connection on, unanswered
+    dropped = 0
+    ## seconds to wait before answering
+    delay = 0
+
+    def setUp(self):
+        import BaseHTTPServer
+        import SocketServer
+        import threading
+        import time
+        connections = self.connections = []
+        requests = self.requests = []
+        test = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                connections.append(self.client_address)
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+            def do_GET(self):
+                requests.append((self.command, self.path))
+                if test.dropped:
+                    test.dropped -= 1
+                    self.close_connection = 1
+                    return
+                if test.delay:
+                    time.sleep(test.delay)
+                body = test.body
+                if test.etag and \
+                        self.headers.get('If-None-Match') == test.etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(test.status)
+                if test.etag:
+                    self.send_header('ETag', test.etag)
+                if test.content_encoding:
+                    body = test.compress(body)
+                    self.send_header('Content-Encoding',
+                                     test.content_encoding)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                self.rfile.read(length)
+                self.do_GET()
+
+            def log_message(self, *args):
+                pass
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+            def handle_error(self, request, client_address):
+                ## clients going away, like after a timeout
+                pass
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.base_url = 'http://127.0.0.1:%s/' % self.server.server_port
+        self.url = self.base_url + 'me'
+
+    def compress(self, body):
+        import gzip
+        import zlib
+        from StringIO import StringIO
+        if self.content_encoding == 'deflate':
+            return zlib.compress(body)
+        buffer = StringIO()
+        gzip_file = gzip.GzipFile(fileobj=buffer, mode='wb')
+        gzip_file.write(body)
+        gzip_file.close()
+        return buffer.getvalue()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        FacebookConnection.connection_pool.clear()
+
+
+class TestConnectionPool(LocalServerTestCase):
+    def test_keep_alive(self):
+        from open_facebook.pool import ConnectionPool
+        pool = ConnectionPool(maxsize=2)
+        for x in range(3):
+            response = pool.urlopen(self.url)
+            self.assertEqual(response.read(), '{"id": "1"}')
+            response.close()
+        self.assertEqual(len(self.connections), 1)
+        pool.clear()
+
+    def test_compression(self):
+        from open_facebook.pool import ConnectionPool
+        pool = ConnectionPool(maxsize=2)
+        self.body = '{"data": [%s]}' % ', '.join(['{"id": "1"}'] * 100)
+        for encoding in ('gzip', 'deflate'):
+            self.content_encoding = encoding
+            response = pool.urlopen(self.url)
+            self.assertEqual(response.read(5), '{"dat')
+            self.assertEqual(response.read(), self.body[5:])
+            response.close()
+            transfer = pool.get_last_transfer()
+            self.assertEqual(transfer['path'], '/me')
+            self.assertEqual(transfer['content_encoding'], encoding)
+            self.assertEqual(transfer['bytes_decoded'], len(self.body))
+            self.assertTrue(transfer['bytes_received'] < len(self.body) / 5)
+        ## still kept alive
+        self.assertEqual(len(self.connections), 1)
+        self.assertEqual(pool.stats()['responses'], 2)
+        pool.clear()
+
+        graph = OpenFacebook('token')
+        graph.api_url = self.base_url
+        self.assertEqual(len(graph.get('me')['data']), 100)
+        self.assertEqual(len(list(graph.get('me', stream=True))), 100)
+
+    def test_stale_connection(self):
+        from open_facebook.pool import ConnectionPool
+        pool = ConnectionPool(maxsize=2)
+        response = pool.urlopen(self.url)
+        response.read()
+        response.close()
+
+        ## reads are sent again on a fresh connection
+        self.dropped = 1
+        response = pool.urlopen(self.url)
+        self.assertEqual(response.read(), '{"id": "1"}')
+        response.close()
+        self.assertEqual(len(self.requests), 3)
+
+        ## writes the server received are not
+        self.dropped = 1
+        self.assertRaises(urllib2.URLError, pool.urlopen, self.url, 'a=b')
+        self.assertEqual(len(self.requests), 4)
+
+        ## timeouts are left to the retry policy
+        response = pool.urlopen(self.url)
+        response.read()
+        response.close()
+        self.delay = 0.3
+        self.assertRaises(urllib2.URLError, pool.urlopen, self.url,
+                          timeout=0.1)
+        self.assertEqual(len(self.requests), 6)
+        pool.clear()
+
+    def test_idle_timeout(self):
+        from open_facebook.pool import ConnectionPool
+        pool = ConnectionPool(maxsize=2, idle_timeout=-1)
+        for x in range(2):
+            response = pool.urlopen(self.url)
+            response.read()
+            response.close()
+        self.assertEqual(len(self.connections), 2)
+
+
+class TestResponseCache(LocalServerTestCase):
+    def get_graph(self, access_token='token'):
+        from open_facebook.cache import ResponseCache
+
+        class LocalOpenFacebook(OpenFacebook):
+            api_url = self.base_url
+            response_cache = ResponseCache(
+                timeouts=[('^me/feed$', 0)])
+        return LocalOpenFacebook(access_token)
+
+    def test_read_through(self):
+        graph = self.get_graph()
+        graph.get('me', fields='id')
+        self.assertEqual(graph.get('me', fields='id'), dict(id='1'))
+        graph.get('me/feed')
+        graph.get('me/feed')
+        self.assertEqual(len(self.requests), 3)
+        stats = graph.response_cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 3)
+
+    def test_oauth_not_cached(self):
+        graph = self.get_graph()
+        self.body = 'access_token=secret_token'
+        graph.get('oauth/access_token', client_secret='secret')
+        graph.get('oauth/access_token', client_secret='secret')
+        self.assertEqual(len(self.requests), 2)
+        for key in graph.response_cache.local._data:
+            self.assertFalse(key.startswith('open_facebook:response:'))
+
+    def test_token_scope(self):
+        graph = self.get_graph()
+        graph.get('me')
+        other_graph = self.get_graph('other_token')
+        other_graph.response_cache = graph.response_cache
+        other_graph.get('me')
+        self.assertEqual(len(self.requests), 2)
+        for key in graph.response_cache.local._data:
+            self.assertFalse('token' in key)
+
+    def test_invalidation(self):
+        graph = self.get_graph()
+        graph.get('me')
+        graph.set('me/feed', message='hi')
+        graph.get('me')
+        self.assertEqual(len(self.requests), 3)
+
+    def test_shared_invalidation(self):
+        from open_facebook.cache import ResponseCache
+        ## two processes sharing a Django cache
+        cache_a = ResponseCache(backend='default')
+        cache_b = ResponseCache(backend='default')
+        url = self.url + '?access_token=shared_token'
+        cache_b.set(cache_b.parse(url), '{"id": "1"}')
+        self.assertEqual(cache_b.get(cache_b.parse(url)), '{"id": "1"}')
+        cache_a.invalidate(cache_a.parse(
+            self.base_url + 'me/feed?access_token=shared_token'))
+        self.assertEqual(cache_b.get(cache_b.parse(url)), None)
+
+    def test_revalidation(self):
+        import time
+        from open_facebook.cache import ResponseCache
+        self.etag = '"abc"'
+        graph = self.get_graph()
+        graph.__class__.response_cache = cache = ResponseCache(timeout=0.1)
+        self.assertEqual(graph.get('me'), dict(id='1'))
+        graph.get('me')
+        self.assertEqual(len(self.requests), 1)
+
+        ## expired, but a 304 makes it fresh again
+        time.sleep(0.15)
+        self.assertEqual(graph.get('me'), dict(id='1'))
+        graph.get('me')
+        self.assertEqual(len(self.requests), 2)
+        stats = cache.stats()
+        self.assertEqual(stats['stale'], 1)
+        self.assertEqual(stats['revalidations'], 1)
+
+        ## changed on Facebook
+        time.sleep(0.15)
+        self.etag = '"def"'
+        self.body = '{"id": "2"}'
+        self.assertEqual(graph.get('me'), dict(id='2'))
+        self.assertEqual(cache.lookup(cache.parse(self.url + '?access_token=token'))[1], '"def"')
+
+
+class TestMetrics(LocalServerTestCase):
+    def test_memory(self):
+        from open_facebook.metrics import PrometheusMetrics
+        metrics = PrometheusMetrics()
+
+        class LocalOpenFacebook(OpenFacebook):
+            api_url = self.base_url
+        LocalOpenFacebook.metrics = metrics
+        graph = LocalOpenFacebook('token')
+        graph.get('1234/comments')
+        graph.get('5678/comments', limit=5)
+        self.assertEqual(metrics.get_counter(
+            'request.attempts', endpoint=':id/comments'), 2)
+        self.assertEqual(metrics.get_counter(
+            'response.bytes_decoded', endpoint=':id/comments'),
+            2 * len(self.body))
+        histogram = metrics.get_histogram('request.latency',
+                                          endpoint=':id/comments')
+        self.assertEqual(histogram.count, 2)
+
+        self.body = '{"error": {"message": "(#341) Feed action request limit reached", "type": "OAuthException"}}'
+        self.assertRaises(facebook_exceptions.FeedActionLimit,
+                          graph.set, 'me/feed', message='hi')
+        self.assertEqual(metrics.get_counter(
+            'errors', exception='FeedActionLimit'), 1)
+        self.assertTrue(metrics.get_counter(
+            'request.bytes_sent', endpoint='me/feed') > 0)
+
+        text = metrics.render()
+        self.assertTrue('facebook_errors_total{exception="FeedActionLimit"} 1'
+                        in text)
+        self.assertTrue('facebook_request_latency_count{endpoint="me/feed"} 1'
+                        in text)
+        self.assertTrue('le="+Inf"' in text)
+
+    def test_disabled(self):
+        from open_facebook.metrics import get_metrics
+        self.assertFalse(FacebookConnection.metrics.enabled)
+        self.assertFalse(get_metrics(None).enabled)
+        self.assertTrue(get_metrics('memory').enabled)
+
+
+class TestTracing(unittest.TestCase):
+    def test_redaction(self):
+        from open_facebook.tracing import Preview, redact
+        self.assertEqual(
+            redact('https://graph.facebook.com/me?access_token=abc&limit=5'),
+            'https://graph.facebook.com/me?access_token=<redacted>&limit=5')
+        self.assertEqual(redact('error_code=190&code=xyz'),
+                         'error_code=190&code=<redacted>')
+        preview = unicode(Preview(dict(access_token='abc', id='1')))
+        self.assertFalse('abc' in preview)
+        self.assertEqual(
+            redact('{"id": "1", "access_token" : "a\\"bc", "code":"x"}'),
+            '{"id": "1", "access_token" : "<redacted>", "code":"<redacted>"}')
+        preview = unicode(Preview('x' * 50, max_length=10))
+        self.assertEqual(preview, 'x' * 10 + '... (50 characters)')
+
+    def test_sampling(self):
+        from open_facebook.tracing import Tracer
+        messages = []
+
+        class Handler(logging.Handler):
+            def emit(self, record):
+                messages.append(record.getMessage())
+
+        trace_logger = logging.getLogger('open_facebook.tests.tracing')
+        trace_logger.setLevel(logging.INFO)
+        trace_logger.addHandler(Handler())
+        trace_logger.propagate = False
+        url = 'https://graph.facebook.com/me?access_token=abc'
+
+        self.assertEqual(Tracer(0, logger=trace_logger).start(url), None)
+        disabled = logging.root.manager.disable
+        logging.disable(logging.NOTSET)
+        try:
+            trace = Tracer(1, max_length=20, logger=trace_logger).start(url)
+            trace.response('{"data": [%s]}' % ('{"id": "1"}, ' * 1000))
+            ## like test user and json oauth responses
+            trace = Tracer(1, max_length=0, logger=trace_logger).start(url)
+            trace.response('{"id": "1", "access_token": "SECRET123"}')
+        finally:
+            logging.disable(disabled)
+        self.assertEqual(len(messages), 4)
+        self.assertFalse('SECRET123' in messages[3])
+        self.assertFalse('abc' in messages[0])
+        self.assertTrue('characters)' in messages[1])
+        self.assertTrue(len(messages[1]) < 200)
+
+
+class TestRetry(LocalServerTestCase):
+    body = '{"error": {"message": "(#2) Service temporarily unavailable", "type": "OAuthException"}}'
+    status = 503
+
+    def get_graph(self, breaker=None):
+        from open_facebook.retry import RetryPolicy
+
+        class LocalOpenFacebook(OpenFacebook):
+            api_url = self.base_url
+            retry_policy = RetryPolicy(max_attempts=3, backoff=0)
+            circuit_breaker = breaker
+        return LocalOpenFacebook('token')
+
+    def test_retry_reads_only(self):
+        graph = self.get_graph()
+        self.assertRaises(facebook_exceptions.OpenFacebookException,
+                          graph.get, 'me')
+        self.assertEqual(len(self.requests), 3)
+        self.assertRaises(facebook_exceptions.OpenFacebookException,
+                          graph.set, 'me/feed', message='hi')
+        self.assertEqual(len(self.requests), 4)
+
+    def test_circuit_breaker(self):
+        from open_facebook.retry import CircuitBreaker
+        breaker = CircuitBreaker(min_requests=2, recovery_timeout=0.1)
+        graph = self.get_graph(breaker)
+        ## the circuit opens after the second try, so no third one
+        self.assertRaises(facebook_exceptions.CircuitOpenException,
+                          graph.get, 'me')
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(breaker.get_state('127.0.0.1:%s/me' %
+                         self.server.server_port), breaker.OPEN)
+        self.assertRaises(facebook_exceptions.CircuitOpenException,
+                          graph.get, 'me')
+        self.assertEqual(len(self.requests), 2)
+
+        ## after the recovery timeout a single probe closes it again
+        import time
+        time.sleep(0.15)
+        self.status = 200
+        self.body = '{"id": "1"}'
+        self.assertEqual(graph.get('me'), {'id': '1'})
+        self.assertEqual(breaker.get_state('127.0.0.1:%s/me' %
+                         self.server.server_port), breaker.CLOSED)
+
+
+class TestMe(unittest.TestCase):
+    def test_fields(self):
+        requests = []
+
+        class LocalOpenFacebook(OpenFacebook):
+            def _request(self, url, post_data=None):
+                requests.append(url)
+                return dict(id='1')
+
+        graph = LocalOpenFacebook('token')
+        graph.me(fields=['id', 'name'])
+        self.assertTrue('fields=id%2Cname' in requests[0])
+        graph.me(fields=['name'])
+        graph.me()
+        self.assertEqual(len(requests), 1)
+        graph.me(fields=['email'])
+        self.assertEqual(len(requests), 2)
+
+
+class TestProfileCache(unittest.TestCase):
+    def setUp(self):
+        from open_facebook.cache import ProfileCache
+        from open_facebook.tests_utils.fake_graph import FakeGraph, \
+            FakeGraphPool
+        self.fake = FakeGraph()
+        self.token = self.fake.add_user(dict(name='Thierry'))
+        self.pool = FakeGraphPool(self.fake).install()
+        OpenFacebook.profile_cache = ProfileCache(timeout=60)
+
+    def tearDown(self):
+        self.pool.uninstall()
+        OpenFacebook.profile_cache = None
+
+    def get_me_requests(self):
+        return len([r for r in self.fake.requests if r[1] == 'me'])
+
+    def test_shared_between_graphs(self):
+        graph = OpenFacebook(self.token)
+        self.assertTrue(graph.is_authenticated())
+        profile = OpenFacebook(self.token).me(fields=['id', 'name'])
+        self.assertEqual(profile['name'], 'Thierry')
+        self.assertEqual(self.get_me_requests(), 1)
+
+        ## copies are returned
+        profile['image'] = 'http://example.com/image.jpg'
+        self.assertFalse('image' in OpenFacebook(self.token).me())
+
+        cache = OpenFacebook.profile_cache
+        cache.invalidate(facebook_id=int(profile['id']))
+        OpenFacebook(self.token).me()
+        self.assertEqual(self.get_me_requests(), 2)
+
+        cache.invalidate(access_token=self.token)
+        self.assertEqual(cache.get(self.token), None)
+
+    def test_fields(self):
+        OpenFacebook(self.token).me(fields=['id'])
+        OpenFacebook(self.token).me(fields=['id', 'name'])
+        self.assertEqual(self.get_me_requests(), 2)
+        OpenFacebook(self.token).me(fields=['name'])
+        self.assertEqual(self.get_me_requests(), 2)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def get_graph(self, **kwargs):
+        from open_facebook.ratelimit import RateLimiter
+        requests = self.requests = []
+
+        class LimitedOpenFacebook(OpenFacebook):
+            rate_limiter = RateLimiter(**kwargs)
+
+            def _request(self, url, post_data=None):
+                requests.append(url)
+                return {}
+        return LimitedOpenFacebook('token')
+
+    def test_raise(self):
+        graph = self.get_graph(limits=dict(token=(2, 60)), block=False)
+        graph.get('me')
+        graph.get('me/friends')
+        try:
+            graph.get('me')
+        except facebook_exceptions.RateLimitException, e:
+            self.assertEqual(e.bucket, 'token')
+            self.assertTrue(0 < e.retry_after <= 30)
+        else:
+            self.fail('rate limit not enforced')
+        self.assertEqual(len(self.requests), 2)
+
+        ## a different token has its own budget
+        graph.access_token = 'other'
+        graph.get('me')
+        self.assertEqual(len(self.requests), 3)
+
+    def test_write_paths(self):
+        graph = self.get_graph(limits=dict(write=(1, 60)), block=False)
+        graph.set('me/feed', message='a')
+        graph.set('1234/comments', message='a')
+        graph.get('me/feed')
+        self.assertRaises(facebook_exceptions.RateLimitException,
+                          graph.set, '5678/comments', message='b')
+        self.assertEqual(len(self.requests), 3)
+
+    def test_refund(self):
+        from open_facebook.ratelimit import RateLimiter
+        for backend in (None, 'default'):
+            limiter = RateLimiter(dict(token=(2, 60), app=(1, 60)),
+                                  app_id='refund-%s' % backend,
+                                  backend=backend, block=False)
+            limiter.acquire('refund', 'me')
+            self.assertRaises(facebook_exceptions.RateLimitException,
+                              limiter.acquire, 'refund', 'me')
+            ## the rejected call didn't use the token budget
+            del limiter.limits['app']
+            limiter.acquire('refund', 'me')
+            self.assertRaises(facebook_exceptions.RateLimitException,
+                              limiter.acquire, 'refund', 'me')
+
+    def test_block(self):
+        import time
+        graph = self.get_graph(limits=dict(app=(1, 0.1)), max_wait=1)
+        start = time.time()
+        graph.get('me')
+        graph.get('me')
+        self.assertTrue(time.time() - start >= 0.09)
+        self.assertEqual(len(self.requests), 2)
+
+    def test_iterate(self):
+        graph = self.get_graph(limits=dict(token=(2, 60)), block=False)
+        page = {'data': [1], 'paging': {'next': graph.api_url + 'me/likes'}}
+        graph._request = lambda url, post_data=None: page
+        ## fetching the next pages takes tokens as well
+        self.assertRaises(facebook_exceptions.RateLimitException, list,
+                          graph.iterate('me/likes', max_pages=3))
+        self.assertRaises(facebook_exceptions.RateLimitException, list,
+                          graph.iterate('me/likes', max_pages=3,
+                                        prefetch=True))
+
+    def test_prune(self):
+        import time
+        from open_facebook.ratelimit import LocalBuckets
+        buckets = LocalBuckets()
+        buckets.consume('a', 10, 0.01)
+        buckets.consume('b', 1, 60)
+        time.sleep(0.01)
+        buckets._pruned_at -= buckets.prune_interval + 1
+        buckets.consume('c', 1, 60)
+        self.assertEqual(sorted(buckets._buckets), ['b', 'c'])
+
+
+class TestStreaming(LocalServerTestCase):
+    body = '{"data": [{"id": "1", "name": "Thijs"}, {"id": 22}], "paging": {"next": null}}'
+
+    def decode(self, body, chunk_size=3):
+        from open_facebook.streaming import JSONItemStream
+        from StringIO import StringIO
+        stream = JSONItemStream(StringIO(body), chunk_size=chunk_size)
+        return list(stream), stream.envelope
+
+    def test_chunks(self):
+        items, envelope = self.decode(self.body)
+        self.assertEqual(items, [dict(id='1', name='Thijs'), dict(id=22)])
+        self.assertEqual(envelope, dict(paging=dict(next=None)))
+        body = u'[ {"name": "J\u00e9r\u00f4me"}, 12345 ]'.encode('utf8')
+        for chunk_size in range(1, 10):
+            items, envelope = self.decode(body, chunk_size)
+            self.assertEqual(items, [dict(name=u'J\xe9r\xf4me'), 12345])
+        self.assertEqual(self.decode('[]')[0], [])
+        self.assertEqual(self.decode('{"id": "1"}')[0], [dict(id='1')])
+        self.assertRaises(ValueError, self.decode, '[{"id": 1}')
+
+    def test_large_items(self):
+        from open_facebook.streaming import JSONItemStream
+        from StringIO import StringIO
+        body = StringIO('[{"id": "%s"}, 1]' % ('x' * 100000))
+        reads = []
+        read = body.read
+        body.read = lambda size: reads.append(size) or read(size)
+        items = list(JSONItemStream(body, chunk_size=10))
+        self.assertEqual(len(items[0]['id']), 100000)
+        self.assertEqual(items[1], 1)
+        ## not decoded again for every chunk of 10 bytes
+        self.assertTrue(len(reads) < 30)
+
+    def test_request(self):
+        graph = OpenFacebook('token')
+        graph.api_url = graph.old_api_url = self.base_url
+        items = graph.get('me/friends', stream=True)
+        self.assertEqual(self.requests, [])
+        self.assertEqual(list(items), [dict(id='1', name='Thijs'), dict(id=22)])
+
+        self.body = '{"error_code": 190, "error_msg": "Invalid OAuth 2.0 Access Token"}'
+        self.assertRaises(facebook_exceptions.OpenFacebookException,
+                          list, graph.fql('SELECT uid FROM user', stream=True))
+
+
+class TestFQLMulti(LocalServerTestCase):
+    body = ('[{"name": "friends", "fql_result_set": [{"uid2": "2"}, '
+            '{"uid2": "3"}]}, {"fql_result_set": [], "name": "pages"}, '
+            '{"name": "broken", "error_code": 200, '
+            '"error_msg": "(#200) Requires extended permission"}]')
+
+    def get_graph(self):
+        graph = OpenFacebook('token')
+        graph.old_api_url = self.base_url
+        return graph
+
+    def test_results(self):
+        results = self.get_graph().fql_multi(dict(
+            friends='SELECT uid2 FROM friend WHERE uid1 = me()',
+            pages='SELECT page_id FROM page_fan WHERE uid IN '
+                  '(SELECT uid2 FROM #friends)'))
+        self.assertTrue('fql.multiquery' in self.requests[0][1])
+        self.assertTrue('%23friends' in self.requests[0][1])
+        self.assertEqual(results['friends'], [dict(uid2='2'), dict(uid2='3')])
+        self.assertEqual(results['pages'], [])
+        self.assertTrue(isinstance(results['broken'],
+                                   facebook_exceptions.PermissionException))
+
+    def test_stream(self):
+        result_sets = self.get_graph().fql_multi({}, stream=True)
+        name, rows = result_sets.next()
+        self.assertEqual((name, rows.next()), ('friends', dict(uid2='2')))
+        name, rows = result_sets.next()
+        self.assertEqual((name, list(rows)), ('pages', []))
+        self.assertRaises(facebook_exceptions.PermissionException,
+                          result_sets.next)
+
+    def test_error(self):
+        self.body = '{"error_code": 601, "error_msg": "Parser error"}'
+        graph = self.get_graph()
+        self.assertRaises(facebook_exceptions.OpenFacebookException,
+                          graph.fql_multi, {})
+        self.assertRaises(facebook_exceptions.OpenFacebookException,
+                          list, graph.fql_multi({}, stream=True))
+
+
+class TestSingleFlight(unittest.TestCase):
+    def test_coalescing(self):
+        import threading
+        import time
+        from open_facebook.singleflight import SingleFlight
+        requests = []
+
+        class LocalOpenFacebook(OpenFacebook):
+            single_flight = SingleFlight()
+
+            @classmethod
+            def _fetch(cls, url, post_data=None, timeout=None,
+                       attempts=None, is_write=False, etag=None):
+                requests.append(url)
+                time.sleep(0.2)
+                return 200, '{"id": "1"}', None
+
+        results = []
+
+        def get(access_token, path='cocacola'):
+            results.append(LocalOpenFacebook(access_token).get(path))
+
+        threads = [threading.Thread(target=get, args=(token, ))
+                   for token in ['a', 'a', 'a', 'b', None, None]]
+        threads.append(threading.Thread(target=get, args=('a', 'pepsi')))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [dict(id='1')] * 7)
+        ## a, b, no token and a different path
+        self.assertEqual(len(requests), 4)
+        self.assertEqual(LocalOpenFacebook.single_flight.stats(),
+                         dict(calls=4, shared=3))
+
+        ## writes are never shared
+        graph = LocalOpenFacebook('a')
+        graph.set('me/feed', message='hi')
+        self.assertEqual(len(requests), 5)
+
+        ## nor are revalidations with requests without an ETag
+        flight = LocalOpenFacebook.single_flight
+        url = 'https://graph.facebook.com/me?access_token=a'
+        self.assertEqual(flight.get_key(url), flight.get_key(url, None))
+        self.assertNotEqual(flight.get_key(url), flight.get_key(url, '"1"'))
+
+
+class TestAsyncOpenFacebook(LocalServerTestCase):
+    body = '{"error": {"type": "OAuthException", "message": "(#200) no"}}'
+
+    def test_error_mapping(self):
+        from tornado.ioloop import IOLoop
+        from open_facebook import exceptions as facebook_exceptions
+        from open_facebook.async_api import AsyncOpenFacebook
+
+        class LocalAsyncOpenFacebook(AsyncOpenFacebook):
+            api_url = self.base_url
+
+        facebook = LocalAsyncOpenFacebook('token')
+        self.assertRaises(facebook_exceptions.PermissionException,
+                          IOLoop.current().run_sync, facebook.me)
+        self.assertFalse(IOLoop.current().run_sync(facebook.is_authenticated))
+
+    def test_map_and_iterate(self):
+        from StringIO import StringIO
+        from tornado.ioloop import IOLoop
+        from open_facebook.async_api import AsyncOpenFacebook
+
+        class LocalAsyncOpenFacebook(AsyncOpenFacebook):
+            api_url = self.base_url
+
+        self.body = '{"data": [1, 2], "paging": {"next": "%sme/likes"}}' % (
+            self.base_url)
+        facebook = LocalAsyncOpenFacebook('token')
+        loop = IOLoop.current()
+        results = loop.run_sync(lambda: facebook.map([
+            'me/likes', ('set', 'me/photos', dict(source=StringIO('x')))]))
+        self.assertEqual(results[0]['data'], [1, 2])
+        self.assertTrue(isinstance(results[1], NotImplementedError))
+
+        del self.requests[:]
+        items = loop.run_sync(lambda: facebook.iterate('me/likes',
+                                                       max_items=3))
+        self.assertEqual(items, [1, 2, 1])
+        self.assertEqual(len(self.requests), 2)
+
+    def test_retry_policy(self):
+        from tornado.ioloop import IOLoop
+        from open_facebook.async_api import AsyncOpenFacebook
+        from open_facebook.retry import RetryPolicy
+
+        class LocalAsyncOpenFacebook(AsyncOpenFacebook):
+            api_url = self.base_url
+            retry_policy = RetryPolicy(max_attempts=3, backoff=0.01)
+
+        self.status = 500
+        facebook = LocalAsyncOpenFacebook('token')
+        loop = IOLoop.current()
+        self.assertRaises(Exception, loop.run_sync, facebook.me)
+        self.assertEqual(len(self.requests), 3)
+
+        ## writes are never retried blindly
+        del self.requests[:]
+        self.assertRaises(Exception, loop.run_sync,
+                          lambda: facebook.set('me/feed', message='hi'))
+        self.assertEqual(len(self.requests), 1)
+
+    def test_connection_errors(self):
+        import urllib2
+        from tornado.ioloop import IOLoop
+        from open_facebook.async_api import AsyncOpenFacebook
+        from open_facebook.retry import CircuitBreaker, RetryPolicy
+        breaker = CircuitBreaker(min_requests=2, recovery_timeout=60)
+
+        class RefusedAsyncOpenFacebook(AsyncOpenFacebook):
+            ## nothing listens on port 1
+            api_url = 'http://127.0.0.1:1/'
+            retry_policy = RetryPolicy(max_attempts=2, backoff=0)
+            circuit_breaker = breaker
+
+        facebook = RefusedAsyncOpenFacebook('token')
+        self.assertRaises(urllib2.URLError, IOLoop.current().run_sync,
+                          facebook.me)
+        self.assertEqual(breaker.get_state('127.0.0.1:1/me'), breaker.OPEN)
+
+
+class TestMap(unittest.TestCase):
+    def test_order_and_errors(self):
+        import time
+        from open_facebook import exceptions as facebook_exceptions
+
+        class SlowGraph(OpenFacebook):
+            def get(self, path, **kwargs):
+                time.sleep(0.1)
+                if path == 'broken':
+                    raise facebook_exceptions.OAuthException(path)
+                return dict(path=path, **kwargs)
+
+        graph = SlowGraph('token')
+        start = time.time()
+        results = graph.map(['a', 'broken', ('get', 'c', dict(limit=1))],
+                            max_workers=3)
+        self.assertTrue(time.time() - start < 0.25)
+        self.assertEqual(results[0], dict(path='a'))
+        self.assertTrue(isinstance(results[1],
+                                   facebook_exceptions.OAuthException))
+        self.assertEqual(results[2], dict(path='c', limit=1))
+
+
+class TestIterate(unittest.TestCase):
+    def get_graph(self):
+        requests = self.requests = []
+
+        class PagedGraph(OpenFacebook):
+            def get(self, path, **kwargs):
+                return self._request('page0')
+
+            def _request(self, url, post_data=None):
+                requests.append(url)
+                page = int(url[len('page'):])
+                response = dict(data=range(page * 3, page * 3 + 3))
+                if page < 3:
+                    response['paging'] = dict(next='page%s' % (page + 1))
+                return response
+        return PagedGraph('token')
+
+    def test_follows_paging(self):
+        graph = self.get_graph()
+        self.assertEqual(list(graph.iterate('me/likes')), range(12))
+        self.assertEqual(len(self.requests), 4)
+
+    def test_budget(self):
+        graph = self.get_graph()
+        self.assertEqual(list(graph.iterate('me/likes', max_items=4)),
+                         range(4))
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(list(graph.iterate('me/likes', max_pages=2)),
+                         range(6))
+
+        ## the budget ends with the page, with or without prefetching
+        del self.requests[:]
+        self.assertEqual(list(graph.iterate('me/likes', max_items=3)),
+                         range(3))
+        self.assertEqual(list(graph.iterate('me/likes', max_items=3,
+                                            prefetch=True)), range(3))
+        self.assertEqual(len(self.requests), 2)
+
+    def test_prefetch(self):
+        graph = self.get_graph()
+        import time
+        items = graph.iterate('me/likes', prefetch=True)
+        items.next()
+        time.sleep(0.1)
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(list(items), range(1, 12))
+
+
+class TestGraphBatch(unittest.TestCase):
+    def get_graph(self):
+        requests = self.requests = []
+
+        class BatchGraph(OpenFacebook):
+            def request(self, path='', post_data=None, **params):
+                operations = json.loads(post_data['batch'])
+                requests.append(operations)
+                error = json.dumps(dict(error=dict(
+                    type='OAuthException', message='(#200) not allowed')))
+                responses = []
+                for operation in operations:
+                    if operation['relative_url'] == 'forbidden':
+                        responses.append(dict(code=403, body=error))
+                    else:
+                        body = json.dumps(dict(url=operation['relative_url']))
+                        responses.append(dict(code=200, body=body))
+                return responses
+        return BatchGraph('token')
+
+    def test_invalidation(self):
+        from open_facebook.cache import ResponseCache
+        graph = self.get_graph()
+        graph.response_cache = cache = ResponseCache()
+        me = cache.parse(graph.api_url + 'me?access_token=token')
+        cache.set(me, '{"id": "1"}')
+        with graph.batch() as batch:
+            batch.get('me')
+        self.assertEqual(cache.get(me), '{"id": "1"}')
+        with graph.batch() as batch:
+            batch.set('me/feed', message='hi')
+        self.assertEqual(cache.get(me), None)
+
+    def test_results(self):
+        from open_facebook import exceptions as facebook_exceptions
+        graph = self.get_graph()
+        with graph.batch() as batch:
+            me = batch.get('me')
+            forbidden = batch.get('forbidden')
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(me.result(), dict(url='me'))
+        self.assertRaises(facebook_exceptions.PermissionException,
+                          forbidden.result)
+
+    def test_split_keeps_dependencies(self):
+        graph = self.get_graph()
+        batch = graph.batch()
+        batch.max_size = 3
+        batch.get('a')
+        batch.get('b')
+        friends = batch.get('me/friends')
+        batch.get('', ids=friends.reference('$.data.*.id'))
+        results = batch.execute()
+        self.assertEqual(len(results), 4)
+        self.assertEqual([len(r) for r in self.requests], [2, 2])
+        self.assertEqual(self.requests[1][1]['depends_on'], friends.name)
+        self.assertTrue('{result=%s:$.data.*.id}' % friends.name in
+                        self.requests[1][1]['relative_url'])
+
+
+class TestSignedRequest(unittest.TestCase):
+    secret = 'secret'
+
+    def sign(self, data, secret=None, digestmod=None):
+        import base64
+        import hashlib
+        import hmac
+        from open_facebook.utils import json
+        payload = base64.urlsafe_b64encode(json.dumps(data)).rstrip('=')
+        signature = hmac.new(secret or self.secret, payload,
+                             digestmod or hashlib.sha256).digest()
+        return '%s.%s' % (base64.urlsafe_b64encode(signature).rstrip('='),
+                          payload)
+
+    def parse(self, signed_request):
+        return FacebookAuthorization.parse_signed_data(signed_request,
+                                                       self.secret)
+
+    def test_valid(self):
+        data = dict(algorithm='HMAC-SHA256', user_id='1', code='a-b_c')
+        self.assertEqual(self.parse(self.sign(data)), data)
+        self.assertEqual(self.parse(unicode(self.sign(data))), data)
+
+    def test_rejected(self):
+        import hashlib
+        import open_facebook.api
+        data = dict(algorithm='HMAC-SHA256', user_id='1')
+        signature, payload = self.sign(data).split('.')
+        tampered = self.sign(dict(data, user_id='2')).split('.')[1]
+        sha1_data = dict(data, algorithm='HMAC-SHA1')
+
+        loads = open_facebook.api.json.loads
+        parsed = []
+        open_facebook.api.json.loads = lambda *a: parsed.append(a)
+        try:
+            for signed_request in ['%s.%s' % (signature, tampered),
+                                   self.sign(data, secret='wrong'),
+                                   'garbage', '.', u'\xe9.\xe9',
+                                   '!!!!.%s' % payload,
+                                   self.sign(sha1_data,
+                                             digestmod=hashlib.sha1)]:
+                self.assertEqual(self.parse(signed_request), None)
+        finally:
+            open_facebook.api.json.loads = loads
+        self.assertEqual(parsed, [])
+        ## a valid signature, but claiming another algorithm
+        self.assertEqual(self.parse(self.sign(sha1_data)), None)
+
+    def test_signature(self):
+        import hashlib
+        import hmac
+        expected = hmac.new('key', 'data', hashlib.sha512).digest()
+        for i in range(2):
+            self.assertEqual(FacebookAuthorization.calculate_signature(
+                'data', 'key', 'HMAC-SHA512'), expected)
+        self.assertTrue(FacebookAuthorization.verify_signature(
+            'data', 'key', expected, 'HMAC-SHA512'))
+        self.assertFalse(FacebookAuthorization.verify_signature(
+            'data', 'key', expected[:-1], 'HMAC-SHA512'))
+        self.assertRaises(ValueError, FacebookAuthorization.calculate_signature,
+                          'data', 'key', 'HMAC-CRC32')
+
+
+class TestAppTokenCache(unittest.TestCase):
+    def setUp(self):
+        from django_facebook import settings as facebook_settings
+        from open_facebook.tests_utils.fake_graph import FakeGraph, \
+            FakeGraphPool
+        from open_facebook.tokens import AppTokenCache
+        self.fake = FakeGraph(facebook_settings.FACEBOOK_APP_ID,
+                              facebook_settings.FACEBOOK_APP_SECRET)
+        self.pool = FakeGraphPool(self.fake).install()
+        self.cache = FacebookAuthorization.app_token_cache
+        FacebookAuthorization.app_token_cache = AppTokenCache(
+            timeout=60, refresh=10)
+
+    def tearDown(self):
+        self.pool.uninstall()
+        FacebookAuthorization.app_token_cache = self.cache
+
+    def get_token_requests(self):
+        return len([r for r in self.fake.requests
+                    if r[1] == 'oauth/access_token'])
+
+    def test_cached(self):
+        import time
+        token = FacebookAuthorization.get_app_access_token()
+        self.assertEqual(token, self.fake.app_access_token)
+        FacebookAuthorization.create_test_user()
+        FacebookAuthorization.get_or_create_test_user()
+        self.assertEqual(self.get_token_requests(), 1)
+
+        ## due for a refresh
+        cache = FacebookAuthorization.app_token_cache
+        key = cache.get_key(self.fake.app_id, self.fake.app_secret)
+        cache._tokens[key] = (token, time.time() + 5)
+        self.assertEqual(cache.get_valid(self.fake.app_id,
+                                         self.fake.app_secret), None)
+        FacebookAuthorization.get_app_access_token()
+        self.assertEqual(self.get_token_requests(), 2)
+        self.assertTrue(cache._tokens[key][1] > time.time() + 50)
+
+    def test_concurrent_apps(self):
+        import threading
+        from open_facebook.tokens import AppTokenCache
+        cache = AppTokenCache(backend='default', refresh=10)
+        ## resolved on first use, not at import time
+        self.assertEqual(cache._backend, None)
+        fetching = threading.Event()
+        release = threading.Event()
+
+        def slow_fetch(app_id, secret):
+            fetching.set()
+            release.wait(5)
+            return 'slow_token', 60
+        thread = threading.Thread(
+            target=cache.get, args=('slow', 'secret', slow_fetch))
+        thread.start()
+        try:
+            fetching.wait(5)
+            ## another app doesn't wait for the slow fetch
+            token = cache.get('fast', 'secret',
+                              lambda app_id, secret: ('fast_token', 60))
+            self.assertEqual(token, 'fast_token')
+            self.assertTrue(thread.is_alive())
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual(cache.get_valid('slow', 'secret'), 'slow_token')
+        cache.backend.delete(cache.get_key('slow', 'secret'))
+        cache.backend.delete(cache.get_key('fast', 'secret'))
+
+    def test_response_cache(self):
+        from open_facebook.cache import ResponseCache
+        response_cache = FacebookConnection.response_cache
+        FacebookConnection.response_cache = ResponseCache()
+        try:
+            cache = FacebookAuthorization.app_token_cache
+            token = FacebookAuthorization.get_app_access_token()
+            cache.invalidate(self.fake.app_id, self.fake.app_secret, token)
+            FacebookAuthorization.get_app_access_token()
+        finally:
+            FacebookConnection.response_cache = response_cache
+        self.assertEqual(self.get_token_requests(), 2)
+
+    def test_refresh_failure(self):
+        import time
+        cache = FacebookAuthorization.app_token_cache
+        cache.set('1', 'secret', 'old', 5)
+
+        def fetch(app_id, secret):
+            raise facebook_exceptions.OAuthException('down')
+        self.assertEqual(cache.get('1', 'secret', fetch), 'old')
+        cache.set('1', 'secret', 'old', -1)
+        self.assertRaises(facebook_exceptions.OAuthException,
+                          cache.get, '1', 'secret', fetch)
+
+    def test_rejected_token(self):
+        FacebookAuthorization.get_app_access_token()
+        ## the app secret was reset
+        self.fake.app_access_token = '%s|new' % self.fake.app_id
+        user = FacebookAuthorization.create_test_user()
+        self.assertTrue(user['access_token'])
+        self.assertEqual(FacebookAuthorization.get_app_access_token(),
+                         self.fake.app_access_token)
+        self.assertEqual(self.get_token_requests(), 2)
+        self.assertRaises(facebook_exceptions.OAuthException,
+                          FacebookAuthorization.create_test_user, 'dead')
+
+
+class TestMultipart(unittest.TestCase):
+    def parse(self, body):
+        import cgi
+        from StringIO import StringIO
+        data = body.read()
+        self.assertEqual(len(data), len(body))
+        return cgi.FieldStorage(fp=StringIO(data), environ=dict(
+            REQUEST_METHOD='POST', CONTENT_TYPE=body.content_type,
+            CONTENT_LENGTH=str(len(data))))
+
+    def test_body(self):
+        import mmap
+        import tempfile
+        from StringIO import StringIO
+        from open_facebook.multipart import MultipartBody, Upload
+        image = ''.join([chr(i % 256) for i in range(200000)])
+        image_file = tempfile.TemporaryFile()
+        image_file.write(image)
+        image_file.seek(0)
+        mapped = mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ)
+        progress = []
+        body = MultipartBody(dict(
+            message=u'J\xe9r\xf4me', source=image_file,
+            mapped=Upload(mapped, 'photo.jpg',
+                          progress=lambda *args: progress.append(args)),
+            text=StringIO('text')))
+
+        chunk = body.read(8192)
+        self.assertTrue(0 < len(chunk) <= 8192)
+        body.seek(0)
+        form = self.parse(body)
+        self.assertEqual(form['message'].value, 'J\xc3\xa9r\xc3\xb4me')
+        self.assertEqual(form['source'].value, image)
+        self.assertEqual(form['mapped'].value, image)
+        self.assertEqual(form['mapped'].filename, 'photo.jpg')
+        self.assertEqual(form['mapped'].type, 'image/jpeg')
+        self.assertEqual(form['text'].value, 'text')
+        self.assertEqual(progress[-1], (len(image), len(image)))
+        self.assertTrue(len(progress) > 3)
+
+    def test_upload(self):
+        import tempfile
+        from open_facebook.tests_utils.fake_graph import FakeGraph, \
+            FakeGraphServer
+        fake = FakeGraph()
+        token = fake.add_user()
+        server = FakeGraphServer(fake).start()
+        photo = tempfile.NamedTemporaryFile(suffix='.jpg')
+        photo.write('x' * 100000)
+        photo.seek(0)
+        try:
+            graph = OpenFacebook(token)
+            graph.api_url = server.base_url
+            response = graph.set('me/photos', source=photo, message='hi')
+            photos = graph.get('me/photos')['data']
+        finally:
+            server.stop()
+            FacebookConnection.connection_pool.clear()
+        self.assertEqual(photos[0]['id'], response['id'])
+        self.assertEqual(photos[0]['message'], 'hi')
+        self.assertTrue(photo.name.endswith(photos[0]['source']))
+
+
+class TestFakeGraph(unittest.TestCase):
+    def setUp(self):
+        from open_facebook.tests_utils.fake_graph import FakeGraph
+        self.fake = FakeGraph(app_id='42', app_secret='secret', seed=1)
+        likes = [dict(id=str(i), name='Like %s' % i) for i in range(30)]
+        self.token = self.fake.add_user(
+            dict(id='1', name='Thierry', email='thierry@example.com'),
+            likes=likes, permissions=['email'])
+
+    def test_in_process(self):
+        from open_facebook.tests_utils.fake_graph import FakeGraphPool
+        with FakeGraphPool(self.fake):
+            graph = OpenFacebook(self.token)
+            self.assertEqual(graph.me(fields=['id', 'name']),
+                             dict(id='1', name='Thierry'))
+            self.assertEqual(graph.get('me/permissions')['data'],
+                             [dict(email=1)])
+            likes = list(graph.iterate('me/likes', page_size=10))
+            self.assertEqual(len(likes), 30)
+            self.assertEqual(likes[-1]['name'], 'Like 29')
+            post = graph.set('me/feed', message='hello')
+            self.assertEqual(graph.get('me/feed')['data'][0]['id'],
+                             post['id'])
+            self.assertRaises(facebook_exceptions.OAuthException,
+                              OpenFacebook('unknown').get, 'me')
+            fql = graph.fql('SELECT uid, name FROM user WHERE uid = me()')
+            self.assertEqual(fql, [dict(uid='1', name='Thierry')])
+            self.assertEqual(graph.fql_multi(dict(
+                me='SELECT uid FROM user WHERE uid = me()')),
+                dict(me=[dict(uid='1')]))
+
+    def test_server_and_batch(self):
+        from open_facebook.tests_utils.fake_graph import FakeGraphServer
+        server = FakeGraphServer(self.fake).start()
+        try:
+            graph = OpenFacebook(self.token)
+            graph.api_url = graph.old_api_url = server.base_url
+            batch = graph.batch()
+            likes = batch.get('me/likes', limit=2)
+            me = batch.get('', ids=likes.reference('$.data.*.id'))
+            batch.execute()
+            self.assertEqual(sorted(me.result().keys()), ['0', '1'])
+        finally:
+            server.stop()
+            FacebookConnection.connection_pool.clear()
+
+    def test_faults(self):
+        import time
+        from open_facebook.tests_utils.fake_graph import FakeGraphPool
+        self.fake.latency = 0.05
+        self.fake.throttle = (2, 60)
+        with FakeGraphPool(self.fake):
+            graph = OpenFacebook(self.token)
+            start = time.time()
+            graph.get('me')
+            self.assertTrue(time.time() - start >= 0.05)
+            graph.get('me')
+            self.assertRaises(facebook_exceptions.OpenFacebookException,
+                              graph.get, 'me')
+        self.fake.latency = 0
+        self.fake.throttle = None
+        self.fake.error_rate = 1
+        self.assertEqual(self.fake.handle('GET', 'http://x/me')[0], 500)
+
+    def test_cassette(self):
+        import os
+        import tempfile
+        from open_facebook.tests_utils.fake_graph import Cassette, \
+            CassettePool, FakeGraphPool
+        path = os.path.join(tempfile.mkdtemp(), 'me.json')
+        with CassettePool(path, record=True, pool=FakeGraphPool(self.fake)):
+            recorded = OpenFacebook(self.token).get('me')
+        self.assertFalse(self.token in open(path).read())
+        requests = len(self.fake.requests)
+        with CassettePool(Cassette(path)):
+            self.assertEqual(OpenFacebook(self.token).get('me'), recorded)
+            self.assertRaises(LookupError, OpenFacebook(self.token).get,
+                              'me/likes')
+        self.assertEqual(len(self.fake.requests), requests)
+
+    def test_cassette_redaction(self):
+        import os
+        import tempfile
+        from open_facebook.tests_utils.fake_graph import CassettePool, \
+            FakeGraphPool
+        path = os.path.join(tempfile.mkdtemp(), 'tokens.json')
+        with CassettePool(path, record=True, pool=FakeGraphPool(self.fake)):
+            graph = OpenFacebook()
+            graph.get('oauth/access_token', client_id='42',
+                      client_secret='secret', grant_type='client_credentials')
+            test_user = FacebookAuthorization.create_test_user(
+                app_access_token=self.fake.app_access_token)
+        recorded = open(path).read()
+        self.assertFalse('42|secret' in recorded)
+        self.assertFalse('42%7Csecret' in recorded)
+        self.assertFalse(test_user['access_token'] in recorded)
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_run_and_compare(self):
+        from open_facebook.benchmarks import runner
+        results = runner.run('^signed_request.parse$', repeat=2,
+                             min_time=0.001)
+        result = results['benchmarks']['signed_request.parse']
+        self.assertTrue(0 < result['best'] <= result['median'])
+
+        baseline = dict(benchmarks={
+            'signed_request.parse': dict(best=result['best'] / 2),
+            'removed': dict(best=1)})
+        rows, regressions = runner.compare(baseline, results, threshold=0.5)
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(regressions, rows)
+        rows, regressions = runner.compare(baseline, results, threshold=1.5)
+        self.assertEqual(regressions, [])
+        self.assertTrue('signed_request.parse' in runner.load()['benchmarks'])
+
+
 if __name__ == '__main__':
     import logging
     handler = logging.StreamHandler()
@@ -0,0 +1,623 @@
+"""A fake Graph API, to test and benchmark Open Facebook offline.
+
+:class:`FakeGraph` implements the parts of the Graph API this project
+uses: ``me`` (and user ids), ``me/likes``, ``me/permissions``,
+``me/feed``, ``me/photos``, ``oauth/access_token``, ``fql.query``,
+``fql.multiquery``, the test user endpoints and batch requests. Failures
+can be injected using ``latency``, ``error_rate`` and ``throttle``.
+
+Use it in-process, replacing the connection pool::
+
+    graph = FakeGraph()
+    token = graph.add_user(dict(name='Thierry Schellenbach'))
+    with FakeGraphPool(graph):
+        print OpenFacebook(token).me()
+
+Or on localhost, with the real connection pool::
+
+    server = FakeGraphServer(graph).start()
+    OpenFacebook.api_url = OpenFacebook.old_api_url = server.base_url
+    ...
+    server.stop()
+
+:class:`CassettePool` records real responses to a json file and replays
+them later, which makes tests against the live API reproducible.
+"""
+
+import cgi
+import hashlib
+import itertools
+import logging
+import random
+import re
+import threading
+import time
+import urllib
+import urlparse
+from StringIO import StringIO
+
+from open_facebook.tracing import redact
+from open_facebook.utils import json
+
+logger = logging.getLogger(__name__)
+
+FQL_RE = re.compile(r'^\s*SELECT\s+(?P<fields>.+?)\s+FROM\s+(?P<table>\w+)',
+                    re.IGNORECASE)
+REFERENCE_RE = re.compile(r'\{result=([^:]+):([^}]+)\}')
+
+
+class FakeResponse(object):
+    """Mimics the :class:`open_facebook.pool.PooledResponse` interface"""
+    def __init__(self, status, body, headers=None, path=None):
+        self.code = status
+        self.msg = ''
+        self.headers = Headers(headers or {})
+        self.path = path
+        self.content_encoding = ''
+        self._body = StringIO(body)
+        self.bytes_received = self.bytes_decoded = 0
+
+    def read(self, amt=None):
+        data = self._body.read() if amt is None else self._body.read(amt)
+        self.bytes_received += len(data)
+        self.bytes_decoded += len(data)
+        return data
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.code
+
+    def close(self):
+        pass
+
+
+class Headers(dict):
+    """Case insensitive headers"""
+    def __init__(self, headers):
+        dict.__init__(self, [(k.lower(), v) for k, v in headers.items()])
+
+    def get(self, name, default=None):
+        return dict.get(self, name.lower(), default)
+
+    def getheader(self, name, default=None):
+        return self.get(name, default)
+
+
+class FakeGraph(object):
+    """
+    :param latency: seconds to wait before every response, or a
+        ``(min, max)`` tuple to wait a random amount of time
+    :param error_rate: the fraction of requests failing with a 500
+    :param throttle: ``(number of requests, seconds)`` allowed per access
+        token, further requests fail with Facebook's rate limit error
+    :param seed: seeds the random generator, for reproducible runs
+    """
+    def __init__(self, app_id='1', app_secret='secret', latency=0,
+                 error_rate=0, throttle=None, seed=None):
+        self.app_id = str(app_id)
+        self.app_secret = app_secret
+        self.app_access_token = '%s|%s' % (self.app_id, app_secret)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle = throttle
+        self.random = random.Random(seed)
+        self.users = {}
+        self.objects = {}
+        self.test_users = []
+        self.codes = {}
+        self.requests = []
+        self._ids = itertools.count(100001)
+        self._windows = {}
+        self._lock = threading.RLock()
+
+    ## setup
+
+    def add_user(self, profile=None, likes=(), friends=(), permissions=(),
+                 access_token=None):
+        """Adds a user and returns its access token"""
+        user_id = str(self._next_id())
+        user = dict(id=user_id, name='User %s' % user_id)
+        user.update(profile or {})
+        user['id'] = str(user['id'])
+        access_token = access_token or 'token-%s' % user['id']
+        self.objects[user['id']] = user
+        for item in itertools.chain(likes, friends):
+            self.objects.setdefault(str(item['id']), item)
+        self.users[access_token] = dict(
+            profile=user, likes=list(likes), friends=list(friends),
+            permissions=dict([(p, 1) for p in permissions]),
+            feed=[], photos=[])
+        return access_token
+
+    def add_code(self, code, access_token):
+        """Makes ``code`` convertable into ``access_token``"""
+        self.codes[code] = access_token
+
+    ## request handling
+
+    def handle(self, method, url, data=None, headers=None):
+        """Returns ``(status, body, headers)`` for the request"""
+        scheme, host, path, query, fragment = urlparse.urlsplit(url)
+        params = dict(urlparse.parse_qsl(query, keep_blank_values=True))
+        content_type = (Headers(headers or {}).get('Content-Type') or '')
+        if data:
+            params.update(self._parse_body(data, content_type))
+        method = params.pop('method', method).upper()
+        path = path.strip('/')
+        if path.startswith('method/'):
+            path = path[len('method/'):]
+        self.requests.append((method, path))
+        base_url = '%s://%s/' % (scheme, host)
+
+        self._sleep()
+        access_token = params.get('access_token')
+        self._lock.acquire()
+        try:
+            if self.error_rate and self.random.random() < self.error_rate:
+                status, body = self._error(
+                    500, 2, 'OAuthException',
+                    '(#2) Service temporarily unavailable')
+            elif self._throttled(access_token):
+                status, body = self._error(
+                    400, 17, 'OAuthException',
+                    '(#17) User request limit reached')
+            else:
+                status, body = self.dispatch(method, path, params, base_url)
+        finally:
+            self._lock.release()
+        if not isinstance(body, basestring):
+            body = json.dumps(body)
+        return status, body, {'Content-Type': 'text/javascript'}
+
+    def dispatch(self, method, path, params, base_url):
+        """Returns ``(status, response)`` for a request without the
+        injected failures
+        """
+        segments = path.split('/') if path else []
+        if path == 'oauth/access_token':
+            return self.access_token(params)
+        if path == 'fql.query':
+            return self.fql(params)
+        if path == 'fql.multiquery':
+            return self.fql_multi(params)
+        if not segments and method == 'POST' and 'batch' in params:
+            return self.batch(params, base_url)
+        if len(segments) == 3 and segments[1:] == ['accounts', 'test-users']:
+            return self.test_user(method, params)
+
+        user = self.get_user(params.get('access_token'))
+        if user is None and params.get('access_token') != \
+                self.app_access_token:
+            return self._error(400, 190, 'OAuthException',
+                               'Invalid OAuth access token.')
+        if not segments and 'ids' in params:
+            ids = [i for i in params['ids'].split(',') if i]
+            missing = [i for i in ids if i not in self.objects]
+            if missing:
+                return self._error(404, 803, 'OAuthException',
+                                   '(#803) Some of the aliases you '
+                                   'requested do not exist: %s' %
+                                   ','.join(missing))
+            return 200, dict([(i, self._project(self.objects[i], params))
+                              for i in ids])
+        if segments and segments[0] != 'me':
+            obj = self.objects.get(segments[0])
+            if obj is None:
+                return self._error(404, 803, 'OAuthException',
+                                   '(#803) Some of the aliases you '
+                                   'requested do not exist: %s' % segments[0])
+            user = self.get_user_by_id(segments[0])
+            if user is None:
+                if len(segments) == 1:
+                    return 200, self._project(obj, params)
+                return self._error(400, 100, 'GraphMethodException',
+                                   'Unsupported get request.')
+        elif user is None:
+            return self._error(400, 2500, 'OAuthException',
+                               'An active access token must be used to '
+                               'query information about the current user.')
+        connection = '/'.join(segments[1:])
+        if not connection:
+            return 200, self._project(user['profile'], params)
+        if connection == 'likes':
+            return 200, self._page(user['likes'], params, path, base_url)
+        if connection == 'friends':
+            return 200, self._page(user['friends'], params, path, base_url)
+        if connection == 'permissions':
+            return 200, dict(data=[user['permissions']])
+        if connection in ('feed', 'photos'):
+            items = user[connection]
+            if method == 'POST':
+                item = dict(params)
+                item.pop('access_token', None)
+                item['id'] = '%s_%s' % (user['profile']['id'],
+                                        self._next_id())
+                items.insert(0, item)
+                return 200, dict(id=item['id'])
+            return 200, self._page(items, params, path, base_url)
+        return self._error(400, 100, 'GraphMethodException',
+                           'Unsupported get request.')
+
+    def get_user(self, access_token):
+        return self.users.get(access_token)
+
+    def get_user_by_id(self, user_id):
+        for user in self.users.values():
+            if user['profile']['id'] == user_id:
+                return user
+
+    ## endpoints
+
+    def access_token(self, params):
+        if params.get('grant_type') == 'client_credentials':
+            if params.get('client_secret') != self.app_secret:
+                return self._error(400, 1, 'OAuthException',
+                                   'Error validating client secret.')
+            return 200, 'access_token=%s' % urllib.quote(
+                self.app_access_token)
+        access_token = self.codes.get(params.get('code'))
+        if access_token is None:
+            return self._error(400, 100, 'OAuthException',
+                               'Error validating verification code.')
+        return 200, urllib.urlencode(dict(access_token=access_token,
+                                          expires=5183999))
+
+    def fql(self, params):
+        user = self.get_user(params.get('access_token'))
+        match = FQL_RE.match(params.get('query', ''))
+        if user is None:
+            return 200, dict(error_code=190, error_msg='Invalid OAuth 2.0 '
+                             'Access Token', request_args=[])
+        if not match:
+            return 200, dict(error_code=601, error_msg='Parser error: '
+                             'unexpected end of query.', request_args=[])
+        fields = [f.strip() for f in match.group('fields').split(',')]
+        table = match.group('table').lower()
+        if table == 'permissions':
+            rows = [user['permissions']]
+        elif table == 'user' and 'friend' in params['query']:
+            rows = [dict(f, uid=f.get('uid', f.get('id')))
+                    for f in user['friends']]
+        elif table == 'user':
+            rows = [dict(user['profile'], uid=user['profile']['id'])]
+        else:
+            rows = []
+        return 200, [dict([(f, row.get(f)) for f in fields])
+                     for row in rows]
+
+    def fql_multi(self, params):
+        """Runs every query on its own, ``#name`` references aren't
+        resolved
+        """
+        results = []
+        for name, query in sorted(json.loads(params['queries']).items()):
+            status, rows = self.fql(dict(params, query=query))
+            if isinstance(rows, dict):
+                return status, rows
+            results.append(dict(name=name, fql_result_set=rows))
+        return 200, results
+
+    def test_user(self, method, params):
+        if params.get('access_token') != self.app_access_token:
+            return self._error(400, 190, 'OAuthException',
+                               'Invalid OAuth access token.')
+        if method == 'POST':
+            permissions = params.get('permissions') or ''
+            access_token = self.add_user(
+                dict(name=params.get('name', 'Test User')),
+                permissions=[p for p in permissions.split(',') if p])
+            user = self.users[access_token]['profile']
+            test_user = dict(
+                id=user['id'], access_token=access_token,
+                login_url='https://www.facebook.com/platform/'
+                          'test_account_login.php?user_id=%s' % user['id'],
+                email='%s@tfbnw.net' % user['id'], password='password')
+            self.test_users.append(test_user)
+            return 200, test_user
+        return 200, dict(data=[dict(id=u['id'], access_token=u['access_token'],
+                                    login_url=u['login_url'])
+                               for u in self.test_users])
+
+    def batch(self, params, base_url):
+        operations = json.loads(params['batch'])
+        results = []
+        named = {}
+        for operation in operations:
+            relative_url = operation['relative_url']
+            relative_url = REFERENCE_RE.sub(
+                lambda m: self._reference(named, *m.groups()), relative_url)
+            url = base_url + relative_url
+            if 'access_token' not in relative_url:
+                separator = '&' if '?' in url else '?'
+                url += separator + urllib.urlencode(
+                    dict(access_token=params.get('access_token', '')))
+            body = operation.get('body')
+            status, response = self.dispatch(
+                operation.get('method', 'GET').upper(),
+                urlparse.urlsplit(url)[2].strip('/'),
+                self._params(url, body), base_url)
+            if not isinstance(response, basestring):
+                response = json.dumps(response)
+            if operation.get('name'):
+                named[operation['name']] = response
+            results.append(dict(code=status, headers=[], body=response))
+        return 200, results
+
+    ## helpers
+
+    def _params(self, url, body=None):
+        params = dict(urlparse.parse_qsl(urlparse.urlsplit(url)[3],
+                                         keep_blank_values=True))
+        if body:
+            params.update(urlparse.parse_qsl(body, keep_blank_values=True))
+        return params
+
+    def _reference(self, named, name, jsonpath):
+        """Resolves the simple ``$.data.*.id`` style references"""
+        values = [json.loads(named[name])]
+        for part in jsonpath.lstrip('$').strip('.').split('.'):
+            if part == '*':
+                values = [v for value in values for v in value]
+            else:
+                values = [value[part] for value in values]
+        return ','.join([unicode(v) for v in values])
+
+    def _parse_body(self, data, content_type):
+        if content_type.startswith('multipart/form-data'):
+            form = cgi.FieldStorage(fp=StringIO(data), environ=dict(
+                REQUEST_METHOD='POST', CONTENT_TYPE=content_type,
+                CONTENT_LENGTH=str(len(data))))
+            params = {}
+            for key in form.keys():
+                field = form[key]
+                params[key] = field.filename or field.value
+            return params
+        return urlparse.parse_qsl(data, keep_blank_values=True)
+
+    def _project(self, profile, params):
+        fields = params.get('fields')
+        if not fields:
+            return profile
+        return dict([(f, profile[f]) for f in fields.split(',')
+                     if f in profile])
+
+    def _page(self, items, params, path, base_url):
+        limit = int(params.get('limit') or 25)
+        offset = int(params.get('offset') or 0)
+        data = [self._project(item, params)
+                for item in items[offset:offset + limit]]
+        response = dict(data=data, paging={})
+        if offset + limit < len(items):
+            next_params = dict(params, limit=limit, offset=offset + limit)
+            response['paging']['next'] = '%s%s?%s' % (
+                base_url, path, urllib.urlencode(next_params))
+        return response
+
+    def _error(self, status, code, type, message):
+        return status, dict(error=dict(type=type, message=message,
+                                       code=code))
+
+    def _throttled(self, access_token):
+        if not self.throttle:
+            return False
+        limit, period = self.throttle
+        window = int(time.time() // period)
+        key = (access_token, window)
+        self._windows[key] = count = self._windows.get(key, 0) + 1
+        return count > limit
+
+    def _sleep(self):
+        latency = self.latency
+        if isinstance(latency, tuple):
+            latency = self.random.uniform(*latency)
+        if latency:
+            time.sleep(latency)
+
+    def _next_id(self):
+        self._lock.acquire()
+        try:
+            return self._ids.next()
+        finally:
+            self._lock.release()
+
+
+class FakeGraphPool(object):
+    """Replaces ``FacebookConnection.connection_pool``, answering every
+    request from ``graph`` without any sockets. Works as context manager,
+    or call :meth:`install` and :meth:`uninstall` yourself.
+    """
+    def __init__(self, graph):
+        self.graph = graph
+        self._previous = None
+
+    def urlopen(self, url, data=None, headers=None, timeout=None):
+        method = 'GET' if data is None else 'POST'
+        if hasattr(data, 'read'):
+            data = data.read()
+        status, body, response_headers = self.graph.handle(
+            method, url, data, headers)
+        return FakeResponse(status, body, response_headers,
+                            urlparse.urlsplit(url)[2])
+
+    def clear(self):
+        pass
+
+    def install(self):
+        from open_facebook.api import FacebookConnection
+        self._previous = FacebookConnection.connection_pool
+        FacebookConnection.connection_pool = self
+        return self
+
+    def uninstall(self):
+        from open_facebook.api import FacebookConnection
+        FacebookConnection.connection_pool = self._previous
+
+    def __enter__(self):
+        return self.install()
+
+    def __exit__(self, *exc_info):
+        self.uninstall()
+
+
+class FakeGraphServer(object):
+    """Serves ``graph`` over http on localhost, from a background thread"""
+    def __init__(self, graph, host='127.0.0.1', port=0):
+        self.graph = graph
+        self.host = host
+        self.port = port
+        self.server = None
+
+    def start(self):
+        import BaseHTTPServer
+        import SocketServer
+        graph = self.graph
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            ## send the headers and body without waiting for delayed acks
+            disable_nagle_algorithm = True
+            wbufsize = -1
+
+            def do_GET(self, data=None):
+                url = 'http://%s%s' % (self.headers.get('Host'), self.path)
+                status, body, headers = graph.handle(
+                    self.command, url, data, dict(self.headers.items()))
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                self.do_GET(self.rfile.read(length))
+
+            def log_message(self, *args):
+                pass
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.server = Server((self.host, self.port), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    @property
+    def base_url(self):
+        return 'http://%s:%s/' % self.server.server_address[:2]
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class Cassette(object):
+    """Recorded responses, stored as json in ``path``.
+
+    Requests are matched on method, url and body, with access tokens and
+    other secrets redacted, which are redacted from the recorded
+    responses as well. Repeated requests replay the recorded responses
+    in order.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.interactions = []
+        self._played = {}
+        try:
+            cassette_file = open(path)
+        except IOError:
+            pass
+        else:
+            try:
+                self.interactions = json.load(cassette_file)
+            finally:
+                cassette_file.close()
+
+    @classmethod
+    def get_key(cls, method, url, data=None):
+        scheme, host, path, query, fragment = urlparse.urlsplit(url)
+        query = urllib.urlencode(sorted(urlparse.parse_qsl(
+            query, keep_blank_values=True)))
+        return [method, redact('%s%s?%s' % (host, path, query)),
+                redact(data or '')]
+
+    def play(self, method, url, data=None):
+        """Returns the next recorded interaction for this request"""
+        key = self.get_key(method, url, data)
+        index = self._played.get(repr(key), 0)
+        matches = [i for i in self.interactions if i['request'] == key]
+        if index >= len(matches):
+            raise LookupError('%s %s was not recorded in %s' % (
+                key[0], key[1], self.path))
+        self._played[repr(key)] = index + 1
+        return matches[index]['response']
+
+    def record(self, method, url, data, status, body, headers):
+        self.interactions.append(dict(
+            request=self.get_key(method, url, data),
+            response=dict(status=status, body=redact(body),
+                          headers=headers)))
+
+    def save(self):
+        cassette_file = open(self.path, 'w')
+        try:
+            json.dump(self.interactions, cassette_file, indent=1)
+        finally:
+            cassette_file.close()
+
+
+class CassettePool(FakeGraphPool):
+    """Connection pool replaying a :class:`Cassette`.
+
+    In record mode requests are sent using the real ``pool`` and the
+    responses are added to the cassette, call ``cassette.save()`` (or
+    leave the ``with`` block) to write them.
+    """
+    def __init__(self, cassette, record=False, pool=None):
+        if isinstance(cassette, basestring):
+            cassette = Cassette(cassette)
+        self.cassette = cassette
+        self.record = record
+        self.pool = pool
+        self._previous = None
+
+    def urlopen(self, url, data=None, headers=None, timeout=None):
+        method = 'GET' if data is None else 'POST'
+        path = urlparse.urlsplit(url)[2]
+        key_data = data
+        if hasattr(data, 'read'):
+            ## multipart uploads use a random boundary and binary data
+            boundary = data.boundary
+            data = data.read()
+            key_data = 'multipart:%s' % hashlib.sha1(
+                data.replace(boundary, '')).hexdigest()
+        if not self.record:
+            response = self.cassette.play(method, url, key_data)
+            return FakeResponse(response['status'],
+                                response['body'].encode('utf8'),
+                                response['headers'], path)
+
+        pool = self.pool or self._previous
+        response_file = pool.urlopen(url, data, headers=headers,
+                                     timeout=timeout)
+        try:
+            body = response_file.read()
+        finally:
+            response_file.close()
+        response_headers = {}
+        for key in ('content-type', 'etag'):
+            if response_file.headers.get(key):
+                response_headers[key] = response_file.headers.get(key)
+        self.cassette.record(method, url, key_data, response_file.code,
+                             body.decode('utf8'), response_headers)
+        return FakeResponse(response_file.code, body, response_headers, path)
+
+    def uninstall(self):
+        FakeGraphPool.uninstall(self)
+        if self.record:
+            self.cassette.save()
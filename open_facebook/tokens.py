@@ -0,0 +1,153 @@
+"""Caching of app access tokens.
+
+An app access token used to cost a request to ``oauth/access_token`` every
+time it was needed. :class:`AppTokenCache` keeps them per app id and
+secret, in process and optionally in a Django cache shared between the
+processes:
+
+- tokens are used for ``FACEBOOK_APP_TOKEN_TIMEOUT`` seconds, or until
+  the ``expires`` Facebook returned
+- within ``FACEBOOK_APP_TOKEN_REFRESH`` seconds of that a single caller
+  fetches a new token, the others keep using the current one meanwhile
+- tokens rejected by Facebook are dropped, see :meth:`invalidate`
+
+``FacebookAuthorization.get_app_access_token`` goes through
+``FacebookAuthorization.app_token_cache``.
+"""
+
+import hashlib
+import logging
+import threading
+import time
+
+from open_facebook.utils import get_django_cache
+
+logger = logging.getLogger(__name__)
+
+
+class AppTokenCache(object):
+    """
+    :param backend: the name of the Django cache shared between processes,
+        ``None`` to only keep the tokens in this process
+    :param timeout: seconds a token is used for when Facebook doesn't
+        say when it expires
+    :param refresh: seconds before expiry a new token is fetched
+    """
+    def __init__(self, backend=None, timeout=86400, refresh=300):
+        self.timeout = timeout
+        self.refresh = refresh
+        self.backend_name = backend
+        self._backend = None
+        self._lock = threading.Lock()
+        self._tokens = {}
+        self._refreshing = set()
+        self._fetch_locks = {}
+
+    @property
+    def backend(self):
+        if self._backend is None and self.backend_name:
+            self._backend = get_django_cache(self.backend_name)
+        return self._backend
+
+    @classmethod
+    def get_key(cls, app_id, secret):
+        """Returns the cache key, the secret is only included hashed"""
+        return 'open_facebook:app_token:%s' % hashlib.sha1(
+            '%s:%s' % (app_id, secret)).hexdigest()
+
+    def get(self, app_id, secret, fetch):
+        """Returns the app access token, calling
+        ``fetch(app_id, secret)`` for a ``(token, expires_in)`` tuple when
+        there is no valid token or it is due for a refresh
+        """
+        key = self.get_key(app_id, secret)
+        entry = self._get_entry(key)
+        now = time.time()
+        if entry is not None:
+            token, expires_at = entry
+            if now < expires_at - self.refresh:
+                return token
+            if now < expires_at:
+                ## refresh early, unless another caller already does
+                self._lock.acquire()
+                try:
+                    refreshing = key in self._refreshing
+                    self._refreshing.add(key)
+                finally:
+                    self._lock.release()
+                if refreshing:
+                    return token
+                try:
+                    return self.set(app_id, secret, *fetch(app_id, secret))
+                except Exception, e:
+                    logger.warn('refreshing the app access token failed: %s',
+                                e)
+                    return token
+                finally:
+                    self._lock.acquire()
+                    self._refreshing.discard(key)
+                    self._lock.release()
+
+        ## no usable token, fetch one for all callers waiting on this app
+        fetch_lock = self._get_fetch_lock(key)
+        fetch_lock.acquire()
+        try:
+            entry = self._tokens.get(key)
+            if entry is not None and time.time() < entry[1]:
+                return entry[0]
+            return self.set(app_id, secret, *fetch(app_id, secret))
+        finally:
+            fetch_lock.release()
+
+    def get_valid(self, app_id, secret):
+        """Returns the cached token if it doesn't need a refresh yet, for
+        callers fetching tokens themselves, like the async client
+        """
+        entry = self._get_entry(self.get_key(app_id, secret))
+        if entry is not None and time.time() < entry[1] - self.refresh:
+            return entry[0]
+
+    def set(self, app_id, secret, token, expires_in=None):
+        """Stores ``token`` and returns it"""
+        timeout = expires_in or self.timeout
+        entry = (token, time.time() + timeout)
+        key = self.get_key(app_id, secret)
+        self._tokens[key] = entry
+        if self.backend is not None:
+            self.backend.set(key, entry, timeout)
+        return token
+
+    def invalidate(self, app_id, secret, token):
+        """Drops ``token``, for example after Facebook rejected it. A
+        newer token, fetched meanwhile, is kept.
+        """
+        key = self.get_key(app_id, secret)
+        entry = self._tokens.get(key)
+        if entry is not None and entry[0] == token:
+            self._tokens.pop(key, None)
+        if self.backend is not None:
+            entry = self.backend.get(key)
+            if entry is not None and entry[0] == token:
+                self.backend.delete(key)
+        logger.info('dropped the app access token of app %s', app_id)
+
+    def clear(self):
+        self._tokens.clear()
+
+    def _get_fetch_lock(self, key):
+        self._lock.acquire()
+        try:
+            fetch_lock = self._fetch_locks.get(key)
+            if fetch_lock is None:
+                fetch_lock = self._fetch_locks[key] = threading.Lock()
+            return fetch_lock
+        finally:
+            self._lock.release()
+
+    def _get_entry(self, key):
+        entry = self._tokens.get(key)
+        if entry is None and self.backend is not None:
+            entry = self.backend.get(key)
+            if entry is not None:
+                self._tokens[key] = entry
+        return entry
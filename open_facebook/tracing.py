@@ -0,0 +1,98 @@
+"""Sampled logging of Graph API requests and responses.
+
+Logging every url and response at INFO leaks access tokens into the logs
+and formatting large responses costs real CPU. The :class:`Tracer` only
+logs a sample of the requests, through the ``open_facebook.api`` logger:
+
+- tokens, secrets and codes are redacted from urls and payloads
+- payload previews are capped at ``max_length`` characters
+- messages are formatted lazily, skipped requests or a disabled INFO
+  level cost a single random number
+
+Configure it using ``FACEBOOK_TRACE_SAMPLE_RATE`` (the fraction of
+requests to log, 0 disables tracing) and ``FACEBOOK_TRACE_MAX_LENGTH``.
+"""
+
+import logging
+import random
+import re
+import time
+
+SENSITIVE_KEYS = ('access_token', 'client_secret', 'code', 'signed_request')
+SENSITIVE_RE = re.compile(r'\b(%s)=[^&\s"\']*' % '|'.join(SENSITIVE_KEYS))
+JSON_SENSITIVE_RE = re.compile(r'("(?:%s)"\s*:\s*)"(?:[^"\\]|\\.)*"'
+                               % '|'.join(SENSITIVE_KEYS))
+REDACTED = '<redacted>'
+
+
+def redact(text):
+    """Replaces the values of sensitive url parameters and json keys"""
+    text = SENSITIVE_RE.sub(r'\1=%s' % REDACTED, text)
+    return JSON_SENSITIVE_RE.sub(r'\1"%s"' % REDACTED, text)
+
+
+class Preview(object):
+    """Formats a redacted, size capped version of ``value`` only when
+    the log record is actually emitted
+    """
+    def __init__(self, value, max_length=1000):
+        self.value = value
+        self.max_length = max_length
+
+    def __unicode__(self):
+        value = self.value
+        if isinstance(value, dict):
+            value = dict([(k, REDACTED if k in SENSITIVE_KEYS else v)
+                          for k, v in value.items()])
+        if isinstance(value, str):
+            value = value.decode('utf8', 'replace')
+        ## redact first, a capped value could escape the patterns
+        text = redact(unicode(value))
+        if self.max_length and len(text) > self.max_length:
+            text = u'%s... (%s characters)' % (text[:self.max_length],
+                                               len(text))
+        return text
+
+    def __str__(self):
+        return unicode(self).encode('utf8')
+
+
+class Trace(object):
+    """A sampled request, logs its response"""
+    def __init__(self, tracer, url):
+        self.tracer = tracer
+        self.url = url
+        self.start = time.time()
+
+    def response(self, response):
+        tracer = self.tracer
+        tracer.logger.info(
+            'Facebook Graph API response for %s after %.3fs: %s',
+            Preview(self.url.split('?', 1)[0]), time.time() - self.start,
+            Preview(response, tracer.max_length))
+
+
+class Tracer(object):
+    """
+    :param sample_rate: the fraction of requests which is logged
+    :param max_length: the maximum number of characters logged per
+        payload, 0 for no limit
+    :param logger: the logger to log to, defaults to ``open_facebook.api``
+    """
+    def __init__(self, sample_rate=0.01, max_length=1000, logger=None):
+        self.sample_rate = sample_rate
+        self.max_length = max_length
+        self.logger = logger or logging.getLogger('open_facebook.api')
+
+    def start(self, url, post_data=None):
+        """Returns a :class:`Trace` if this request is sampled, after
+        logging the request, or ``None``
+        """
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return None
+        if not self.logger.isEnabledFor(logging.INFO):
+            return None
+        self.logger.info('requesting url %s with post data %s',
+                         Preview(url, self.max_length),
+                         Preview(post_data, self.max_length))
+        return Trace(self, url)
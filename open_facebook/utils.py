@@ -1,8 +1,10 @@
 """Utility functions for ``open_facebook``.
 """
 
+import base64
 import logging
 import re
+import string
 import sys
 
 try:
@@ -17,6 +19,23 @@ logger = logging.getLogger(__name__)
 
 URL_PARAM_RE = re.compile('(?P<k>[^(=|&)]+)=(?P<v>[^&]+)(&|$)')
 URL_PARAM_NO_VALUE_RE = re.compile('(?P<k>[^(&|?)]+)(&|$)')
+ID_RE = re.compile(r'^[\d_]+$')
+## maps the url safe base64 alphabet to the standard one
+BASE64_URL_TRANSLATION = string.maketrans('-_', '+/')
+
+try:
+    from hmac import compare_digest as constant_time_compare
+except ImportError:
+    def constant_time_compare(a, b):
+        """Compares two strings in a time that only depends on their
+        length, so signatures can't be guessed byte by byte
+        """
+        if len(a) != len(b):
+            return False
+        result = 0
+        for x, y in zip(a, b):
+            result |= ord(x) ^ ord(y)
+        return result == 0
 
 
 def base64_url_decode_php_style(inp):
@@ -30,11 +49,53 @@ def base64_url_decode_php_style(inp):
     
     :param inp: The base64-encoded string to be decoded
     """
-    import base64
+    if isinstance(inp, unicode):
+        inp = inp.encode('ascii')
     padding_factor = (4 - len(inp) % 4) % 4
     inp += "=" * padding_factor
-    return base64.b64decode(unicode(inp).translate(
-        dict(zip(map(ord, u'-_'), u'+/'))))
+    return base64.b64decode(inp.translate(BASE64_URL_TRANSLATION))
+
+
+def is_write_request(url, post_data=None):
+    """Whether the request modifies data on Facebook, either by posting
+    data or through a ``method=post|delete`` parameter.
+    """
+    if post_data:
+        return True
+    if '?' not in url:
+        return False
+    import urlparse
+    query = url.split('?', 1)[1]
+    for key, value in urlparse.parse_qsl(query):
+        if key == 'method' and value.lower() != 'get':
+            return True
+    return False
+
+
+def get_path_family(path, max_segments=None):
+    """Groups Graph paths by replacing object ids with ``:id``, so
+    ``1234/comments`` and ``5678/comments`` both become ``:id/comments``
+
+    :param max_segments: only keep this many segments of the path
+    """
+    segments = [s for s in path.split('/') if s][:max_segments]
+    return '/'.join([':id' if ID_RE.match(s) else s for s in segments])
+
+
+def get_endpoint(url):
+    """Returns the endpoint ``url`` belongs to, for reporting metrics"""
+    import urlparse
+    return get_path_family(urlparse.urlsplit(url)[2], 2)
+
+
+def get_django_cache(name):
+    """Returns the Django cache configured as ``name``"""
+    try:
+        from django.core.cache import caches
+        return caches[name]
+    except ImportError:
+        from django.core.cache import get_cache
+        return get_cache(name)
 
 
 def encode_params(params_dict):